@@ -1,7 +1,7 @@
 from logging.config import fileConfig
 
 from alembic import context
-from sqlalchemy import engine_from_config, pool, text
+from sqlalchemy import Connection, engine_from_config, pool, text
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
@@ -55,12 +55,8 @@ def run_migrations_online() -> None:
 
     """
     patroni_postgresql: bool = "patroni_postgresql" in context.get_x_argument(as_dictionary=True)
-    connectable = engine_from_config(
-        config.get_section(config.config_ini_section),  # type: ignore
-        prefix="sqlalchemy.",
-        poolclass=pool.NullPool,
-    )
-    with connectable.connect() as connection:
+
+    def do_run_migrations(connection: Connection) -> None:
         context.configure(connection=connection, target_metadata=target_metadata)
 
         with context.begin_transaction():
@@ -71,6 +67,20 @@ def run_migrations_online() -> None:
                 context.execute(text("SET ROLE wiremind_owner"))
             context.run_migrations()
 
+    # Connection shared by Chartreuse when it runs the upgrade in-process (upgrade_engine: inprocess)
+    shared_connection: Connection | None = config.attributes.get("connection")
+    if shared_connection is not None:
+        do_run_migrations(shared_connection)
+        return
+
+    connectable = engine_from_config(
+        config.get_section(config.config_ini_section),  # type: ignore
+        prefix="sqlalchemy.",
+        poolclass=pool.NullPool,
+    )
+    with connectable.connect() as connection:
+        do_run_migrations(connection)
+
 
 if context.is_offline_mode():
     run_migrations_offline()
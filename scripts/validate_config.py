@@ -43,18 +43,20 @@ def validate_config(config_path: str) -> bool:
             config = yaml.safe_load(f)
 
         # Validate structure
-        if "databases" not in config:
+        if "databases" not in config and "fleet" not in config:
             print("❌ Configuration must contain 'databases' key")
             return False
 
-        databases = config["databases"]
+        databases = config.get("databases") or {}
         if not isinstance(databases, dict):
             print("❌ 'databases' must be a dictionary with database names as keys")
             return False
 
-        if len(databases) == 0:
+        if len(databases) == 0 and "fleet" not in config:
             print("❌ At least one database must be configured")
             return False
+        if "fleet" in config:
+            print("ℹ️  The fleet section is not validated by this script, use chartreuse's config loader")
 
         # Validate each database
         required_fields = [
@@ -0,0 +1,5 @@
+"""
+Benchmarks of the overhead of Chartreuse on synthetic alembic revision histories.
+
+Run them from a source checkout with `python -m chartreuse.benchmarks --help`.
+"""
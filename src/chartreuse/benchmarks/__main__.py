@@ -0,0 +1,3 @@
+from .check_path import main
+
+main()
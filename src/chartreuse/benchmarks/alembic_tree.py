@@ -0,0 +1,102 @@
+"""
+Generation of synthetic alembic trees, with revisions doing nothing so that only the overhead of Chartreuse
+and alembic is measured.
+"""
+
+import os
+from typing import Literal
+
+Shape = Literal["linear", "branched"]
+
+SECTION_NAME = "bench"
+
+ALEMBIC_INI = f"""[{SECTION_NAME}]
+script_location = migrations
+path_separator = os
+"""
+
+ENV_PY = """
+from alembic import context
+from sqlalchemy import engine_from_config, pool
+
+config = context.config
+
+
+def run_migrations(connection):
+    context.configure(connection=connection)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+connection = config.attributes.get("connection")
+if connection is None:
+    connectable = engine_from_config(
+        config.get_section(config.config_ini_section), prefix="sqlalchemy.", poolclass=pool.NullPool
+    )
+    with connectable.connect() as connection:
+        run_migrations(connection)
+else:
+    run_migrations(connection)
+"""
+
+REVISION = """
+revision = {revision!r}
+down_revision = {down_revision!r}
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    pass
+
+
+def downgrade() -> None:
+    pass
+"""
+
+
+def _get_down_revisions(revision_count: int, shape: Shape, branch_count: int) -> list[str | tuple[str, ...] | None]:
+    """Return the down revision of each revision, revision n being identified by its index."""
+    if shape == "linear" or revision_count < branch_count + 2:
+        return [None, *(_revision_id(index - 1) for index in range(1, revision_count))]
+
+    # A root, branch_count branches forking from it, and a revision merging them back into a single head
+    down_revisions: list[str | tuple[str, ...] | None] = [None]
+    branch_length = (revision_count - 2) // branch_count
+    branch_heads: list[str] = []
+    for branch in range(branch_count):
+        # The last branch takes the remaining revisions
+        length = branch_length if branch < branch_count - 1 else revision_count - 2 - branch_length * branch
+        down_revision = _revision_id(0)
+        for _ in range(length):
+            down_revisions.append(down_revision)
+            down_revision = _revision_id(len(down_revisions) - 1)
+        branch_heads.append(down_revision)
+    down_revisions.append(tuple(branch_heads))
+    return down_revisions
+
+
+def _revision_id(index: int) -> str:
+    return f"{index:012x}"
+
+
+def write_synthetic_tree(
+    alembic_directory_path: str, revision_count: int, shape: Shape = "linear", branch_count: int = 4
+) -> str:
+    """
+    Write an alembic directory with revision_count revisions, as a single chain or as branch_count branches merged
+    into a single head. Return the head revision.
+    """
+    versions_path = os.path.join(alembic_directory_path, "migrations", "versions")
+    os.makedirs(versions_path)
+    with open(os.path.join(alembic_directory_path, "alembic.ini"), "w") as f:
+        f.write(ALEMBIC_INI)
+    with open(os.path.join(alembic_directory_path, "migrations", "env.py"), "w") as f:
+        f.write(ENV_PY)
+
+    down_revisions = _get_down_revisions(revision_count, shape, branch_count)
+    for index, down_revision in enumerate(down_revisions):
+        revision = _revision_id(index)
+        with open(os.path.join(versions_path, f"{revision}_revision.py"), "w") as f:
+            f.write(REVISION.format(revision=revision, down_revision=down_revision))
+    return _revision_id(len(down_revisions) - 1)
@@ -1,12 +1,57 @@
+import asyncio
+import contextlib
+import itertools
 import logging
+import threading
+import time
+from collections import Counter
+from collections.abc import Callable, Collection, Container, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from graphlib import TopologicalSorter
+from typing import TYPE_CHECKING, Any, Literal, TypeVar
 
-import wiremind_kubernetes.kubernetes_helper
+from .config_loader import DatabaseConfig, validate_dependencies
+from .utils import AlembicMigrationHelper, MigrationPlan, dispose_engines
 
-from .config_loader import DatabaseConfig
-from .utils import AlembicMigrationHelper
+if TYPE_CHECKING:
+    from wiremind_kubernetes.kubernetes_helper import KubernetesDeploymentManager
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_MAX_CONCURRENCY = 4
+# Seconds the databases have to become ready before being checked
+DEFAULT_READINESS_TIMEOUT = 60
+# Seconds between two checks of the deployments being stopped by the coordinator of a sharded run
+STOPPED_PODS_POLL_INTERVAL = 2.0
+# Seconds a shard waits for a database it depends on to be upgraded by another shard, and between two checks of it
+DEFAULT_DEPENDENCY_WAIT_TIMEOUT = 3600
+DEPENDENCY_POLL_INTERVAL = 5.0
+# Fleet databases checked, upgraded or planned together: their configurations and helpers are dropped once their batch
+# is done, so that a large fleet is never held at once
+FLEET_BATCH_SIZE = 1000
+
+T = TypeVar("T")
+
+UpgradeStatus = Literal["upgraded", "up_to_date", "failed", "not_upgraded"]
+
+
+class _DependencyWaitError(Exception):
+    """Waiting for a database upgraded by another shard failed, the database depending on it is not upgraded."""
+
+    def __init__(self, dependency: str):
+        super().__init__(f"dependencies not upgraded: {dependency}")
+        self.dependency = dependency
+
+
+@dataclass(frozen=True)
+class UpgradeResult:
+    """Outcome of the upgrade of one database, with the time its upgrade took in seconds."""
+
+    status: UpgradeStatus
+    duration: float = 0.0
+    error: str | None = None
+
 
 def configure_logging() -> None:
     logging.basicConfig(
@@ -16,65 +61,659 @@ def configure_logging() -> None:
     )
 
 
-class Chartreuse:
-    """Handles single or multiple database migrations."""
+def create_migration_helpers(
+    databases_config: dict[str, DatabaseConfig], configure: bool = True
+) -> dict[str, AlembicMigrationHelper]:
+    """
+    Initialize the migration helper of each database.
+    This is done serially as helpers of databases without a template section may write to the same alembic.ini,
+    checks are run lazily. Without configure, alembic.ini is left untouched: the helpers can only be used in-process.
+    """
+    migration_helpers: dict[str, AlembicMigrationHelper] = {}
+    for db_name, db_config in databases_config.items():
+        logger.info("Initializing migration helper for database: %s", db_name)
+
+        # Build additional parameters with section name
+        additional_params = db_config.additional_parameters
+
+        # Use database name as section name for alembic -n parameter
+        section_param = f"-n {db_name}"
+
+        additional_params = f"{additional_params} {section_param}".strip()
+
+        helper = AlembicMigrationHelper(
+            alembic_directory_path=db_config.alembic_directory_path,
+            alembic_config_file_path=db_config.alembic_config_file_path,
+            database_url=db_config.url,
+            allow_migration_for_empty_database=db_config.allow_migration_for_empty_database,
+            additional_parameters=additional_params,
+            alembic_section_name=db_name,
+            alembic_template_section_name=db_config.alembic_template_section,
+            check_mode=db_config.check_mode,
+            upgrade_engine=db_config.upgrade_engine,
+            record_migration_history=db_config.record_migration_history,
+            lock_timeout=db_config.lock_timeout,
+            statement_timeout=db_config.statement_timeout,
+            lock_retry_deadline=db_config.lock_retry_deadline,
+            preload_modules=db_config.preload_modules,
+            max_replication_lag=db_config.max_replication_lag,
+            replication_throttle_timeout=db_config.replication_throttle_timeout,
+            configure=configure,
+        )
+        migration_helpers[db_name] = helper
+    return migration_helpers
+
+
+def _iter_batches(databases: Iterable[tuple[str, DatabaseConfig]]) -> Iterator[dict[str, DatabaseConfig]]:
+    databases = iter(databases)
+    while batch := dict(itertools.islice(databases, FLEET_BATCH_SIZE)):
+        yield batch
+
+
+def plan_migrations(
+    databases: Iterable[tuple[str, DatabaseConfig]], max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+) -> Iterator[tuple[str, MigrationPlan]]:
+    """
+    Compute concurrently the migration plan of every database, without touching Kubernetes. The databases, e.g. from
+    MultiDatabaseConfig.iter_databases(), are planned by batches of FLEET_BATCH_SIZE as they are iterated, and their
+    plans yielded in order.
+    """
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="chartreuse") as executor:
+        for batch in _iter_batches(databases):
+            # Plans are computed in-process from in-memory configurations: planning must not write credentials to
+            # alembic.ini
+            migration_helpers = create_migration_helpers(batch, configure=False)
+            try:
+                plans = executor.map(lambda helper: helper.get_migration_plan(), migration_helpers.values())
+                yield from zip(migration_helpers, plans, strict=True)
+            finally:
+                dispose_engines(helper.database_url for helper in migration_helpers.values())
+
+
+class AsyncChartreuse:
+    """
+    Handles single or multiple database migrations, with asyncio so that waiting on the databases and waiting on
+    Kubernetes can overlap.
+
+    Database checks and in-process upgrades are synchronous: they run in a pool of max_concurrency threads.
+    Subprocess upgrades run as asyncio subprocesses, Kubernetes calls in asyncio's default thread pool.
+    """
 
     def __init__(
         self,
         databases_config: dict[str, DatabaseConfig],
         release_name: str,
-        kubernetes_helper: wiremind_kubernetes.kubernetes_helper.KubernetesDeploymentManager | None = None,
+        kubernetes_helper: "KubernetesDeploymentManager | None" = None,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        readiness_timeout: float | None = None,
+        patroni_postgresql: bool = False,
+        upgraded_databases: Container[str] | None = None,
+        dependency_wait_timeout: float = DEFAULT_DEPENDENCY_WAIT_TIMEOUT,
+        fleet_databases: Callable[[], Iterable[tuple[str, DatabaseConfig]]] | None = None,
+        checked_databases: Container[str] | None = None,
     ):
         configure_logging()
 
+        if max_concurrency < 1:
+            raise ValueError(f"max_concurrency must be at least 1, got {max_concurrency}")
+        validate_dependencies(databases_config)
+
         self.databases_config = databases_config
-        self.migration_helpers: dict[str, AlembicMigrationHelper] = {}
+        self.max_concurrency = max_concurrency
+        self.upgrade_results: dict[str, UpgradeResult] = {}
+        # One deadline for all the databases to be ready, None to check them without waiting
+        self._readiness_deadline = None if readiness_timeout is None else time.monotonic() + readiness_timeout
+        self.patroni_postgresql = patroni_postgresql
+        # Database checks are I/O bound (remote round trips, alembic subprocesses): run them in threads
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="chartreuse")
+        self._deployments_to_scale: set[str] | None = None
+        self._has_deployments_to_scale = False
+        self.migration_helpers = create_migration_helpers(databases_config)
+        # Iterates over the tenant databases of a fleet, which only depend on databases of databases_config: called
+        # again for each pass over the databases, the fleet databases of the current batch being the only ones known
+        self.fleet_databases = fleet_databases
+        self._fleet_batch: dict[str, DatabaseConfig] = {}
+        # Helpers of the fleet databases of the current batch, created when they are first checked
+        self._fleet_helpers: dict[str, AlembicMigrationHelper] = {}
+        self._fleet_helpers_lock = threading.Lock()
+        # Databases checked, all by default, and databases upgraded by upgrade(), all the checked ones by default: the
+        # coordinator of a sharded run checks every database, to scale the deployments they use, but only upgrades the
+        # ones of its shard. The others are only waited for by the upgraded databases depending on them, until they
+        # are upgraded by their shard.
+        self.checked_databases = checked_databases
+        self.upgraded_databases = upgraded_databases
+        self.dependency_wait_timeout = dependency_wait_timeout
+        self._dependency_waits: dict[str, asyncio.Task] = {}
+
+        self.release_name = release_name
+        self._kubernetes_helper = kubernetes_helper
+
+    @property
+    def kubernetes_helper(self) -> "KubernetesDeploymentManager":
+        """
+        The Kubernetes helper, created on first use: the Kubernetes client is slow to import and not needed when
+        there is nothing to migrate.
+        """
+        if self._kubernetes_helper is None:
+            import wiremind_kubernetes.kubernetes_helper
+
+            self._kubernetes_helper = wiremind_kubernetes.kubernetes_helper.KubernetesDeploymentManager(
+                use_kubeconfig=None, release_name=self.release_name
+            )
+        return self._kubernetes_helper
+
+    @kubernetes_helper.setter
+    def kubernetes_helper(self, kubernetes_helper: "KubernetesDeploymentManager") -> None:
+        self._kubernetes_helper = kubernetes_helper
+
+    def close(self) -> None:
+        """Stop the worker threads and close the database connections."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        dispose_engines()
+
+    async def _run_in_thread(self, function: Callable[..., T], *args: Any) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def iter_database_batches(self) -> Iterator[dict[str, DatabaseConfig]]:
+        """
+        Yield the databases by batches, as the fleet databases are discovered: the databases of databases_config, then
+        the fleet databases by batches of FLEET_BATCH_SIZE. The helpers of the fleet databases of a batch are created
+        when they are first used, and dropped with their connections once the batch is done.
+        """
+        yield self.databases_config
+        if self.fleet_databases is None:
+            return
+        for batch in _iter_batches(self.fleet_databases()):
+            self._fleet_batch = batch
+            try:
+                yield batch
+            finally:
+                with self._fleet_helpers_lock:
+                    fleet_helpers, self._fleet_helpers = self._fleet_helpers, {}
+                self._fleet_batch = {}
+                dispose_engines(helper.database_url for helper in fleet_helpers.values())
+
+    def _get_config(self, db_name: str) -> DatabaseConfig:
+        if db_name in self.databases_config:
+            return self.databases_config[db_name]
+        return self._fleet_batch[db_name]
+
+    def _get_helper(self, db_name: str) -> AlembicMigrationHelper:
+        if db_name in self.migration_helpers:
+            return self.migration_helpers[db_name]
+        with self._fleet_helpers_lock:
+            if db_name not in self._fleet_helpers:
+                self._fleet_helpers.update(create_migration_helpers({db_name: self._fleet_batch[db_name]}))
+            return self._fleet_helpers[db_name]
+
+    def _is_checked(self, db_name: str) -> bool:
+        return self.checked_databases is None or db_name in self.checked_databases
+
+    def _is_upgraded(self, db_name: str) -> bool:
+        if self.upgraded_databases is None:
+            return self._is_checked(db_name)
+        return db_name in self.upgraded_databases
+
+    def _check(self, db_name: str) -> bool:
+        helper = self._get_helper(db_name)
+        # Each database is checked as soon as it is ready, without waiting for the others
+        if self._readiness_deadline is not None:
+            helper.wait_until_ready(self._readiness_deadline, patroni_postgresql=self.patroni_postgresql)
+        return helper.is_migration_needed
 
-        # Initialize migration helpers for each database
-        for db_name, db_config in databases_config.items():
-            logger.info("Initializing migration helper for database: %s", db_name)
+    async def is_migration_needed(self) -> bool:
+        """Check concurrently if any database needs migration, returning as soon as one does."""
 
-            # Build additional parameters with section name
-            additional_params = db_config.additional_parameters
+        async def check(db_name: str) -> tuple[str, bool]:
+            return db_name, await self._run_in_thread(self._check, db_name)
 
-            # Use database name as section name for alembic -n parameter
-            section_param = f"-n {db_name}"
+        for batch in self.iter_database_batches():
+            checks = [asyncio.ensure_future(check(db_name)) for db_name in batch if self._is_checked(db_name)]
+            try:
+                for completed in asyncio.as_completed(checks):
+                    db_name, is_migration_needed = await completed
+                    if is_migration_needed:
+                        logger.info("Database '%s' needs migration", db_name)
+                        return True
+            finally:
+                # Checks still running go on in their thread, their result is kept by their helper
+                for pending_check in checks:
+                    pending_check.cancel()
+        return False
+
+    async def _check_all(self, db_names: Iterable[str]) -> dict[str, bool]:
+        """Check concurrently which databases need migration."""
+        db_names = list(db_names)
+        results = await asyncio.gather(*(self._run_in_thread(self._check, db_name) for db_name in db_names))
+        return dict(zip(db_names, results, strict=True))
+
+    async def _upgrade_database(self, db_name: str, subprocess_slots: asyncio.Semaphore) -> float:
+        logger.info("Upgrading database: %s", db_name)
+        helper = self._get_helper(db_name)
+        started_at = time.monotonic()
+        if helper.upgrade_engine == "subprocess":
+            async with subprocess_slots:
+                await helper.async_upgrade_db()
+        else:
+            await self._run_in_thread(helper.upgrade_db)
+        logger.info("Successfully upgraded database: %s", db_name)
+        return time.monotonic() - started_at
+
+    async def _upgrade_after_other_shards(self, db_name: str, subprocess_slots: asyncio.Semaphore) -> float:
+        """Upgrade a database once the databases it depends on, upgraded by other shards, are upgraded."""
+        for dependency in self._get_config(db_name).depends_on:
+            if self._is_upgraded(dependency):
+                continue
+            if dependency not in self._dependency_waits:
+                # Waited for once, by every database depending on it
+                self._dependency_waits[dependency] = asyncio.ensure_future(
+                    self._wait_for_upgrade_by_other_shard(dependency)
+                )
+            try:
+                await self._dependency_waits[dependency]
+            except Exception as e:
+                raise _DependencyWaitError(dependency) from e
+        return await self._upgrade_database(db_name, subprocess_slots)
+
+    async def _wait_for_upgrade_by_other_shard(self, db_name: str) -> None:
+        """Wait until a database upgraded by another shard does not need migration anymore."""
+        if not await self._run_in_thread(self._check, db_name):
+            return
+        logger.info("Waiting for database '%s' to be upgraded by its shard...", db_name)
+        helper = self._get_helper(db_name)
+        started_at = time.monotonic()
+        while await self._run_in_thread(helper.recheck_migration_needed):
+            if time.monotonic() - started_at >= self.dependency_wait_timeout:
+                raise TimeoutError(
+                    f"Database '{db_name}' was still not upgraded by its shard after {self.dependency_wait_timeout}s"
+                )
+            await asyncio.sleep(DEPENDENCY_POLL_INTERVAL)
+        logger.info("Database '%s' was upgraded by its shard", db_name)
 
-            additional_params = f"{additional_params} {section_param}".strip()
+    async def get_deployments_to_scale(self) -> set[str] | None:
+        """
+        Deployments using a database that needs migration, to stop during the upgrade.
+        None if one of those databases does not declare its deployments: all the deployments are then stopped.
+        """
+        if not self._has_deployments_to_scale:
+            self._deployments_to_scale = await self._get_deployments_to_scale()
+            self._has_deployments_to_scale = True
+        return self._deployments_to_scale
 
-            helper = AlembicMigrationHelper(
-                alembic_directory_path=db_config.alembic_directory_path,
-                alembic_config_file_path=db_config.alembic_config_file_path,
-                database_url=db_config.url,
-                allow_migration_for_empty_database=db_config.allow_migration_for_empty_database,
-                additional_parameters=additional_params,
-                alembic_section_name=db_name,
+    async def _get_deployments_to_scale(self) -> set[str] | None:
+        deployments: set[str] = set()
+        for batch in self.iter_database_batches():
+            migration_needs = await self._check_all(db_name for db_name in batch if self._is_checked(db_name))
+            batch_deployments = await self._get_deployments_of(
+                [db_name for db_name in migration_needs if migration_needs[db_name]]
             )
-            self.migration_helpers[db_name] = helper
+            if batch_deployments is None:
+                return None
+            deployments.update(batch_deployments)
+        return deployments
 
-        # Initialize Kubernetes helper
-        if kubernetes_helper:
-            self.kubernetes_helper = kubernetes_helper
+    async def _get_deployments_of(self, db_names: Collection[str]) -> set[str] | None:
+        """Deployments using the databases, None if one of them does not declare its deployments."""
+        deployments: set[str] = set()
+        for db_name in db_names:
+            db_config = self._get_config(db_name)
+            if db_config.deployments is None and db_config.deployment_selector is None:
+                logger.info("Database '%s' does not declare its deployments, all of them will be stopped", db_name)
+                return None
+            deployments.update(db_config.deployments or [])
+            if db_config.deployment_selector:
+                selected_deployments = await asyncio.to_thread(
+                    self.kubernetes_helper.client_appsv1_api.list_namespaced_deployment,
+                    namespace=self.kubernetes_helper.namespace,
+                    label_selector=db_config.deployment_selector,
+                )
+                deployments.update(deployment.metadata.name for deployment in selected_deployments.items)
+        return deployments
+
+    async def _get_expected_deployment_scales(self) -> dict[int, dict[str, int]]:
+        """The expected scale of the deployments to scale, by priority."""
+        deployments = await self.get_deployments_to_scale() or set()
+        expected_deployment_scale_dict = await asyncio.to_thread(
+            self.kubernetes_helper._get_expected_deployment_scale_dict
+        )
+        expected_deployment_scales = {
+            priority: {name: scale for name, scale in priority_dict.items() if name in deployments}
+            for priority, priority_dict in expected_deployment_scale_dict.items()
+        }
+        managed_deployments = {name for priority_dict in expected_deployment_scales.values() for name in priority_dict}
+        for name in sorted(deployments - managed_deployments):
+            logger.warning("Deployment %s has no ExpectedDeploymentScale, not scaling it", name)
+        return expected_deployment_scales
+
+    async def stop_deployments(self) -> None:
+        """Scale down the deployments to scale, by descending priority like KubernetesDeploymentManager.stop_pods."""
+        logger.info("Scaling down the Deployments using the databases to migrate...")
+        expected_deployment_scales = await self._get_expected_deployment_scales()
+        for priority in sorted(expected_deployment_scales, reverse=True):
+            if expected_deployment_scales[priority]:
+                await asyncio.to_thread(self.kubernetes_helper._stop_deployments, expected_deployment_scales[priority])
+        logger.info("Done scaling down the Deployments using the databases to migrate.")
+
+    async def start_deployments(self) -> None:
+        """Scale the deployments to scale back up, like KubernetesDeploymentManager.start_pods."""
+        logger.info("Scaling up the Deployments using the migrated databases...")
+        for priority_dict in (await self._get_expected_deployment_scales()).values():
+            for name, expected_scale in priority_dict.items():
+                await asyncio.to_thread(self.kubernetes_helper.re_enable_hpa, deployment_name=name)
+                await asyncio.to_thread(self.kubernetes_helper.scale_up_deployment, name, expected_scale)
+        logger.info("Done scaling up the Deployments using the migrated databases.")
+
+    async def stop_pods(self) -> None:
+        """Scale down the deployments to scale, or all the deployments of the release when they are not known."""
+        if await self.get_deployments_to_scale() is None:
+            await asyncio.to_thread(self.kubernetes_helper.stop_pods)
         else:
-            self.kubernetes_helper = wiremind_kubernetes.kubernetes_helper.KubernetesDeploymentManager(
-                use_kubeconfig=None, release_name=release_name
+            await self.stop_deployments()
+
+    async def prepare_and_stop_pods(self) -> bool:
+        """
+        Check the databases, starting to scale down as soon as one needs migration while the others are still being
+        checked and the ones to migrate prepared. Return whether a migration is needed, once the pods are stopped.
+        """
+
+        async def check(db_name: str) -> tuple[str, bool]:
+            return db_name, await self._run_in_thread(self._check, db_name)
+
+        preparations: list[asyncio.Future] = []
+        stop_pods: asyncio.Task | None = None
+        # Deployments using the databases needing migration so far, until one of them does not declare them
+        deployments: set[str] = set()
+        migration_needed = False
+        try:
+            for batch in self.iter_database_batches():
+                checks = [asyncio.ensure_future(check(db_name)) for db_name in batch if self._is_checked(db_name)]
+                try:
+                    for completed in asyncio.as_completed(checks):
+                        db_name, is_migration_needed = await completed
+                        if not is_migration_needed:
+                            continue
+                        logger.info("Database '%s' needs migration", db_name)
+                        migration_needed = True
+                        # The helpers of fleet databases are dropped with their batch: only prepare the others
+                        if db_name in self.migration_helpers and self._is_upgraded(db_name):
+                            preparations.append(
+                                asyncio.ensure_future(
+                                    self._run_in_thread(self.migration_helpers[db_name].prepare_upgrade)
+                                )
+                            )
+                        if stop_pods is not None:
+                            continue
+                        db_deployments = await self._get_deployments_of([db_name])
+                        if db_deployments is None:
+                            # All the deployments are stopped whatever the other checks find: don't wait for them.
+                            # They are all started again after the upgrade, without checking every database again.
+                            logger.info("Scaling down while the other databases are checked...")
+                            self._deployments_to_scale = None
+                            self._has_deployments_to_scale = True
+                            stop_pods = asyncio.create_task(asyncio.to_thread(self.kubernetes_helper.stop_pods))
+                        else:
+                            deployments.update(db_deployments)
+                finally:
+                    for pending_check in checks:
+                        pending_check.cancel()
+
+            if not migration_needed:
+                return False
+            if stop_pods is None:
+                # The deployments to stop depend on every check, which are done by now
+                self._deployments_to_scale = deployments
+                self._has_deployments_to_scale = True
+                stop_pods = asyncio.create_task(self.stop_pods())
+            await asyncio.gather(stop_pods, *preparations)
+            return True
+        except Exception:
+            if stop_pods is not None:
+                await self._start_pods_without_upgrade(stop_pods)
+            raise
+        finally:
+            for task in preparations:
+                task.cancel()
+
+    async def _start_pods_without_upgrade(self, stop_pods: asyncio.Task) -> None:
+        """
+        Scale back up the deployments being stopped when a check or a preparation failed, as no upgrade will run.
+        """
+        logger.error("Checking or preparing the databases failed, scaling the Deployments back up...")
+        # The scale-down runs in a thread, which can't be cancelled: wait for it
+        with contextlib.suppress(Exception):
+            await stop_pods
+        try:
+            await self.start_pods()
+        except Exception:
+            logger.exception("Couldn't scale up the Deployments after a failed check, SHOULD BE DONE MANUALLY !")
+
+    async def start_pods(self) -> None:
+        """Scale back up the deployments to scale, or all the deployments of the release when they are not known."""
+        if await self.get_deployments_to_scale() is None:
+            await asyncio.to_thread(self.kubernetes_helper.start_pods)
+        else:
+            await self.start_deployments()
+
+    async def wait_for_stopped_pods(self, timeout: float, db_names: Collection[str] | None = None) -> None:
+        """
+        Wait until the deployments using the given databases, the deployments to scale by default, are stopped by
+        the coordinator of a sharded run, all the deployments of the release when they are not known.
+        Raise TimeoutError if they are still running after timeout seconds.
+        """
+        deployments = await (
+            self.get_deployments_to_scale() if db_names is None else self._get_deployments_of(db_names)
+        )
+        if deployments is None:
+            expected_deployment_scale_dict = await asyncio.to_thread(
+                self.kubernetes_helper._get_expected_deployment_scale_dict
+            )
+            deployments = {name for priority_dict in expected_deployment_scale_dict.values() for name in priority_dict}
+
+        logger.info("Waiting for the Deployments to be scaled down...")
+        deadline = time.monotonic() + timeout
+        for name in sorted(deployments):
+            while not await asyncio.to_thread(self.kubernetes_helper.is_deployment_stopped, name):
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Deployment {name} is still running after {timeout}s")
+                await asyncio.sleep(STOPPED_PODS_POLL_INTERVAL)
+        logger.info("Done waiting for the Deployments to be scaled down.")
+
+    async def is_database_migration_needed(self, db_name: str) -> bool:
+        """Check one database of the current batch, for the workers of a work queue."""
+        return await self._run_in_thread(self._check, db_name)
+
+    async def upgrade_database(self, db_name: str) -> None:
+        """
+        Upgrade one database of the current batch, whatever its dependencies, recording its result for the workers of
+        a work queue.
+        """
+        try:
+            duration = await self._upgrade_database(db_name, asyncio.Semaphore(1))
+        except Exception as e:
+            self.upgrade_results[db_name] = UpgradeResult(status="failed", error=str(e))
+            raise
+        self.upgrade_results[db_name] = UpgradeResult(status="upgraded", duration=duration)
+
+    def _skip_upgrade(self, db_name: str, not_upgraded: list[str]) -> None:
+        logger.error(
+            "Not upgrading database '%s' as its dependencies were not upgraded: %s", db_name, ", ".join(not_upgraded)
+        )
+        self.upgrade_results[db_name] = UpgradeResult(
+            status="not_upgraded", error=f"dependencies not upgraded: {', '.join(not_upgraded)}"
+        )
+
+    def _log_upgrade_report(self) -> None:
+        """Log how many databases ended in each status, and which ones were not upgraded."""
+        statuses = Counter(result.status for result in self.upgrade_results.values())
+        logger.info("Upgrade report: %s", ", ".join(f"{count} {status}" for status, count in sorted(statuses.items())))
+        for db_name, result in self.upgrade_results.items():
+            if result.status == "upgraded":
+                logger.info("  %s: upgraded in %.2fs", db_name, result.duration)
+            elif result.status != "up_to_date":
+                logger.error("  %s: %s (%s)", db_name, result.status, result.error)
+
+    async def upgrade(self) -> None:
+        """
+        Upgrade all databases that need migration.
+
+        Independent databases are upgraded in parallel, a database is only upgraded once all the databases it
+        depends on have been successfully upgraded (or were up to date). Dependencies upgraded by another shard are
+        polled until they are, for up to dependency_wait_timeout seconds. The fleet databases are upgraded by batches,
+        once the databases of databases_config are done.
+        """
+        # In-process upgrades are bounded by the thread pool, subprocess upgrades by this semaphore
+        subprocess_slots = asyncio.Semaphore(self.max_concurrency)
+        self._dependency_waits = {}
+
+        failed: dict[str, BaseException] = {}
+        # Ordered set of the databases not upgraded as a dependency was not
+        skipped: dict[str, None] = {}
+        # The fleet databases of a batch only depend on databases of databases_config, upgraded by the first batch
+        for batch in self.iter_database_batches():
+            upgraded_databases = [db_name for db_name in batch if self._is_upgraded(db_name)]
+            migration_needs = await self._check_all(upgraded_databases)
+            # Dependencies upgraded by other shards are waited for before the upgrade of the databases depending on them
+            sorter = TopologicalSorter(
+                {
+                    db_name: [
+                        dependency
+                        for dependency in batch[db_name].depends_on
+                        if dependency in batch and self._is_upgraded(dependency)
+                    ]
+                    for db_name in upgraded_databases
+                }
             )
+            sorter.prepare()
+
+            running: dict[asyncio.Task, str] = {}
+            while sorter.is_active():
+                for db_name in sorter.get_ready():
+                    not_upgraded = [
+                        dependency
+                        for dependency in batch[db_name].depends_on
+                        if dependency in failed or dependency in skipped
+                    ]
+                    if not_upgraded:
+                        self._skip_upgrade(db_name, not_upgraded)
+                        skipped[db_name] = None
+                        sorter.done(db_name)
+                    elif not migration_needs[db_name]:
+                        logger.info("Database '%s' is up to date", db_name)
+                        self.upgrade_results[db_name] = UpgradeResult(status="up_to_date")
+                        sorter.done(db_name)
+                    else:
+                        running[asyncio.create_task(self._upgrade_after_other_shards(db_name, subprocess_slots))] = (
+                            db_name
+                        )
+
+                if not running:
+                    continue
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    db_name = running.pop(task)
+                    error = task.exception()
+                    if isinstance(error, _DependencyWaitError):
+                        if error.dependency not in failed:
+                            logger.error("Failed to upgrade database '%s': %s", error.dependency, error.__cause__)
+                            failed[error.dependency] = error.__cause__ or error
+                        self._skip_upgrade(db_name, [error.dependency])
+                        skipped[db_name] = None
+                    elif error is not None:
+                        logger.error("Failed to upgrade database '%s': %s", db_name, error)
+                        failed[db_name] = error
+                        self.upgrade_results[db_name] = UpgradeResult(status="failed", error=str(error))
+                    else:
+                        self.upgrade_results[db_name] = UpgradeResult(status="upgraded", duration=task.result())
+                    sorter.done(db_name)
+
+        self._log_upgrade_report()
+        if failed:
+            raise RuntimeError(
+                f"Failed to upgrade database(s): {', '.join(failed)}"
+                + (f", not upgraded: {', '.join(skipped)}" if skipped else "")
+            ) from next(iter(failed.values()))
+
+
+class Chartreuse:
+    """Synchronous API of AsyncChartreuse, each operation running in its own event loop."""
+
+    def __init__(
+        self,
+        databases_config: dict[str, DatabaseConfig],
+        release_name: str,
+        kubernetes_helper: "KubernetesDeploymentManager | None" = None,
+        max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+        readiness_timeout: float | None = None,
+        patroni_postgresql: bool = False,
+        upgraded_databases: Container[str] | None = None,
+        dependency_wait_timeout: float = DEFAULT_DEPENDENCY_WAIT_TIMEOUT,
+        fleet_databases: Callable[[], Iterable[tuple[str, DatabaseConfig]]] | None = None,
+        checked_databases: Container[str] | None = None,
+    ):
+        self.orchestrator = AsyncChartreuse(
+            databases_config=databases_config,
+            release_name=release_name,
+            kubernetes_helper=kubernetes_helper,
+            max_concurrency=max_concurrency,
+            readiness_timeout=readiness_timeout,
+            patroni_postgresql=patroni_postgresql,
+            upgraded_databases=upgraded_databases,
+            dependency_wait_timeout=dependency_wait_timeout,
+            fleet_databases=fleet_databases,
+            checked_databases=checked_databases,
+        )
+
+    @property
+    def databases_config(self) -> dict[str, DatabaseConfig]:
+        return self.orchestrator.databases_config
+
+    @property
+    def migration_helpers(self) -> dict[str, AlembicMigrationHelper]:
+        return self.orchestrator.migration_helpers
+
+    @property
+    def kubernetes_helper(self) -> "KubernetesDeploymentManager":
+        return self.orchestrator.kubernetes_helper
+
+    def iter_database_batches(self) -> Iterator[dict[str, DatabaseConfig]]:
+        return self.orchestrator.iter_database_batches()
+
+    @kubernetes_helper.setter
+    def kubernetes_helper(self, kubernetes_helper: "KubernetesDeploymentManager") -> None:
+        self.orchestrator.kubernetes_helper = kubernetes_helper
+
+    @property
+    def upgrade_results(self) -> dict[str, UpgradeResult]:
+        return self.orchestrator.upgrade_results
+
+    def close(self) -> None:
+        self.orchestrator.close()
 
     @property
     def is_migration_needed(self) -> bool:
-        """Check if any database needs migration."""
-        for db_name, helper in self.migration_helpers.items():
-            if helper.is_migration_needed:
-                logger.info("Database '%s' needs migration", db_name)
-                return True
-        return False
+        return asyncio.run(self.orchestrator.is_migration_needed())
+
+    @property
+    def deployments_to_scale(self) -> set[str] | None:
+        return asyncio.run(self.orchestrator.get_deployments_to_scale())
+
+    def stop_deployments(self) -> None:
+        asyncio.run(self.orchestrator.stop_deployments())
+
+    def prepare_and_stop_pods(self) -> bool:
+        return asyncio.run(self.orchestrator.prepare_and_stop_pods())
+
+    def start_deployments(self) -> None:
+        asyncio.run(self.orchestrator.start_deployments())
+
+    def wait_for_stopped_pods(self, timeout: float, db_names: Collection[str] | None = None) -> None:
+        asyncio.run(self.orchestrator.wait_for_stopped_pods(timeout, db_names))
+
+    def is_database_migration_needed(self, db_name: str) -> bool:
+        return asyncio.run(self.orchestrator.is_database_migration_needed(db_name))
+
+    def upgrade_database(self, db_name: str) -> None:
+        asyncio.run(self.orchestrator.upgrade_database(db_name))
 
     def upgrade(self) -> None:
-        """Upgrade all databases that need migration."""
-        for db_name, helper in self.migration_helpers.items():
-            if helper.is_migration_needed:
-                logger.info("Upgrading database: %s", db_name)
-                helper.upgrade_db()
-                logger.info("Successfully upgraded database: %s", db_name)
-            else:
-                logger.info("Database '%s' is up to date", db_name)
+        asyncio.run(self.orchestrator.upgrade())
@@ -1,15 +1,50 @@
+import importlib
 import logging
 import os
-
-from wiremind_kubernetes import KubernetesDeploymentManager
+import socket
+import sys
+from typing import TYPE_CHECKING, Any
 
 from chartreuse import get_version
 
-from .chartreuse import Chartreuse
-from .config_loader import load_multi_database_config
+from .utils.phase_timer import time_phase, write_phase_report
+
+if TYPE_CHECKING:
+    from .chartreuse import Chartreuse
+    from .work_queue import WorkQueue
 
 logger = logging.getLogger(__name__)
 
+# Imported on first use, most runs ending with nothing to migrate: the configuration and the databases need
+# pydantic, SQLAlchemy and alembic, and the Kubernetes client is only needed once pods have to be scaled.
+_LAZY_IMPORTS = {
+    "Chartreuse": "chartreuse.chartreuse",
+    "DEFAULT_MAX_CONCURRENCY": "chartreuse.chartreuse",
+    "DEFAULT_READINESS_TIMEOUT": "chartreuse.chartreuse",
+    "DEFAULT_SHARD_WAIT_TIMEOUT": "chartreuse.sharding",
+    "KubernetesDeploymentManager": "wiremind_kubernetes",
+    "Shard": "chartreuse.sharding",
+    "WorkQueue": "chartreuse.work_queue",
+    "get_engine": "chartreuse.utils",
+    "process_work_queue": "chartreuse.work_queue",
+    "read_multi_database_config": "chartreuse.config_loader",
+    "select_shard_databases": "chartreuse.sharding",
+    "wait_for_shards": "chartreuse.sharding",
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _LAZY_IMPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_LAZY_IMPORTS[name]), name)
+    globals()[name] = value
+    return value
+
+
+def _lazy(name: str) -> Any:
+    """A lazily imported name, looked up on this module so that it can be patched."""
+    return getattr(sys.modules[__name__], name)
+
 
 def ensure_safe_run() -> None:
     """
@@ -64,6 +99,57 @@ def main() -> None:
     """
     When put in a post-install Helm hook, if this program fails the whole release is considered as failed.
     """
+    report_directory: str = os.environ.get("CHARTREUSE_REPORT_DIRECTORY", "")
+    try:
+        with time_phase("total"):
+            run_upgrade()
+    finally:
+        if report_directory:
+            write_phase_report(report_directory)
+
+
+def _configure_kubernetes(chartreuse: "Chartreuse", release_name: str) -> None:
+    """Give Chartreuse the Kubernetes helper of the release, once pods have to be scaled."""
+    chartreuse.kubernetes_helper = _lazy("KubernetesDeploymentManager")(release_name=release_name, use_kubeconfig=None)
+
+
+def _upgrade_shard(chartreuse: "Chartreuse", release_name: str, enable_stop_pods: bool, wait_timeout: float) -> None:
+    """Upgrade the databases of a shard other than the coordinator, which scales the deployments."""
+    with time_phase("check"):
+        if not chartreuse.is_migration_needed:
+            return
+
+    if enable_stop_pods:
+        _configure_kubernetes(chartreuse, release_name)
+        with time_phase("wait_for_stopped_pods"):
+            chartreuse.wait_for_stopped_pods(wait_timeout)
+
+    with time_phase("upgrade"):
+        chartreuse.upgrade()
+
+
+def _work_on_queue(
+    chartreuse: "Chartreuse",
+    work_queue: "WorkQueue",
+    release_name: str,
+    enable_stop_pods: bool,
+    wait_timeout: float,
+    concurrency: int,
+) -> None:
+    """Migrate the databases claimed from the work queue as a worker other than the coordinator."""
+    before_upgrade = None
+    if enable_stop_pods:
+        _configure_kubernetes(chartreuse, release_name)
+
+        def before_upgrade(db_name: str) -> None:
+            # The coordinator stops the deployments using the databases to migrate
+            chartreuse.wait_for_stopped_pods(wait_timeout, [db_name])
+
+    with time_phase("upgrade"):
+        _lazy("process_work_queue")(work_queue, chartreuse, concurrency, before_upgrade=before_upgrade)
+
+
+def run_upgrade() -> None:
     ensure_safe_run()
 
     # Validate and get multi-database configuration path
@@ -73,7 +159,9 @@ def main() -> None:
     logger.info("Using multi-database configuration from: %s", multi_config_path)
 
     try:
-        databases_config = load_multi_database_config(multi_config_path)
+        with time_phase("load_config"):
+            # The tenants of the fleet are discovered as they are checked and upgraded, by batches
+            config = _lazy("read_multi_database_config")(multi_config_path)
     except (FileNotFoundError, ValueError) as e:
         logger.error("Failed to load multi-database configuration: %s", e)
         raise
@@ -85,30 +173,128 @@ def main() -> None:
         "false",
         "0",
     )
+    # Scale down as soon as one database needs migration, while the others are checked and prepared
+    OVERLAP_STOP_PODS: bool = os.environ.get("CHARTREUSE_OVERLAP_STOP_PODS", "false").lower() not in ("", "false", "0")
     HELM_IS_INSTALL: bool = os.environ.get("HELM_IS_INSTALL", "false").lower() not in ("", "false", "0")
+    MAX_CONCURRENCY: int = int(os.environ.get("CHARTREUSE_MAX_CONCURRENCY", _lazy("DEFAULT_MAX_CONCURRENCY")))
+    PATRONI_POSTGRESQL: bool = bool(os.environ.get("CHARTREUSE_PATRONI_POSTGRESQL"))
+    READINESS_TIMEOUT: float = float(
+        os.environ.get("CHARTREUSE_ALEMBIC_POSTGRES_WAIT_CONFIGURED_TIMEOUT", _lazy("DEFAULT_READINESS_TIMEOUT"))
+    )
 
-    deployment_manager = KubernetesDeploymentManager(release_name=RELEASE_NAME, use_kubeconfig=None)
-    chartreuse = Chartreuse(
-        databases_config=databases_config,
-        release_name=RELEASE_NAME,
-        kubernetes_helper=deployment_manager,
+    # Pods of an Indexed Job, each migrating the databases of its shard
+    SHARD_COUNT: int = int(os.environ.get("CHARTREUSE_SHARD_COUNT", "1"))
+    SHARD_WAIT_TIMEOUT: float = float(
+        os.environ.get("CHARTREUSE_SHARD_WAIT_TIMEOUT", _lazy("DEFAULT_SHARD_WAIT_TIMEOUT"))
     )
 
-    if chartreuse.is_migration_needed:
-        if ENABLE_STOP_PODS:
-            deployment_manager.stop_pods()
+    # Workers claiming the databases from a queue shared through a control database
+    WORK_QUEUE_URL: str = os.environ.get("CHARTREUSE_WORK_QUEUE_URL", "")
+    if WORK_QUEUE_URL and SHARD_COUNT > 1:
+        raise ValueError("CHARTREUSE_WORK_QUEUE_URL and CHARTREUSE_SHARD_COUNT can't be used together")
 
-        chartreuse.upgrade()
+    work_queue = None
+    is_coordinator = True
+    if WORK_QUEUE_URL:
+        # Like shards, the worker of index 0 of an Indexed Job coordinates the scaling of the deployments
+        is_coordinator = int(os.environ.get("JOB_COMPLETION_INDEX", "0")) == 0
+        work_queue = _lazy("WorkQueue")(
+            _lazy("get_engine")(WORK_QUEUE_URL),
+            run_id=os.environ["CHARTREUSE_WORK_QUEUE_RUN_ID"],
+            worker=socket.gethostname(),
+        )
+        # The databases are queued by process_work_queue, by batches
+        work_queue.create()
+
+    fleet_databases = None if config.fleet is None else config.iter_fleet_databases
+    shard = None
+    upgraded_databases = None
+    checked_databases = None
+    if SHARD_COUNT > 1:
+        shard = _lazy("Shard")(index=int(os.environ["JOB_COMPLETION_INDEX"]), count=SHARD_COUNT)
+        logger.info("Shard %d of %d.", shard.index, shard.count)
+        upgraded_databases = shard
+        if not shard.is_coordinator:
+            # The coordinator checks every database to scale the deployments they use, the other shards only check
+            # theirs, and the databases of other shards they wait for when upgrading
+            checked_databases = shard
+            if config.fleet is not None:
+
+                def iter_shard_fleet_databases() -> Any:
+                    return _lazy("select_shard_databases")(config.iter_fleet_databases(), shard)
 
-        if not ENABLE_STOP_PODS:
+                fleet_databases = iter_shard_fleet_databases
+
+    chartreuse: Chartreuse = _lazy("Chartreuse")(
+        databases_config=config.databases,
+        release_name=RELEASE_NAME,
+        max_concurrency=MAX_CONCURRENCY,
+        readiness_timeout=READINESS_TIMEOUT,
+        patroni_postgresql=PATRONI_POSTGRESQL,
+        upgraded_databases=upgraded_databases,
+        dependency_wait_timeout=SHARD_WAIT_TIMEOUT,
+        fleet_databases=fleet_databases,
+        checked_databases=checked_databases,
+    )
+
+    try:
+        if shard is not None and not shard.is_coordinator:
+            _upgrade_shard(chartreuse, RELEASE_NAME, ENABLE_STOP_PODS, SHARD_WAIT_TIMEOUT)
             return
-        if UPGRADE_BEFORE_DEPLOYMENT and not HELM_IS_INSTALL:
+        if work_queue is not None and not is_coordinator:
+            _work_on_queue(chartreuse, work_queue, RELEASE_NAME, ENABLE_STOP_PODS, SHARD_WAIT_TIMEOUT, MAX_CONCURRENCY)
             return
 
-        try:
-            deployment_manager.start_pods()
-        except Exception:
-            logger.error("Couldn't scale up new pods in chartreuse_upgrade after migration, SHOULD BE DONE MANUALLY ! ")
+        if ENABLE_STOP_PODS and OVERLAP_STOP_PODS:
+            _configure_kubernetes(chartreuse, RELEASE_NAME)
+            with time_phase("check_and_stop_pods"):
+                if not chartreuse.prepare_and_stop_pods():
+                    return
+        else:
+            with time_phase("check"):
+                if not chartreuse.is_migration_needed:
+                    return
+
+            if ENABLE_STOP_PODS:
+                _configure_kubernetes(chartreuse, RELEASE_NAME)
+                with time_phase("stop_pods"):
+                    # Only stop the deployments using the databases to migrate when they all declare them
+                    if chartreuse.deployments_to_scale is None:
+                        chartreuse.kubernetes_helper.stop_pods()
+                    else:
+                        chartreuse.stop_deployments()
+
+        with time_phase("upgrade"):
+            if work_queue is None:
+                chartreuse.upgrade()
+            else:
+                # Returns once every worker is done, raises if a database failed
+                _lazy("process_work_queue")(work_queue, chartreuse, MAX_CONCURRENCY)
+    finally:
+        # Don't keep idle connections to the databases while scaling up
+        chartreuse.close()
+
+    if not ENABLE_STOP_PODS:
+        return
+    if UPGRADE_BEFORE_DEPLOYMENT and not HELM_IS_INSTALL:
+        return
+
+    if shard is not None:
+        # Raises if a shard failed: the deployments are then left stopped, like when an upgrade fails
+        with time_phase("wait_for_shards"):
+            _lazy("wait_for_shards")(
+                chartreuse.kubernetes_helper, os.environ["CHARTREUSE_JOB_NAME"], shard, SHARD_WAIT_TIMEOUT
+            )
+
+    try:
+        with time_phase("start_pods"):
+            # On install, the deployments may not have been started yet: start all of them
+            if chartreuse.deployments_to_scale is None or HELM_IS_INSTALL:
+                chartreuse.kubernetes_helper.start_pods()
+            else:
+                chartreuse.start_deployments()
+    except Exception:
+        logger.error("Couldn't scale up new pods in chartreuse_upgrade after migration, SHOULD BE DONE MANUALLY ! ")
 
 
 if __name__ == "__main__":
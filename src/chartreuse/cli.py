@@ -0,0 +1,105 @@
+"""
+`chartreuse` command line, for the tasks that are not run by the Helm hook itself.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+from dataclasses import asdict
+
+from .chartreuse import DEFAULT_MAX_CONCURRENCY, configure_logging, plan_migrations
+from .config_loader import read_multi_database_config
+from .utils import MigrationPlan
+from .utils.revision_manifest import bake_manifest
+
+logger = logging.getLogger(__name__)
+
+
+def bake(args: argparse.Namespace) -> None:
+    for alembic_directory_path in args.alembic_directory_paths:
+        manifest_path = bake_manifest(alembic_directory_path, args.alembic_config_file_path)
+        logger.info("Revision manifest written to %s", manifest_path)
+
+
+def format_plan(db_name: str, plan: MigrationPlan) -> str:
+    if plan.skipped_empty_database:
+        return f"{db_name}: empty database, not upgraded (allow_migration_for_empty_database is false)"
+    lines = [
+        f"{db_name}: {len(plan.pending_revisions)} pending revision(s)",
+        f"  current: {', '.join(plan.current_revisions) or '<base>'}",
+        f"  heads: {', '.join(plan.head_revisions)}",
+    ]
+    lines.extend(f"  - {revision}" for revision in plan.pending_revisions)
+    return "\n".join(lines)
+
+
+def plan(args: argparse.Namespace) -> None:
+    if not args.config_path:
+        raise SystemExit("No configuration: pass its path or set CHARTREUSE_MULTI_CONFIG_PATH")
+    # The plans are printed as they are computed, without holding the databases of a fleet at once
+    plans = plan_migrations(
+        read_multi_database_config(args.config_path).iter_databases(), max_concurrency=args.max_concurrency
+    )
+
+    has_pending_revisions = False
+    if args.json:
+        # One JSON object, written one database at a time
+        separator = "{\n"
+        for db_name, migration_plan in plans:
+            has_pending_revisions = has_pending_revisions or bool(migration_plan.pending_revisions)
+            print(separator + json.dumps({db_name: asdict(migration_plan)}, indent=2)[2:-2], end="")
+            separator = ",\n"
+        print("{}" if separator == "{\n" else "\n}")
+    else:
+        for db_name, migration_plan in plans:
+            has_pending_revisions = has_pending_revisions or bool(migration_plan.pending_revisions)
+            print(format_plan(db_name, migration_plan))
+    if args.detailed_exitcode and has_pending_revisions:
+        sys.exit(2)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(prog="chartreuse", description="Helper for Alembic migrations within Kubernetes.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    bake_parser = subparsers.add_parser(
+        "bake",
+        help="Write the revision manifest of alembic directories, to be run when building the container image.",
+    )
+    bake_parser.add_argument("alembic_directory_paths", nargs="+", metavar="ALEMBIC_DIRECTORY")
+    bake_parser.add_argument(
+        "-c", "--config", dest="alembic_config_file_path", default="alembic.ini", help="Alembic config file name"
+    )
+    bake_parser.set_defaults(func=bake)
+
+    plan_parser = subparsers.add_parser(
+        "plan", help="Show the revisions an upgrade would apply to each database, without applying them."
+    )
+    plan_parser.add_argument(
+        "config_path",
+        nargs="?",
+        default=os.environ.get("CHARTREUSE_MULTI_CONFIG_PATH"),
+        metavar="CONFIG",
+        help="Multi-database configuration file (default: $CHARTREUSE_MULTI_CONFIG_PATH)",
+    )
+    plan_parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=int(os.environ.get("CHARTREUSE_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY)),
+        help="Maximum number of databases checked at the same time",
+    )
+    plan_parser.add_argument("--json", action="store_true", help="Print the plans as JSON")
+    plan_parser.add_argument(
+        "--detailed-exitcode", action="store_true", help="Exit with status 2 when a database has pending revisions"
+    )
+    plan_parser.set_defaults(func=plan)
+
+    args = parser.parse_args(argv)
+    configure_logging()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Sharding of the databases across the pods of a Kubernetes Indexed Job.
+
+Each pod of the Job migrates the databases of its shard, given by its JOB_COMPLETION_INDEX. Databases are assigned
+to shards by rendezvous hashing of their name: adding or removing a database never moves the others, and changing
+the number of shards only moves the databases of the shards added or removed. Dependencies don't change the
+assignment, so that a fleet of tenants depending on one shared database is still spread over every shard: a shard
+waits for the databases of other shards its databases depend on to be upgraded by their shard. As the assignment of
+a database only depends on its name, the tenants of a fleet are assigned as they are discovered.
+
+Shard 0 coordinates the run: it checks every database, stops the deployments before any shard upgrades and starts
+them once every shard is done. The other shards wait for the deployments to be stopped before upgrading theirs.
+"""
+
+import hashlib
+import logging
+import time
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from .config_loader import DatabaseConfig
+
+if TYPE_CHECKING:
+    from wiremind_kubernetes.kubernetes_helper import KubernetesDeploymentManager
+
+logger = logging.getLogger(__name__)
+
+COORDINATOR_SHARD_INDEX = 0
+# Seconds the shards wait for each other: for the deployments to be stopped, and for every shard to be done
+DEFAULT_SHARD_WAIT_TIMEOUT = 3600
+# Seconds between two reads of the status of the Job
+SHARD_POLL_INTERVAL = 5.0
+
+
+class ShardFailedError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Shard:
+    """The index-th of count shards."""
+
+    index: int
+    count: int
+
+    def __post_init__(self) -> None:
+        if self.count < 1:
+            raise ValueError(f"The shard count must be at least 1, got {self.count}")
+        if not 0 <= self.index < self.count:
+            raise ValueError(f"The shard index must be between 0 and {self.count - 1}, got {self.index}")
+
+    @property
+    def is_coordinator(self) -> bool:
+        return self.index == COORDINATOR_SHARD_INDEX
+
+    def __contains__(self, db_name: object) -> bool:
+        """Whether the database is assigned to the shard."""
+        return isinstance(db_name, str) and get_shard_index(db_name, self.count) == self.index
+
+
+def _get_weight(key: str, shard_index: int) -> int:
+    digest = hashlib.blake2b(f"{shard_index}:{key}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def get_shard_index(key: str, shard_count: int) -> int:
+    """The shard of the key: the one with the highest weight for it (rendezvous hashing)."""
+    return max(range(shard_count), key=lambda shard_index: _get_weight(key, shard_index))
+
+
+def select_shard_databases(
+    databases: Iterable[tuple[str, DatabaseConfig]], shard: Shard
+) -> Iterator[tuple[str, DatabaseConfig]]:
+    """The databases of the shard, in configuration order, as the databases are iterated."""
+    return ((db_name, db_config) for db_name, db_config in databases if db_name in shard)
+
+
+def parse_indexes(indexes: str | None) -> set[int]:
+    """Parse the completed or failed indexes of a Job status, e.g. "1,3-5"."""
+    parsed: set[int] = set()
+    for interval in filter(None, (indexes or "").split(",")):
+        first, _, last = interval.partition("-")
+        parsed.update(range(int(first), int(last or first) + 1))
+    return parsed
+
+
+def wait_for_shards(
+    kubernetes_helper: "KubernetesDeploymentManager", job_name: str, shard: Shard, timeout: float
+) -> None:
+    """
+    Wait until every other shard of the Indexed Job completed.
+    Raise ShardFailedError if one of them failed, or if they are not all done after timeout seconds.
+    """
+    other_indexes = set(range(shard.count)) - {shard.index}
+    deadline = time.monotonic() + timeout
+    while True:
+        job = kubernetes_helper.client_batchv1_api.read_namespaced_job(job_name, kubernetes_helper.namespace)
+        failed_indexes = parse_indexes(job.status.failed_indexes) & other_indexes
+        if failed_indexes or any(
+            condition.type == "Failed" and condition.status == "True" for condition in job.status.conditions or []
+        ):
+            raise ShardFailedError(f"Shard(s) of Job {job_name} failed: {sorted(failed_indexes) or 'unknown'}")
+        pending_indexes = other_indexes - parse_indexes(job.status.completed_indexes)
+        if not pending_indexes:
+            logger.info("All the shards of Job %s are done.", job_name)
+            return
+        if time.monotonic() >= deadline:
+            raise ShardFailedError(f"Shard(s) {sorted(pending_indexes)} of Job {job_name} still not done, giving up")
+        logger.info("Waiting for shard(s) %s of Job %s...", sorted(pending_indexes), job_name)
+        time.sleep(SHARD_POLL_INTERVAL)
@@ -43,7 +43,10 @@ def configure_os_environ_mock(mocker: MockerFixture, additional_environment: dic
             "additional_parameters": "",
         }
     ]
-    mocker.patch("chartreuse.chartreuse_upgrade.load_multi_database_config", return_value=mock_config)
+    mocker.patch(
+        "chartreuse.chartreuse_upgrade.read_multi_database_config",
+        return_value=mocker.MagicMock(databases=mock_config, fleet=None),
+    )
 
 
 def configure_chartreuse_mock(
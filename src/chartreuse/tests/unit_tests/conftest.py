@@ -1,7 +1,17 @@
-# Note: Not a fixture
+import os
+from collections.abc import Callable
+from typing import Any
+
+import pytest
+import sqlalchemy
 from pytest_mock.plugin import MockerFixture
 
+import chartreuse.utils
+
+HelperFactory = Callable[..., chartreuse.utils.AlembicMigrationHelper]
+
 
+# Note: Not a fixture
 def configure_chartreuse_mock(mocker: MockerFixture, is_migration_needed: bool = True) -> None:
     mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse.__init__", return_value=None)
     mocker.patch(
@@ -10,8 +20,105 @@ def configure_chartreuse_mock(mocker: MockerFixture, is_migration_needed: bool =
         return_value=is_migration_needed,
         create=True,
     )
+    mocker.patch(
+        "chartreuse.chartreuse_upgrade.Chartreuse.deployments_to_scale",
+        new_callable=mocker.PropertyMock,
+        return_value=None,
+        create=True,
+    )
+    # A plain attribute, set by chartreuse_upgrade once pods have to be scaled
+    mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse.kubernetes_helper", None)
     mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse.upgrade")
+    mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse.close")
     mocker.patch(
         "wiremind_kubernetes.kubernetes_helper._get_namespace_from_kube",
         return_value="foo",
     )
+
+
+SAMPLE_IN_PROCESS_ALEMBIC_INI = """[test]
+script_location = migrations
+prepend_sys_path = .
+"""
+
+SAMPLE_REVISION = """
+revision = "{revision}"
+down_revision = {down_revision}
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    pass
+
+
+def downgrade() -> None:
+    pass
+"""
+
+
+SAMPLE_ENV_PY = """
+from alembic import context
+from sqlalchemy import engine_from_config, pool
+
+config = context.config
+
+
+def run_migrations(connection):
+    context.configure(connection=connection)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+connection = config.attributes.get("connection")
+if connection is None:
+    connectable = engine_from_config(
+        config.get_section(config.config_ini_section), prefix="sqlalchemy.", poolclass=pool.NullPool
+    )
+    with connectable.connect() as connection:
+        run_migrations(connection)
+else:
+    run_migrations(connection)
+"""
+
+
+def write_alembic_tree(alembic_directory_path: str) -> None:
+    """Write an alembic directory with the two revisions aaaaaaaaaaaa -> bbbbbbbbbbbb."""
+    with open(os.path.join(alembic_directory_path, "alembic.ini"), "w") as f:
+        f.write(SAMPLE_IN_PROCESS_ALEMBIC_INI)
+    versions_path = os.path.join(alembic_directory_path, "migrations", "versions")
+    os.makedirs(versions_path)
+    with open(os.path.join(alembic_directory_path, "migrations", "env.py"), "w") as f:
+        f.write(SAMPLE_ENV_PY)
+    for revision, down_revision in (("aaaaaaaaaaaa", None), ("bbbbbbbbbbbb", "aaaaaaaaaaaa")):
+        with open(os.path.join(versions_path, f"{revision}.py"), "w") as f:
+            f.write(SAMPLE_REVISION.format(revision=revision, down_revision=repr(down_revision)))
+
+
+def stamp(database_url: str, revision: str) -> None:
+    """Populate the database with a table, at the given revision."""
+    engine = sqlalchemy.create_engine(database_url)
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text("CREATE TABLE foobar (id INTEGER)"))
+        connection.execute(sqlalchemy.text("CREATE TABLE alembic_version (version_num VARCHAR(32) NOT NULL)"))
+        connection.execute(sqlalchemy.text(f"INSERT INTO alembic_version VALUES ('{revision}')"))
+    engine.dispose()
+
+
+@pytest.fixture
+def make_helper() -> HelperFactory:
+    """
+    Factory of unconfigured AlembicMigrationHelpers of the test section, allowing the migration of empty databases,
+    by default on the test.db SQLite database of their alembic directory.
+    """
+
+    def make(alembic_directory_path: str | None = None, **kwargs: Any) -> chartreuse.utils.AlembicMigrationHelper:
+        if alembic_directory_path is not None:
+            kwargs["alembic_directory_path"] = alembic_directory_path
+            kwargs.setdefault("database_url", f"sqlite:///{alembic_directory_path}/test.db")
+        kwargs.setdefault("alembic_section_name", "test")
+        kwargs.setdefault("allow_migration_for_empty_database", True)
+        kwargs.setdefault("configure", False)
+        return chartreuse.utils.AlembicMigrationHelper(**kwargs)
+
+    return make
@@ -0,0 +1,38 @@
+"""Unit tests for the benchmarks, on tiny histories."""
+
+import tempfile
+
+import pytest
+
+from chartreuse.benchmarks.alembic_tree import write_synthetic_tree
+from chartreuse.benchmarks.check_path import run_case
+from chartreuse.utils import AlembicMigrationHelper
+
+
+@pytest.mark.parametrize("shape", ["linear", "branched"])
+def test_synthetic_tree(shape: str) -> None:
+    """Test that synthetic trees have the requested number of revisions and a single head."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        head = write_synthetic_tree(temp_dir, 11, shape)  # type: ignore[arg-type]
+
+        helper = AlembicMigrationHelper(
+            alembic_directory_path=temp_dir, database_url="foo", alembic_section_name="bench", configure=False
+        )
+
+        assert helper._get_script_heads() == {head}
+        assert head == f"{10:012x}"
+
+
+def test_run_case() -> None:
+    """Test that a benchmark case times every operation."""
+    results = run_case(
+        shape="branched", revision_count=10, database_count=2, check_mode="inprocess", upgrade_engine="inprocess"
+    )
+
+    assert [result.operation for result in results] == [
+        "construction",
+        "is_postgres_empty",
+        "check_migration_needed",
+        "upgrade_db",
+    ]
+    assert all(result.database_count == 2 and result.duration >= 0 for result in results)
@@ -1,11 +1,16 @@
 """Unit tests for chartreuse main module."""
 
+import asyncio
 import logging
-from unittest.mock import MagicMock
+import threading
+from collections.abc import Iterator
+from typing import Any
+from unittest.mock import AsyncMock, MagicMock, PropertyMock
 
+import pytest
 from pytest_mock.plugin import MockerFixture
 
-from chartreuse.chartreuse import Chartreuse, configure_logging
+from chartreuse.chartreuse import AsyncChartreuse, Chartreuse, configure_logging
 from chartreuse.config_loader import DatabaseConfig
 
 
@@ -72,6 +77,17 @@ class TestChartreuse:
             allow_migration_for_empty_database=True,
             additional_parameters="--verbose -n test-db",
             alembic_section_name="test-db",
+            alembic_template_section_name=None,
+            check_mode="subprocess",
+            upgrade_engine="subprocess",
+            record_migration_history=True,
+            lock_timeout=None,
+            statement_timeout=None,
+            lock_retry_deadline=0,
+            preload_modules=[],
+            max_replication_lag=None,
+            replication_throttle_timeout=600.0,
+            configure=True,
         )
 
         # Verify kubernetes helper is set
@@ -115,10 +131,10 @@ class TestChartreuse:
             release_name="test-release",
         )
 
-        # Verify KubernetesDeploymentManager was initialized
-        mock_k8s_manager.assert_called_once_with(use_kubeconfig=None, release_name="test-release")
-
+        # Verify KubernetesDeploymentManager is only initialized on first use
+        mock_k8s_manager.assert_not_called()
         assert chartreuse.kubernetes_helper == mock_k8s_instance
+        mock_k8s_manager.assert_called_once_with(use_kubeconfig=None, release_name="test-release")
         assert chartreuse.is_migration_needed is False
 
     def test_check_migration_needed(self, mocker: MockerFixture) -> None:
@@ -340,10 +356,10 @@ class TestChartreuseMultiDatabase:
             release_name="test-release",
         )
 
-        # Verify KubernetesDeploymentManager was initialized
-        mock_k8s_manager.assert_called_once_with(use_kubeconfig=None, release_name="test-release")
-
+        # Verify KubernetesDeploymentManager is only initialized on first use
+        mock_k8s_manager.assert_not_called()
         assert multi_chartreuse.kubernetes_helper == mock_k8s_instance
+        mock_k8s_manager.assert_called_once_with(use_kubeconfig=None, release_name="test-release")
 
     def test_check_migration_needed_with_mixed_needs(self, mocker: MockerFixture) -> None:
         """Test check_migration_needed with some databases needing migration."""
@@ -516,4 +532,668 @@ class TestChartreuseMultiDatabase:
             allow_migration_for_empty_database=True,  # Default value from DatabaseConfig
             additional_parameters="-n test",  # Section name parameter added (no leading space when original is empty)
             alembic_section_name="test",  # New parameter for multi-database support
+            alembic_template_section_name=None,
+            check_mode="subprocess",
+            upgrade_engine="subprocess",
+            record_migration_history=True,
+            lock_timeout=None,
+            statement_timeout=None,
+            lock_retry_deadline=0,
+            preload_modules=[],
+            max_replication_lag=None,
+            replication_throttle_timeout=600.0,
+            configure=True,
+        )
+
+
+def _databases_config(*db_names: str, depends_on: dict[str, list[str]] | None = None) -> dict[str, DatabaseConfig]:
+    depends_on = depends_on or {}
+    return {
+        db_name: DatabaseConfig(
+            dialect="postgresql",
+            user="user",
+            password="pass",
+            host="localhost",
+            port=5432,
+            database=db_name,
+            alembic_directory_path=f"/app/alembic/{db_name}",
+            depends_on=depends_on.get(db_name, []),
+        )
+        for db_name in db_names
+    }
+
+
+class TestChartreuseConcurrency:
+    """Test cases for the concurrent checks of Chartreuse."""
+
+    def test_checks_run_concurrently(self, mocker: MockerFixture) -> None:
+        """Test that databases are checked in parallel, up to max_concurrency."""
+        barrier = threading.Barrier(3, timeout=5)
+
+        def check_once_all_checks_are_running() -> bool:
+            barrier.wait()
+            return False
+
+        helpers = []
+        for _ in range(3):
+            helper = MagicMock()
+            type(helper).is_migration_needed = PropertyMock(side_effect=check_once_all_checks_are_running)
+            helpers.append(helper)
+        mocker.patch("chartreuse.chartreuse.AlembicMigrationHelper", side_effect=helpers)
+        mocker.patch("chartreuse.chartreuse.configure_logging")
+
+        chartreuse = Chartreuse(
+            databases_config=_databases_config("main", "analytics", "audit"),
+            release_name="test-release",
+            kubernetes_helper=MagicMock(),
+            max_concurrency=3,
+        )
+
+        assert chartreuse.is_migration_needed is False
+
+    def test_is_migration_needed_returns_on_first_needed_database(self, mocker: MockerFixture) -> None:
+        """Test that is_migration_needed does not wait for slow databases once one needs migration."""
+        slow_check_may_finish = threading.Event()
+
+        def slow_check() -> bool:
+            slow_check_may_finish.wait(5)
+            return False
+
+        slow_helper = MagicMock()
+        type(slow_helper).is_migration_needed = PropertyMock(side_effect=slow_check)
+        needed_helper = MagicMock()
+        needed_helper.is_migration_needed = True
+        mocker.patch("chartreuse.chartreuse.AlembicMigrationHelper", side_effect=[slow_helper, needed_helper])
+        mocker.patch("chartreuse.chartreuse.configure_logging")
+
+        chartreuse = Chartreuse(
+            databases_config=_databases_config("slow", "needed"),
+            release_name="test-release",
+            kubernetes_helper=MagicMock(),
+            max_concurrency=2,
+        )
+
+        assert chartreuse.is_migration_needed is True
+        assert not slow_check_may_finish.is_set()
+        slow_check_may_finish.set()
+
+    def test_invalid_max_concurrency(self, mocker: MockerFixture) -> None:
+        """Test that max_concurrency must allow at least one worker."""
+        mocker.patch("chartreuse.chartreuse.configure_logging")
+
+        with pytest.raises(ValueError, match="max_concurrency"):
+            Chartreuse(
+                databases_config=_databases_config("main"),
+                release_name="test-release",
+                kubernetes_helper=MagicMock(),
+                max_concurrency=0,
+            )
+
+
+class TestChartreuseUpgradeScheduler:
+    """Test cases for the dependency-aware parallel upgrade of Chartreuse."""
+
+    def _chartreuse(
+        self, mocker: MockerFixture, helpers: dict[str, MagicMock], depends_on: dict[str, list[str]] | None = None
+    ) -> Chartreuse:
+        mocker.patch("chartreuse.chartreuse.AlembicMigrationHelper", side_effect=list(helpers.values()))
+        mocker.patch("chartreuse.chartreuse.configure_logging")
+        return Chartreuse(
+            databases_config=_databases_config(*helpers, depends_on=depends_on),
+            release_name="test-release",
+            kubernetes_helper=MagicMock(),
+            max_concurrency=len(helpers),
+        )
+
+    def test_independent_databases_are_upgraded_in_parallel(self, mocker: MockerFixture) -> None:
+        """Test that databases without dependencies between them are upgraded at the same time."""
+        barrier = threading.Barrier(3, timeout=5)
+        helpers = {db_name: MagicMock(is_migration_needed=True) for db_name in ("main", "analytics", "audit")}
+        for helper in helpers.values():
+            helper.upgrade_db.side_effect = barrier.wait
+
+        self._chartreuse(mocker, helpers).upgrade()
+
+        for helper in helpers.values():
+            helper.upgrade_db.assert_called_once()
+
+    def test_database_is_upgraded_after_its_dependencies(self, mocker: MockerFixture) -> None:
+        """Test that a database is only upgraded once the databases it depends on are."""
+        upgraded: list[str] = []
+        helpers = {db_name: MagicMock(is_migration_needed=True) for db_name in ("reports", "main", "analytics")}
+        for db_name, helper in helpers.items():
+            helper.upgrade_db.side_effect = lambda db_name=db_name: upgraded.append(db_name)
+
+        self._chartreuse(
+            mocker, helpers, depends_on={"reports": ["main", "analytics"], "analytics": ["main"]}
+        ).upgrade()
+
+        assert upgraded == ["main", "analytics", "reports"]
+
+    def test_up_to_date_dependency_does_not_block(self, mocker: MockerFixture) -> None:
+        """Test that a database depending on an up to date database is upgraded."""
+        helpers = {"main": MagicMock(is_migration_needed=False), "analytics": MagicMock(is_migration_needed=True)}
+
+        self._chartreuse(mocker, helpers, depends_on={"analytics": ["main"]}).upgrade()
+
+        helpers["main"].upgrade_db.assert_not_called()
+        helpers["analytics"].upgrade_db.assert_called_once()
+
+    def test_failed_database_skips_its_dependents(self, mocker: MockerFixture) -> None:
+        """Test that dependents of a failed database are not upgraded, while independent databases are."""
+        helpers = {db_name: MagicMock(is_migration_needed=True) for db_name in ("main", "analytics", "audit")}
+        helpers["main"].upgrade_db.side_effect = Exception("Boom")
+
+        chartreuse = self._chartreuse(mocker, helpers, depends_on={"analytics": ["main"]})
+        with pytest.raises(RuntimeError, match="Failed to upgrade database\\(s\\): main, not upgraded: analytics"):
+            chartreuse.upgrade()
+
+        helpers["analytics"].upgrade_db.assert_not_called()
+        helpers["audit"].upgrade_db.assert_called_once()
+
+    def test_upgrade_results(self, mocker: MockerFixture) -> None:
+        """Test that the outcome of every database is reported."""
+        helpers = {
+            "main": MagicMock(is_migration_needed=True),
+            "analytics": MagicMock(is_migration_needed=True),
+            "audit": MagicMock(is_migration_needed=False),
+            "reports": MagicMock(is_migration_needed=True),
+        }
+        helpers["analytics"].upgrade_db.side_effect = Exception("Boom")
+
+        chartreuse = self._chartreuse(mocker, helpers, depends_on={"reports": ["analytics"]})
+        with pytest.raises(RuntimeError):
+            chartreuse.upgrade()
+
+        assert {db_name: result.status for db_name, result in chartreuse.upgrade_results.items()} == {
+            "main": "upgraded",
+            "analytics": "failed",
+            "audit": "up_to_date",
+            "reports": "not_upgraded",
+        }
+        assert chartreuse.upgrade_results["analytics"].error == "Boom"
+        assert chartreuse.upgrade_results["main"].duration >= 0
+
+    def test_unknown_dependency(self, mocker: MockerFixture) -> None:
+        """Test that Chartreuse refuses dependencies on databases it does not manage."""
+        with pytest.raises(ValueError, match="unknown database"):
+            self._chartreuse(mocker, {"main": MagicMock()}, depends_on={"main": ["missing"]})
+
+
+class TestChartreuseDeployments:
+    """Test cases for the scaling of the deployments using the databases to migrate."""
+
+    def _chartreuse(self, mocker: MockerFixture, helpers: dict[str, MagicMock], **deployments: dict) -> Chartreuse:
+        mocker.patch("chartreuse.chartreuse.AlembicMigrationHelper", side_effect=list(helpers.values()))
+        mocker.patch("chartreuse.chartreuse.configure_logging")
+        databases_config = {
+            db_name: db_config.model_copy(update=deployments.get(db_name, {}))
+            for db_name, db_config in _databases_config(*helpers).items()
+        }
+        kubernetes_helper = MagicMock()
+        kubernetes_helper._get_expected_deployment_scale_dict.return_value = {
+            0: {"api": 3, "worker": 2},
+            1: {"analytics-api": 1},
+        }
+        return Chartreuse(
+            databases_config=databases_config, release_name="test-release", kubernetes_helper=kubernetes_helper
+        )
+
+    def test_all_deployments_when_undeclared(self, mocker: MockerFixture) -> None:
+        """Test that all deployments are scaled when a database to migrate does not declare its deployments."""
+        helpers = {"main": MagicMock(is_migration_needed=True), "analytics": MagicMock(is_migration_needed=True)}
+
+        chartreuse = self._chartreuse(mocker, helpers, analytics={"deployments": ["analytics-api"]})
+
+        assert chartreuse.deployments_to_scale is None
+
+    def test_only_deployments_of_databases_to_migrate(self, mocker: MockerFixture) -> None:
+        """Test that only the deployments of databases needing migration are stopped and started."""
+        helpers = {"main": MagicMock(is_migration_needed=False), "analytics": MagicMock(is_migration_needed=True)}
+        chartreuse = self._chartreuse(
+            mocker, helpers, main={"deployments": ["api"]}, analytics={"deployments": ["analytics-api"]}
+        )
+
+        chartreuse.stop_deployments()
+        chartreuse.start_deployments()
+
+        assert chartreuse.deployments_to_scale == {"analytics-api"}
+        chartreuse.kubernetes_helper._stop_deployments.assert_called_once_with({"analytics-api": 1})
+        chartreuse.kubernetes_helper.scale_up_deployment.assert_called_once_with("analytics-api", 1)
+        chartreuse.kubernetes_helper.re_enable_hpa.assert_called_once_with(deployment_name="analytics-api")
+
+    def test_deployment_selector(self, mocker: MockerFixture) -> None:
+        """Test that deployments matching the label selector of a database to migrate are scaled."""
+        helpers = {"main": MagicMock(is_migration_needed=True)}
+        chartreuse = self._chartreuse(mocker, helpers, main={"deployment_selector": "component=api"})
+        deployment = MagicMock()
+        deployment.metadata.name = "api"
+        chartreuse.kubernetes_helper.client_appsv1_api.list_namespaced_deployment.return_value.items = [deployment]
+
+        chartreuse.stop_deployments()
+
+        assert chartreuse.deployments_to_scale == {"api"}
+        chartreuse.kubernetes_helper.client_appsv1_api.list_namespaced_deployment.assert_called_once_with(
+            namespace=chartreuse.kubernetes_helper.namespace, label_selector="component=api"
+        )
+        chartreuse.kubernetes_helper._stop_deployments.assert_called_once_with({"api": 3})
+
+
+def test_close_disposes_engines(mocker: MockerFixture) -> None:
+    """Test that closing Chartreuse closes the database connections."""
+    mocker.patch("chartreuse.chartreuse.AlembicMigrationHelper")
+    mocker.patch("chartreuse.chartreuse.configure_logging")
+    mocked_dispose_engines = mocker.patch("chartreuse.chartreuse.dispose_engines")
+
+    chartreuse = Chartreuse(
+        databases_config=_databases_config("main"), release_name="test-release", kubernetes_helper=MagicMock()
+    )
+    chartreuse.close()
+
+    mocked_dispose_engines.assert_called_once()
+
+
+class TestAsyncChartreuse:
+    """Test cases for the asyncio orchestrator behind Chartreuse."""
+
+    def _orchestrator(self, mocker: MockerFixture, helpers: dict[str, MagicMock]) -> AsyncChartreuse:
+        mocker.patch("chartreuse.chartreuse.AlembicMigrationHelper", side_effect=list(helpers.values()))
+        mocker.patch("chartreuse.chartreuse.configure_logging")
+        return AsyncChartreuse(
+            databases_config=_databases_config(*helpers), release_name="test-release", kubernetes_helper=MagicMock()
+        )
+
+    def test_subprocess_upgrades_run_in_the_event_loop(self, mocker: MockerFixture) -> None:
+        """Test that subprocess upgrades are awaited concurrently, not run in threads."""
+        helpers = {
+            db_name: MagicMock(is_migration_needed=True, upgrade_engine="subprocess") for db_name in ("main", "audit")
+        }
+        barrier = asyncio.Barrier(2)
+        for helper in helpers.values():
+            helper.async_upgrade_db = AsyncMock(side_effect=barrier.wait)
+        orchestrator = self._orchestrator(mocker, helpers)
+
+        asyncio.run(asyncio.wait_for(orchestrator.upgrade(), timeout=5))
+
+        for helper in helpers.values():
+            helper.async_upgrade_db.assert_awaited_once()
+            helper.upgrade_db.assert_not_called()
+        assert {result.status for result in orchestrator.upgrade_results.values()} == {"upgraded"}
+
+    def test_kubernetes_and_database_waits_overlap(self, mocker: MockerFixture) -> None:
+        """Test that a Kubernetes operation can run while the databases are being checked."""
+        scaled_down = threading.Event()
+        helper = MagicMock()
+        type(helper).is_migration_needed = PropertyMock(side_effect=lambda: scaled_down.wait(5))
+        orchestrator = self._orchestrator(mocker, {"main": helper})
+
+        async def run() -> list[object]:
+            return await asyncio.gather(orchestrator.is_migration_needed(), asyncio.to_thread(scaled_down.set))
+
+        try:
+            assert asyncio.run(asyncio.wait_for(run(), timeout=5))[0] is True
+        finally:
+            orchestrator.close()
+
+
+class TestPrepareAndStopPods:
+    """Test cases for the scale-down overlapping the checks and the preparation of the upgrades."""
+
+    def _chartreuse(self, mocker: MockerFixture, helpers: dict[str, MagicMock], **deployments: dict) -> Chartreuse:
+        mocker.patch("chartreuse.chartreuse.AlembicMigrationHelper", side_effect=list(helpers.values()))
+        mocker.patch("chartreuse.chartreuse.configure_logging")
+        databases_config = {
+            db_name: db_config.model_copy(update=deployments.get(db_name, {}))
+            for db_name, db_config in _databases_config(*helpers).items()
+        }
+        return Chartreuse(databases_config=databases_config, release_name="test-release", kubernetes_helper=MagicMock())
+
+    def test_scale_down_starts_before_other_checks_end(self, mocker: MockerFixture) -> None:
+        """Test that the scale-down starts as soon as one database needs migration."""
+        scaling_down = threading.Event()
+        slow_helper = MagicMock()
+        type(slow_helper).is_migration_needed = PropertyMock(side_effect=lambda: not scaling_down.wait(5))
+        helpers = {"main": MagicMock(is_migration_needed=True), "slow": slow_helper}
+        chartreuse = self._chartreuse(mocker, helpers)
+        chartreuse.kubernetes_helper.stop_pods.side_effect = scaling_down.set
+
+        try:
+            assert chartreuse.prepare_and_stop_pods()
+        finally:
+            chartreuse.close()
+
+        chartreuse.kubernetes_helper.stop_pods.assert_called_once()
+        helpers["main"].prepare_upgrade.assert_called_once()
+        slow_helper.prepare_upgrade.assert_not_called()
+
+    def test_no_migration_needed(self, mocker: MockerFixture) -> None:
+        """Test that nothing is scaled down when no database needs migration."""
+        helpers = {"main": MagicMock(is_migration_needed=False)}
+        chartreuse = self._chartreuse(mocker, helpers)
+
+        assert not chartreuse.prepare_and_stop_pods()
+
+        chartreuse.kubernetes_helper.stop_pods.assert_not_called()
+        chartreuse.kubernetes_helper._stop_deployments.assert_not_called()
+
+    def test_failed_check_after_scale_down(self, mocker: MockerFixture) -> None:
+        """Test that the deployments are started again when a check fails after the scale-down started."""
+        scaled_down = threading.Event()
+
+        def fail_once_scaled_down() -> bool:
+            scaled_down.wait(5)
+            raise RuntimeError("Connection refused")
+
+        failing_helper = MagicMock()
+        type(failing_helper).is_migration_needed = PropertyMock(side_effect=fail_once_scaled_down)
+        helpers = {"main": MagicMock(is_migration_needed=True), "failing": failing_helper}
+        chartreuse = self._chartreuse(mocker, helpers)
+        chartreuse.kubernetes_helper.stop_pods.side_effect = scaled_down.set
+
+        try:
+            with pytest.raises(RuntimeError, match="Connection refused"):
+                chartreuse.prepare_and_stop_pods()
+        finally:
+            chartreuse.close()
+
+        chartreuse.kubernetes_helper.stop_pods.assert_called_once()
+        chartreuse.kubernetes_helper.start_pods.assert_called_once()
+
+    def test_declared_deployments_wait_for_every_check(self, mocker: MockerFixture) -> None:
+        """Test that the deployments declared by the databases to migrate are only stopped once all are checked."""
+        helpers = {"main": MagicMock(is_migration_needed=True), "analytics": MagicMock(is_migration_needed=True)}
+        chartreuse = self._chartreuse(
+            mocker, helpers, main={"deployments": ["api"]}, analytics={"deployments": ["analytics-api"]}
+        )
+        chartreuse.kubernetes_helper._get_expected_deployment_scale_dict.return_value = {
+            0: {"api": 3, "worker": 2},
+            1: {"analytics-api": 1},
+        }
+
+        assert chartreuse.prepare_and_stop_pods()
+
+        chartreuse.kubernetes_helper.stop_pods.assert_not_called()
+        assert chartreuse.kubernetes_helper._stop_deployments.call_args_list == [
+            mocker.call({"analytics-api": 1}),
+            mocker.call({"api": 3}),
+        ]
+
+
+class TestShardedChartreuse:
+    """Test cases for the coordinator and the other shards of a sharded run."""
+
+    def _chartreuse(self, mocker: MockerFixture, helpers: dict[str, MagicMock], **kwargs: Any) -> Chartreuse:
+        mocker.patch("chartreuse.chartreuse.AlembicMigrationHelper", side_effect=list(helpers.values()))
+        mocker.patch("chartreuse.chartreuse.configure_logging")
+        return Chartreuse(
+            databases_config=_databases_config(*helpers),
+            release_name="test-release",
+            kubernetes_helper=MagicMock(),
+            **kwargs,
+        )
+
+    def test_coordinator_only_upgrades_its_shard(self, mocker: MockerFixture) -> None:
+        """Test that every database is checked but only the upgraded databases are upgraded."""
+        helpers = {db_name: MagicMock(is_migration_needed=True, upgrade_engine="inprocess") for db_name in ("a", "b")}
+        chartreuse = self._chartreuse(mocker, helpers, upgraded_databases=["a"])
+
+        try:
+            assert chartreuse.is_migration_needed
+            chartreuse.upgrade()
+        finally:
+            chartreuse.close()
+
+        helpers["a"].upgrade_db.assert_called_once()
+        helpers["b"].upgrade_db.assert_not_called()
+        assert list(chartreuse.upgrade_results) == ["a"]
+
+    def test_waits_for_dependency_of_other_shard(self, mocker: MockerFixture) -> None:
+        """Test that a database is upgraded once its dependency was upgraded by another shard, which is not reported."""
+        mocker.patch("chartreuse.chartreuse.DEPENDENCY_POLL_INTERVAL", 0)
+        helpers = {
+            "main": MagicMock(is_migration_needed=True, upgrade_engine="inprocess"),
+            "acme": MagicMock(is_migration_needed=True, upgrade_engine="inprocess"),
+        }
+        helpers["main"].recheck_migration_needed.side_effect = [True, True, False]
+        helpers["acme"].upgrade_db.side_effect = lambda: helpers["main"].recheck_migration_needed.assert_called()
+        mocker.patch("chartreuse.chartreuse.AlembicMigrationHelper", side_effect=list(helpers.values()))
+        mocker.patch("chartreuse.chartreuse.configure_logging")
+        chartreuse = Chartreuse(
+            databases_config=_databases_config("main", "acme", depends_on={"acme": ["main"]}),
+            release_name="test-release",
+            kubernetes_helper=MagicMock(),
+            upgraded_databases=["acme"],
         )
+
+        try:
+            chartreuse.upgrade()
+        finally:
+            chartreuse.close()
+
+        assert helpers["main"].recheck_migration_needed.call_count == 3
+        helpers["main"].upgrade_db.assert_not_called()
+        helpers["acme"].upgrade_db.assert_called_once()
+        assert list(chartreuse.upgrade_results) == ["acme"]
+
+    def test_dependency_of_other_shard_timeout(self, mocker: MockerFixture) -> None:
+        """Test that a database is not upgraded when its dependency is still not upgraded by its shard in time."""
+        helpers = {
+            "main": MagicMock(is_migration_needed=True, upgrade_engine="inprocess"),
+            "acme": MagicMock(is_migration_needed=True, upgrade_engine="inprocess"),
+        }
+        helpers["main"].recheck_migration_needed.return_value = True
+        mocker.patch("chartreuse.chartreuse.AlembicMigrationHelper", side_effect=list(helpers.values()))
+        mocker.patch("chartreuse.chartreuse.configure_logging")
+        chartreuse = Chartreuse(
+            databases_config=_databases_config("main", "acme", depends_on={"acme": ["main"]}),
+            release_name="test-release",
+            kubernetes_helper=MagicMock(),
+            upgraded_databases=["acme"],
+            dependency_wait_timeout=0,
+        )
+
+        try:
+            with pytest.raises(RuntimeError, match="not upgraded: acme"):
+                chartreuse.upgrade()
+        finally:
+            chartreuse.close()
+
+        helpers["acme"].upgrade_db.assert_not_called()
+        assert chartreuse.upgrade_results["acme"].status == "not_upgraded"
+
+    def test_wait_for_stopped_pods(self, mocker: MockerFixture) -> None:
+        """Test that a shard waits until every deployment of the release is stopped."""
+        mocker.patch("chartreuse.chartreuse.STOPPED_PODS_POLL_INTERVAL", 0)
+        chartreuse = self._chartreuse(mocker, {"main": MagicMock(is_migration_needed=True)})
+        chartreuse.kubernetes_helper._get_expected_deployment_scale_dict.return_value = {0: {"api": 3, "worker": 2}}
+        chartreuse.kubernetes_helper.is_deployment_stopped.side_effect = [False, True, True]
+
+        chartreuse.wait_for_stopped_pods(timeout=5)
+
+        assert chartreuse.kubernetes_helper.is_deployment_stopped.call_args_list == [
+            mocker.call("api"),
+            mocker.call("api"),
+            mocker.call("worker"),
+        ]
+
+    def test_wait_for_stopped_pods_timeout(self, mocker: MockerFixture) -> None:
+        """Test that a shard gives up when the deployments are still running at the timeout."""
+        chartreuse = self._chartreuse(mocker, {"main": MagicMock(is_migration_needed=True)})
+        chartreuse.kubernetes_helper._get_expected_deployment_scale_dict.return_value = {0: {"api": 3}}
+        chartreuse.kubernetes_helper.is_deployment_stopped.return_value = False
+
+        with pytest.raises(TimeoutError, match="api"):
+            chartreuse.wait_for_stopped_pods(timeout=0)
+
+    def test_upgrade_database(self, mocker: MockerFixture) -> None:
+        """Test that a database claimed from a work queue is checked and upgraded alone, recording its result."""
+        helpers = {db_name: MagicMock(is_migration_needed=True, upgrade_engine="inprocess") for db_name in ("a", "b")}
+        helpers["b"].upgrade_db.side_effect = RuntimeError("boom")
+        chartreuse = self._chartreuse(mocker, helpers)
+
+        try:
+            assert chartreuse.is_database_migration_needed("a")
+            chartreuse.upgrade_database("a")
+            with pytest.raises(RuntimeError, match="boom"):
+                chartreuse.upgrade_database("b")
+        finally:
+            chartreuse.close()
+
+        assert {db_name: result.status for db_name, result in chartreuse.upgrade_results.items()} == {
+            "a": "upgraded",
+            "b": "failed",
+        }
+
+    def test_wait_for_stopped_pods_of_databases(self, mocker: MockerFixture) -> None:
+        """Test that a worker only waits for the deployments using the given databases."""
+        helpers = {"main": MagicMock(is_migration_needed=True), "analytics": MagicMock(is_migration_needed=True)}
+        mocker.patch("chartreuse.chartreuse.AlembicMigrationHelper", side_effect=list(helpers.values()))
+        mocker.patch("chartreuse.chartreuse.configure_logging")
+        databases_config = _databases_config(*helpers)
+        databases_config["analytics"] = databases_config["analytics"].model_copy(
+            update={"deployments": ["analytics-api"]}
+        )
+        chartreuse = Chartreuse(
+            databases_config=databases_config, release_name="test-release", kubernetes_helper=MagicMock()
+        )
+
+        chartreuse.wait_for_stopped_pods(timeout=5, db_names=["analytics"])
+
+        chartreuse.kubernetes_helper.is_deployment_stopped.assert_called_once_with("analytics-api")
+        helpers["main"].wait_until_ready.assert_not_called()
+
+
+class TestFleetChartreuse:
+    """Test cases for the fleet databases, gone over by batches as they are discovered."""
+
+    def _chartreuse(
+        self, mocker: MockerFixture, helpers: dict[str, MagicMock], fleet_size: int, **kwargs: Any
+    ) -> tuple[Chartreuse, list[str]]:
+        """A Chartreuse of the main database and a fleet of tenants depending on it, with the tenants discovered."""
+        mocker.patch("chartreuse.chartreuse.FLEET_BATCH_SIZE", 2)
+        mocker.patch(
+            "chartreuse.chartreuse.AlembicMigrationHelper",
+            side_effect=lambda **kwargs: helpers[kwargs["alembic_section_name"]],
+        )
+        mocker.patch("chartreuse.chartreuse.configure_logging")
+        fleet_config = _databases_config(
+            *(f"tenant_{index}" for index in range(fleet_size)),
+            depends_on={f"tenant_{index}": ["main"] for index in range(fleet_size)},
+        )
+        discovered: list[str] = []
+
+        def iter_fleet_databases() -> Iterator[tuple[str, DatabaseConfig]]:
+            for db_name, db_config in fleet_config.items():
+                discovered.append(db_name)
+                yield db_name, db_config
+
+        chartreuse = Chartreuse(
+            databases_config=_databases_config("main"),
+            release_name="test-release",
+            kubernetes_helper=MagicMock(),
+            fleet_databases=iter_fleet_databases,
+            **kwargs,
+        )
+        return chartreuse, discovered
+
+    def test_fleet_is_upgraded_by_batches(self, mocker: MockerFixture) -> None:
+        """
+        Test that the fleet databases are upgraded by batches after the databases they depend on, the helpers of a
+        batch being created as they are checked and their connections closed before the next batch.
+        """
+        dispose_engines = mocker.patch("chartreuse.chartreuse.dispose_engines")
+        helpers = {
+            db_name: MagicMock(is_migration_needed=True, upgrade_engine="inprocess", database_url=db_name)
+            for db_name in ("main", "tenant_0", "tenant_1", "tenant_2")
+        }
+        chartreuse, _ = self._chartreuse(mocker, helpers, fleet_size=3)
+        upgraded: list[str] = []
+        for db_name, helper in helpers.items():
+            helper.upgrade_db.side_effect = lambda db_name=db_name: upgraded.append(db_name)
+
+        def upgrade_last_tenant() -> None:
+            # The second batch is only upgraded once the connections of the first one are closed
+            dispose_engines.assert_called_once()
+            upgraded.append("tenant_2")
+
+        helpers["tenant_2"].upgrade_db.side_effect = upgrade_last_tenant
+
+        try:
+            chartreuse.upgrade()
+        finally:
+            chartreuse.close()
+
+        assert upgraded[0] == "main"
+        assert sorted(upgraded) == ["main", "tenant_0", "tenant_1", "tenant_2"]
+        assert [list(call.args[0]) for call in dispose_engines.call_args_list[:2]] == [
+            ["tenant_0", "tenant_1"],
+            ["tenant_2"],
+        ]
+        assert chartreuse.migration_helpers == {"main": helpers["main"]}
+        assert {result.status for result in chartreuse.upgrade_results.values()} == {"upgraded"}
+
+    def test_failed_dependency_skips_fleet(self, mocker: MockerFixture) -> None:
+        """Test that the fleet databases are not upgraded when the database they depend on failed."""
+        helpers = {
+            db_name: MagicMock(is_migration_needed=True, upgrade_engine="inprocess")
+            for db_name in ("main", "tenant_0", "tenant_1", "tenant_2")
+        }
+        helpers["main"].upgrade_db.side_effect = RuntimeError("boom")
+        chartreuse, _ = self._chartreuse(mocker, helpers, fleet_size=3)
+
+        try:
+            with pytest.raises(RuntimeError, match="Failed to upgrade database\\(s\\): main, not upgraded: tenant_0"):
+                chartreuse.upgrade()
+        finally:
+            chartreuse.close()
+
+        assert [result.status for result in chartreuse.upgrade_results.values()] == ["failed"] + 3 * ["not_upgraded"]
+
+    def test_is_migration_needed_stops_at_first_batch_needing_migration(self, mocker: MockerFixture) -> None:
+        """Test that the fleet is only discovered up to the batch of the first database needing migration."""
+        helpers = {
+            db_name: MagicMock(is_migration_needed=db_name == "tenant_1")
+            for db_name in ("main", "tenant_0", "tenant_1", "tenant_2")
+        }
+        chartreuse, discovered = self._chartreuse(mocker, helpers, fleet_size=3)
+
+        try:
+            assert chartreuse.is_migration_needed
+        finally:
+            chartreuse.close()
+
+        assert discovered == ["tenant_0", "tenant_1"]
+
+    def test_shard_only_checks_its_databases(self, mocker: MockerFixture) -> None:
+        """
+        Test that a shard other than the coordinator only checks its databases, and the databases of other shards
+        they depend on once it upgrades them.
+        """
+        mocker.patch("chartreuse.chartreuse.DEPENDENCY_POLL_INTERVAL", 0)
+        helpers = {
+            db_name: MagicMock(is_migration_needed=True, upgrade_engine="inprocess")
+            for db_name in ("main", "tenant_0", "tenant_1")
+        }
+        helpers["main"].recheck_migration_needed.side_effect = [True, False]
+        chartreuse, _ = self._chartreuse(
+            mocker,
+            helpers,
+            fleet_size=2,
+            checked_databases=["tenant_1"],
+            upgraded_databases=["tenant_1"],
+            readiness_timeout=60,
+        )
+
+        try:
+            assert chartreuse.is_migration_needed
+            helpers["main"].wait_until_ready.assert_not_called()
+            chartreuse.upgrade()
+        finally:
+            chartreuse.close()
+
+        helpers["tenant_0"].wait_until_ready.assert_not_called()
+        helpers["main"].wait_until_ready.assert_called_once()
+        assert helpers["main"].recheck_migration_needed.call_count == 2
+        helpers["main"].upgrade_db.assert_not_called()
+        helpers["tenant_1"].upgrade_db.assert_called_once()
+        assert list(chartreuse.upgrade_results) == ["tenant_1"]
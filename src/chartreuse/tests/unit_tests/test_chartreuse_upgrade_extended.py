@@ -1,11 +1,17 @@
 """Extended unit tests for chartreuse_upgrade module."""
 
+import json
 import os
+import tempfile
+from unittest.mock import MagicMock
 
 import pytest
 from pytest_mock.plugin import MockerFixture
 
 from chartreuse.chartreuse_upgrade import ensure_safe_run, main
+from chartreuse.sharding import get_shard_index
+
+from .test_chartreuse import _databases_config
 
 
 class TestEnsureSafeRun:
@@ -93,14 +99,15 @@ class TestMainMultiDatabase:
             }
         ]
         mock_load_config = mocker.patch(
-            "chartreuse.chartreuse_upgrade.load_multi_database_config",
-            return_value=mock_config,
+            "chartreuse.chartreuse_upgrade.read_multi_database_config",
+            return_value=MagicMock(databases=mock_config, fleet=None),
         )
 
         # Mock Chartreuse
         mock_multi_chartreuse = mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse")
         mock_chartreuse_instance = mocker.MagicMock()
         mock_chartreuse_instance.is_migration_needed = True
+        mock_chartreuse_instance.deployments_to_scale = None
         mock_multi_chartreuse.return_value = mock_chartreuse_instance
 
         # Mock KubernetesDeploymentManager
@@ -126,6 +133,7 @@ class TestMainMultiDatabase:
         mock_load_config.assert_called_once_with("/app/config.yaml")
         mock_multi_chartreuse.assert_called_once()
         mock_chartreuse_instance.upgrade.assert_called_once()
+        mock_chartreuse_instance.close.assert_called_once()
         mock_k8s_instance.stop_pods.assert_called_once()
         mock_k8s_instance.start_pods.assert_called_once()
 
@@ -146,13 +154,14 @@ class TestMainMultiDatabase:
             }
         ]
         mocker.patch(
-            "chartreuse.chartreuse_upgrade.load_multi_database_config",
-            return_value=mock_config,
+            "chartreuse.chartreuse_upgrade.read_multi_database_config",
+            return_value=MagicMock(databases=mock_config, fleet=None),
         )
 
         mock_multi_chartreuse = mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse")
         mock_chartreuse_instance = mocker.MagicMock()
         mock_chartreuse_instance.is_migration_needed = False
+        mock_chartreuse_instance.deployments_to_scale = None
         mock_multi_chartreuse.return_value = mock_chartreuse_instance
 
         mock_k8s_manager = mocker.patch("chartreuse.chartreuse_upgrade.KubernetesDeploymentManager")
@@ -174,6 +183,7 @@ class TestMainMultiDatabase:
 
         # Verify no pods were stopped/started and no upgrade occurred
         mock_chartreuse_instance.upgrade.assert_not_called()
+        mock_chartreuse_instance.close.assert_called_once()
         mock_k8s_instance.stop_pods.assert_not_called()
         mock_k8s_instance.start_pods.assert_not_called()
 
@@ -182,7 +192,7 @@ class TestMainMultiDatabase:
         mocker.patch("chartreuse.chartreuse_upgrade.ensure_safe_run")
 
         mocker.patch(
-            "chartreuse.chartreuse_upgrade.load_multi_database_config",
+            "chartreuse.chartreuse_upgrade.read_multi_database_config",
             side_effect=FileNotFoundError("Config file not found"),
         )
 
@@ -214,13 +224,14 @@ class TestMainMultiDatabase:
             }
         ]
         mocker.patch(
-            "chartreuse.chartreuse_upgrade.load_multi_database_config",
-            return_value=mock_config,
+            "chartreuse.chartreuse_upgrade.read_multi_database_config",
+            return_value=MagicMock(databases=mock_config, fleet=None),
         )
 
         mock_multi_chartreuse = mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse")
         mock_chartreuse_instance = mocker.MagicMock()
         mock_chartreuse_instance.is_migration_needed = True
+        mock_chartreuse_instance.deployments_to_scale = None
         mock_multi_chartreuse.return_value = mock_chartreuse_instance
 
         mock_k8s_manager = mocker.patch("chartreuse.chartreuse_upgrade.KubernetesDeploymentManager")
@@ -262,13 +273,14 @@ class TestMainMultiDatabase:
             }
         ]
         mocker.patch(
-            "chartreuse.chartreuse_upgrade.load_multi_database_config",
-            return_value=mock_config,
+            "chartreuse.chartreuse_upgrade.read_multi_database_config",
+            return_value=MagicMock(databases=mock_config, fleet=None),
         )
 
         mock_multi_chartreuse = mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse")
         mock_chartreuse_instance = mocker.MagicMock()
         mock_chartreuse_instance.is_migration_needed = True
+        mock_chartreuse_instance.deployments_to_scale = None
         mock_multi_chartreuse.return_value = mock_chartreuse_instance
 
         mock_k8s_manager = mocker.patch("chartreuse.chartreuse_upgrade.KubernetesDeploymentManager")
@@ -293,6 +305,71 @@ class TestMainMultiDatabase:
         mock_k8s_instance.stop_pods.assert_called_once()
         mock_k8s_instance.start_pods.assert_not_called()
 
+    def test_main_multi_database_declared_deployments(self, mocker: MockerFixture) -> None:
+        """Test main function only scales the deployments of the databases to migrate when they declare them."""
+        mocker.patch("chartreuse.chartreuse_upgrade.ensure_safe_run")
+        mocker.patch("os.path.exists", return_value=True)
+        mocker.patch("os.path.isfile", return_value=True)
+        mocker.patch(
+            "chartreuse.chartreuse_upgrade.read_multi_database_config", return_value=MagicMock(databases={}, fleet=None)
+        )
+
+        mock_multi_chartreuse = mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse")
+        mock_chartreuse_instance = mocker.MagicMock()
+        mock_chartreuse_instance.is_migration_needed = True
+        mock_chartreuse_instance.deployments_to_scale = {"analytics-api"}
+        mock_multi_chartreuse.return_value = mock_chartreuse_instance
+
+        mock_k8s_manager = mocker.patch("chartreuse.chartreuse_upgrade.KubernetesDeploymentManager")
+        mock_k8s_instance = mocker.MagicMock()
+        mock_k8s_manager.return_value = mock_k8s_instance
+
+        mocker.patch.dict(
+            os.environ,
+            {
+                "CHARTREUSE_MULTI_CONFIG_PATH": "/app/config.yaml",
+                "CHARTREUSE_ENABLE_STOP_PODS": "true",
+                "CHARTREUSE_RELEASE_NAME": "test-release",
+                "CHARTREUSE_UPGRADE_BEFORE_DEPLOYMENT": "false",
+                "HELM_IS_INSTALL": "false",
+            },
+        )
+
+        main()
+
+        mock_chartreuse_instance.stop_deployments.assert_called_once()
+        mock_chartreuse_instance.start_deployments.assert_called_once()
+        mock_k8s_instance.stop_pods.assert_not_called()
+        mock_k8s_instance.start_pods.assert_not_called()
+
+    def test_main_multi_database_phase_report(self, mocker: MockerFixture) -> None:
+        """Test main function writes the phase timings to CHARTREUSE_REPORT_DIRECTORY."""
+        mocker.patch("chartreuse.chartreuse_upgrade.ensure_safe_run")
+        mocker.patch("os.path.isfile", return_value=True)
+        mocker.patch(
+            "chartreuse.chartreuse_upgrade.read_multi_database_config", return_value=MagicMock(databases={}, fleet=None)
+        )
+        mock_multi_chartreuse = mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse")
+        mock_multi_chartreuse.return_value.is_migration_needed = False
+        mocker.patch("chartreuse.chartreuse_upgrade.KubernetesDeploymentManager")
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            mocker.patch.dict(
+                os.environ,
+                {
+                    "CHARTREUSE_MULTI_CONFIG_PATH": temp_dir,
+                    "CHARTREUSE_RELEASE_NAME": "test-release",
+                    "CHARTREUSE_REPORT_DIRECTORY": temp_dir,
+                },
+            )
+
+            main()
+
+            with open(os.path.join(temp_dir, "chartreuse-report.json")) as f:
+                phases = {phase["phase"] for phase in json.load(f)["phases"]}
+            assert {"load_config", "check", "total"} <= phases
+            assert os.path.isfile(os.path.join(temp_dir, "chartreuse.prom"))
+
     def test_main_multi_database_start_pods_failure(self, mocker: MockerFixture) -> None:
         """Test main function when start_pods fails."""
         mocker.patch("chartreuse.chartreuse_upgrade.ensure_safe_run")
@@ -310,13 +387,14 @@ class TestMainMultiDatabase:
             }
         ]
         mocker.patch(
-            "chartreuse.chartreuse_upgrade.load_multi_database_config",
-            return_value=mock_config,
+            "chartreuse.chartreuse_upgrade.read_multi_database_config",
+            return_value=MagicMock(databases=mock_config, fleet=None),
         )
 
         mock_multi_chartreuse = mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse")
         mock_chartreuse_instance = mocker.MagicMock()
         mock_chartreuse_instance.is_migration_needed = True
+        mock_chartreuse_instance.deployments_to_scale = None
         mock_multi_chartreuse.return_value = mock_chartreuse_instance
 
         mock_k8s_manager = mocker.patch("chartreuse.chartreuse_upgrade.KubernetesDeploymentManager")
@@ -369,13 +447,14 @@ class TestMainSingleDatabase:
             }
         ]
         mocker.patch(
-            "chartreuse.chartreuse_upgrade.load_multi_database_config",
-            return_value=mock_config,
+            "chartreuse.chartreuse_upgrade.read_multi_database_config",
+            return_value=MagicMock(databases=mock_config, fleet=None),
         )
 
         mock_chartreuse = mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse")
         mock_chartreuse_instance = mocker.MagicMock()
         mock_chartreuse_instance.is_migration_needed = True
+        mock_chartreuse_instance.deployments_to_scale = None
         mock_chartreuse.return_value = mock_chartreuse_instance
 
         mock_k8s_manager = mocker.patch("chartreuse.chartreuse_upgrade.KubernetesDeploymentManager")
@@ -401,7 +480,13 @@ class TestMainSingleDatabase:
         mock_chartreuse.assert_called_once_with(
             databases_config=mock_config,
             release_name="test-release",
-            kubernetes_helper=mock_k8s_instance,
+            max_concurrency=4,
+            readiness_timeout=60.0,
+            patroni_postgresql=False,
+            upgraded_databases=None,
+            dependency_wait_timeout=3600.0,
+            fleet_databases=None,
+            checked_databases=None,
         )
 
         # Verify upgrade flow
@@ -429,13 +514,14 @@ class TestMainSingleDatabase:
             }
         ]
         mocker.patch(
-            "chartreuse.chartreuse_upgrade.load_multi_database_config",
-            return_value=mock_config,
+            "chartreuse.chartreuse_upgrade.read_multi_database_config",
+            return_value=MagicMock(databases=mock_config, fleet=None),
         )
 
         mock_chartreuse = mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse")
         mock_chartreuse_instance = mocker.MagicMock()
         mock_chartreuse_instance.is_migration_needed = False
+        mock_chartreuse_instance.deployments_to_scale = None
         mock_chartreuse.return_value = mock_chartreuse_instance
 
         mock_k8s_manager = mocker.patch("chartreuse.chartreuse_upgrade.KubernetesDeploymentManager")
@@ -461,9 +547,195 @@ class TestMainSingleDatabase:
         mock_chartreuse.assert_called_once_with(
             databases_config=mock_config,
             release_name="test-release",
-            kubernetes_helper=mock_k8s_instance,
+            max_concurrency=4,
+            readiness_timeout=60.0,
+            patroni_postgresql=False,
+            upgraded_databases=None,
+            dependency_wait_timeout=3600.0,
+            fleet_databases=None,
+            checked_databases=None,
         )
 
+    def test_main_overlap_stop_pods(self, mocker: MockerFixture) -> None:
+        """Test that the scale-down overlaps the checks when CHARTREUSE_OVERLAP_STOP_PODS is set."""
+        mocker.patch("chartreuse.chartreuse_upgrade.ensure_safe_run")
+        mocker.patch("os.path.exists", return_value=True)
+        mocker.patch("os.path.isfile", return_value=True)
+        mocker.patch(
+            "chartreuse.chartreuse_upgrade.read_multi_database_config", return_value=MagicMock(databases={}, fleet=None)
+        )
+        mock_chartreuse = mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse")
+        mock_chartreuse_instance = mock_chartreuse.return_value
+        mock_chartreuse_instance.prepare_and_stop_pods.return_value = True
+        mock_chartreuse_instance.deployments_to_scale = None
+        mock_k8s_instance = mocker.patch("chartreuse.chartreuse_upgrade.KubernetesDeploymentManager").return_value
+        mocker.patch.dict(
+            os.environ,
+            {
+                "CHARTREUSE_MULTI_CONFIG_PATH": "/app/config.yaml",
+                "CHARTREUSE_RELEASE_NAME": "test-release",
+                "CHARTREUSE_OVERLAP_STOP_PODS": "true",
+            },
+            clear=True,
+        )
+
+        main()
+
+        mock_chartreuse_instance.prepare_and_stop_pods.assert_called_once()
+        mock_k8s_instance.stop_pods.assert_not_called()
+        mock_chartreuse_instance.upgrade.assert_called_once()
+        mock_k8s_instance.start_pods.assert_called_once()
+
+    def test_main_overlap_stop_pods_starts_all_pods(self, mocker: MockerFixture) -> None:
+        """
+        Test that all the deployments are started again after an upgrade that stopped them while checking, without
+        checking the databases again once Chartreuse is closed.
+        """
+        mocker.patch("chartreuse.chartreuse_upgrade.ensure_safe_run")
+        mocker.patch("os.path.exists", return_value=True)
+        mocker.patch("os.path.isfile", return_value=True)
+        mocker.patch(
+            "chartreuse.chartreuse_upgrade.read_multi_database_config",
+            return_value=MagicMock(databases=_databases_config("main", "audit"), fleet=None),
+        )
+        mocker.patch(
+            "chartreuse.chartreuse.AlembicMigrationHelper",
+            side_effect=[MagicMock(is_migration_needed=True), MagicMock(is_migration_needed=False)],
+        )
+        mocker.patch("chartreuse.chartreuse.configure_logging")
+        mock_k8s_instance = mocker.patch("chartreuse.chartreuse_upgrade.KubernetesDeploymentManager").return_value
+        mocker.patch.dict(
+            os.environ,
+            {
+                "CHARTREUSE_MULTI_CONFIG_PATH": "/app/config.yaml",
+                "CHARTREUSE_RELEASE_NAME": "test-release",
+                "CHARTREUSE_OVERLAP_STOP_PODS": "true",
+            },
+            clear=True,
+        )
+
+        main()
+
+        mock_k8s_instance.stop_pods.assert_called_once()
+        mock_k8s_instance.start_pods.assert_called_once()
+
+    def _mock_sharded_run(self, mocker: MockerFixture, job_completion_index: str) -> tuple[MagicMock, MagicMock]:
+        mocker.patch("chartreuse.chartreuse_upgrade.ensure_safe_run")
+        mocker.patch("os.path.exists", return_value=True)
+        mocker.patch("os.path.isfile", return_value=True)
+        config = MagicMock(databases={"main": MagicMock()})
+        config.iter_fleet_databases.side_effect = lambda: iter([(f"tenant_{index}", MagicMock()) for index in range(4)])
+        mocker.patch("chartreuse.chartreuse_upgrade.read_multi_database_config", return_value=config)
+        mock_chartreuse = mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse")
+        mock_chartreuse.return_value.is_migration_needed = True
+        mock_chartreuse.return_value.deployments_to_scale = None
+        mocker.patch("chartreuse.chartreuse_upgrade.KubernetesDeploymentManager")
+        mocker.patch.dict(
+            os.environ,
+            {
+                "CHARTREUSE_MULTI_CONFIG_PATH": "/app/config.yaml",
+                "CHARTREUSE_RELEASE_NAME": "test-release",
+                "CHARTREUSE_SHARD_COUNT": "2",
+                "CHARTREUSE_JOB_NAME": "test-release-chartreuse",
+                "JOB_COMPLETION_INDEX": job_completion_index,
+            },
+            clear=True,
+        )
+        return mock_chartreuse, mocker.patch("chartreuse.chartreuse_upgrade.wait_for_shards")
+
+    def test_main_shard_waits_for_stopped_pods(self, mocker: MockerFixture) -> None:
+        """Test that a shard other than the coordinator upgrades its databases once the coordinator stopped pods."""
+        mock_chartreuse, mock_wait_for_shards = self._mock_sharded_run(mocker, job_completion_index="1")
+        mock_chartreuse_instance = mock_chartreuse.return_value
+
+        main()
+
+        kwargs = mock_chartreuse.call_args.kwargs
+        assert list(kwargs["databases_config"]) == ["main"]
+        assert kwargs["checked_databases"].index == kwargs["upgraded_databases"].index == 1
+        # Only the fleet databases of the shard are iterated over
+        assert [db_name for db_name, _ in kwargs["fleet_databases"]()] == [
+            f"tenant_{index}" for index in range(4) if get_shard_index(f"tenant_{index}", 2) == 1
+        ]
+        mock_chartreuse_instance.wait_for_stopped_pods.assert_called_once_with(3600.0)
+        mock_chartreuse_instance.upgrade.assert_called_once()
+        mock_chartreuse_instance.kubernetes_helper.stop_pods.assert_not_called()
+        mock_chartreuse_instance.kubernetes_helper.start_pods.assert_not_called()
+        mock_wait_for_shards.assert_not_called()
+
+    def test_main_coordinator_waits_for_shards(self, mocker: MockerFixture) -> None:
+        """Test that the coordinator checks every database and starts pods once every shard is done."""
+        mock_chartreuse, mock_wait_for_shards = self._mock_sharded_run(mocker, job_completion_index="0")
+        mock_chartreuse_instance = mock_chartreuse.return_value
+
+        main()
+
+        kwargs = mock_chartreuse.call_args.kwargs
+        assert list(kwargs["databases_config"]) == ["main"]
+        assert kwargs["checked_databases"] is None
+        assert kwargs["upgraded_databases"].index == 0
+        assert [db_name for db_name, _ in kwargs["fleet_databases"]()] == [f"tenant_{index}" for index in range(4)]
+        mock_chartreuse_instance.kubernetes_helper.stop_pods.assert_called_once()
+        mock_chartreuse_instance.upgrade.assert_called_once()
+        mock_wait_for_shards.assert_called_once_with(
+            mock_chartreuse_instance.kubernetes_helper, "test-release-chartreuse", mocker.ANY, 3600.0
+        )
+        mock_chartreuse_instance.kubernetes_helper.start_pods.assert_called_once()
+
+    def _mock_work_queue_run(self, mocker: MockerFixture, job_completion_index: str) -> tuple[MagicMock, MagicMock]:
+        mocker.patch("chartreuse.chartreuse_upgrade.ensure_safe_run")
+        mocker.patch("os.path.exists", return_value=True)
+        mocker.patch("os.path.isfile", return_value=True)
+        mocker.patch(
+            "chartreuse.chartreuse_upgrade.read_multi_database_config",
+            return_value=MagicMock(databases={"main": MagicMock(depends_on=[])}, fleet=None),
+        )
+        mocker.patch("chartreuse.chartreuse_upgrade.get_engine")
+        mocker.patch("chartreuse.chartreuse_upgrade.WorkQueue")
+        mock_chartreuse = mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse")
+        mock_chartreuse.return_value.is_migration_needed = True
+        mock_chartreuse.return_value.deployments_to_scale = None
+        mocker.patch("chartreuse.chartreuse_upgrade.KubernetesDeploymentManager")
+        mocker.patch.dict(
+            os.environ,
+            {
+                "CHARTREUSE_MULTI_CONFIG_PATH": "/app/config.yaml",
+                "CHARTREUSE_RELEASE_NAME": "test-release",
+                "CHARTREUSE_WORK_QUEUE_URL": "postgresql://control/chartreuse",
+                "CHARTREUSE_WORK_QUEUE_RUN_ID": "42",
+                "JOB_COMPLETION_INDEX": job_completion_index,
+            },
+            clear=True,
+        )
+        return mock_chartreuse, mocker.patch("chartreuse.chartreuse_upgrade.process_work_queue")
+
+    def test_main_work_queue_worker(self, mocker: MockerFixture) -> None:
+        """Test that a worker processes the queue, waiting for the coordinator to stop pods before upgrading."""
+        mock_chartreuse, mock_process_work_queue = self._mock_work_queue_run(mocker, job_completion_index="1")
+        mock_chartreuse_instance = mock_chartreuse.return_value
+
+        main()
+
+        mock_process_work_queue.assert_called_once()
+        before_upgrade = mock_process_work_queue.call_args.kwargs["before_upgrade"]
+        before_upgrade("main")
+        mock_chartreuse_instance.wait_for_stopped_pods.assert_called_once_with(3600.0, ["main"])
+        mock_chartreuse_instance.upgrade.assert_not_called()
+        mock_chartreuse_instance.kubernetes_helper.stop_pods.assert_not_called()
+        mock_chartreuse_instance.kubernetes_helper.start_pods.assert_not_called()
+
+    def test_main_work_queue_coordinator(self, mocker: MockerFixture) -> None:
+        """Test that the coordinator stops pods, processes the queue until it is drained, then starts pods."""
+        mock_chartreuse, mock_process_work_queue = self._mock_work_queue_run(mocker, job_completion_index="0")
+        mock_chartreuse_instance = mock_chartreuse.return_value
+
+        main()
+
+        mock_chartreuse_instance.kubernetes_helper.stop_pods.assert_called_once()
+        mock_process_work_queue.assert_called_once_with(mocker.ANY, mock_chartreuse_instance, 4)
+        mock_chartreuse_instance.upgrade.assert_not_called()
+        mock_chartreuse_instance.kubernetes_helper.start_pods.assert_called_once()
+
 
 class TestMainBooleanParsing:
     """Test cases for boolean environment variable parsing."""
@@ -500,13 +772,14 @@ class TestMainBooleanParsing:
             }
         ]
         mocker.patch(
-            "chartreuse.chartreuse_upgrade.load_multi_database_config",
-            return_value=mock_config,
+            "chartreuse.chartreuse_upgrade.read_multi_database_config",
+            return_value=MagicMock(databases=mock_config, fleet=None),
         )
 
         mock_chartreuse = mocker.patch("chartreuse.chartreuse_upgrade.Chartreuse")
         mock_chartreuse_instance = mocker.MagicMock()
         mock_chartreuse_instance.is_migration_needed = True  # Set to True to test stop_pods behavior
+        mock_chartreuse_instance.deployments_to_scale = None
         mock_chartreuse.return_value = mock_chartreuse_instance
 
         mock_k8s_manager = mocker.patch("chartreuse.chartreuse_upgrade.KubernetesDeploymentManager")
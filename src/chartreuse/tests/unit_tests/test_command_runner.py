@@ -0,0 +1,74 @@
+"""Unit tests for the asyncio subprocesses."""
+
+import asyncio
+import os
+import sys
+from subprocess import CalledProcessError
+
+import pytest
+
+from chartreuse.utils.command_runner import run_command_async
+
+
+def test_run_command_async_streams_output() -> None:
+    """Test that every line of stdout and stderr is passed to the callback."""
+    lines: list[str] = []
+
+    asyncio.run(
+        run_command_async(
+            f"{sys.executable} -c \"import sys; print('out'); print('err', file=sys.stderr)\"",
+            line_callback=lines.append,
+        )
+    )
+
+    assert sorted(lines) == ["err", "out"]
+
+
+def test_run_command_async_long_lines() -> None:
+    """Test that lines longer than a chunk of output are passed whole to the callback."""
+    lines: list[str] = []
+
+    asyncio.run(
+        run_command_async(
+            f"{sys.executable} -c \"print('a' * 2**21); print('é' * 100000, end='')\"", line_callback=lines.append
+        )
+    )
+
+    assert lines == ["a" * 2**21, "é" * 100000]
+
+
+def test_run_command_async_callback_failure() -> None:
+    """Test that the command is killed when its output can't be handled."""
+
+    def line_callback(line: str) -> None:
+        raise ValueError(line)
+
+    with pytest.raises(ValueError) as excinfo:
+        asyncio.run(
+            run_command_async(
+                f'{sys.executable} -c "import os, time; print(os.getpid(), flush=True); time.sleep(30)"',
+                line_callback=line_callback,
+            )
+        )
+
+    # Killed and reaped
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(str(excinfo.value)), 0)
+
+
+def test_run_command_async_failure() -> None:
+    """Test that a failing command raises CalledProcessError."""
+    with pytest.raises(CalledProcessError) as excinfo:
+        asyncio.run(run_command_async(f"{sys.executable} -c 'raise SystemExit(3)'"))
+
+    assert excinfo.value.returncode == 3
+
+
+def test_run_command_async_cancelled() -> None:
+    """Test that the command is killed when cancelled."""
+
+    async def run() -> None:
+        await asyncio.wait_for(run_command_async(f"{sys.executable} -c 'import time; time.sleep(30)'"), timeout=0.5)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(run())
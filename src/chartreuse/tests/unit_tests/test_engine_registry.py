@@ -0,0 +1,28 @@
+"""Unit tests for the engine registry."""
+
+from pytest_mock.plugin import MockerFixture
+
+from chartreuse.utils import dispose_engines, get_engine
+
+
+def test_get_engine_is_shared_per_url() -> None:
+    """Test that the same engine is returned for the same database URL."""
+    try:
+        engine = get_engine("sqlite://")
+
+        assert get_engine("sqlite://") is engine
+        assert get_engine("sqlite:///other.db") is not engine
+    finally:
+        dispose_engines()
+
+
+def test_dispose_engines(mocker: MockerFixture) -> None:
+    """Test that every engine is disposed of and forgotten."""
+    engine = get_engine("sqlite://")
+    mocked_dispose = mocker.patch.object(engine, "dispose")
+
+    dispose_engines()
+
+    mocked_dispose.assert_called_once()
+    assert get_engine("sqlite://") is not engine
+    dispose_engines()
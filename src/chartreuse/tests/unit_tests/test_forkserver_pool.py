@@ -0,0 +1,100 @@
+"""Unit tests for the checks and upgrades run in workers forked from the forkserver."""
+
+import functools
+import json
+import multiprocessing.context
+import os
+import tempfile
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+
+from chartreuse.utils import AlembicMigrationHelper, dispose_engines, script_directory_cache
+from chartreuse.utils.alembic_config import build_alembic_config
+from chartreuse.utils.alembic_output import RevisionProgress
+from chartreuse.utils.forkserver_pool import (
+    FORKSERVER_PRELOAD_SCRIPT_DIRECTORIES,
+    PRELOAD_SCRIPT_DIRECTORIES_ENV,
+    WorkerUpgradeError,
+    get_forkserver_context,
+)
+from chartreuse.utils.forkserver_preload import preload_script_directories
+
+from .conftest import HelperFactory, write_alembic_tree
+
+
+@pytest.fixture
+def make_helper(make_helper: HelperFactory) -> HelperFactory:
+    return functools.partial(
+        make_helper, check_mode="forkserver", upgrade_engine="forkserver", preload_modules=["json"]
+    )
+
+
+def test_forkserver_check_and_upgrade(make_helper: HelperFactory) -> None:
+    """Test that checks and upgrades run in workers, their progress and applied revisions being sent back."""
+    events: list[RevisionProgress] = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+
+        try:
+            helper = make_helper(temp_dir, on_revision_progress=events.append)
+            assert helper.is_migration_needed
+            helper.upgrade_db()
+
+            assert not make_helper(temp_dir).is_migration_needed
+        finally:
+            dispose_engines()
+
+    assert [(event.revision, event.position, event.total) for event in events] == [
+        ("aaaaaaaaaaaa", 1, 2),
+        ("bbbbbbbbbbbb", 2, 2),
+    ]
+    assert [applied_revision.revision for applied_revision in helper.applied_revisions] == [
+        "aaaaaaaaaaaa",
+        "bbbbbbbbbbbb",
+    ]
+
+
+def test_forkserver_failed_upgrade(make_helper: HelperFactory) -> None:
+    """Test that a failed upgrade raises in the Chartreuse process with the revision it failed on."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+        with open(os.path.join(temp_dir, "migrations", "versions", "bbbbbbbbbbbb.py"), "a") as f:
+            f.write("\n\ndef upgrade() -> None:\n    raise RuntimeError('boom')\n")
+
+        helper = make_helper(temp_dir, record_migration_history=False)
+        with pytest.raises(WorkerUpgradeError, match="RuntimeError: boom"):
+            helper.upgrade_db()
+
+    # aaaaaaaaaaaa was rolled back with the upgrade transaction
+    assert [(revision.revision, revision.success) for revision in helper.applied_revisions] == [("bbbbbbbbbbbb", False)]
+
+
+def test_forkserver_parses_registered_trees(mocker: MockerFixture, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that the forkserver parses the migration trees of the helpers, for its workers to inherit them."""
+    mocker.patch("chartreuse.utils.forkserver_pool._preload_script_directories", set())
+    monkeypatch.delenv(PRELOAD_SCRIPT_DIRECTORIES_ENV, raising=False)
+    from_config = mocker.spy(script_directory_cache.ScriptDirectory, "from_config")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+        AlembicMigrationHelper(
+            alembic_directory_path=temp_dir,
+            database_url=f"sqlite:///{temp_dir}/acme.db",
+            alembic_section_name="acme",
+            alembic_template_section_name="test",
+            check_mode="forkserver",
+            configure=False,
+        )
+
+        set_forkserver_preload = mocker.spy(multiprocessing.context.ForkServerContext, "set_forkserver_preload")
+        get_forkserver_context()
+        assert set_forkserver_preload.call_args.args[1][-1] == FORKSERVER_PRELOAD_SCRIPT_DIRECTORIES
+        assert json.loads(os.environ[PRELOAD_SCRIPT_DIRECTORIES_ENV]) == [[temp_dir, "alembic.ini", "test"]]
+        # What the forkserver runs once started, with the environment of the Chartreuse process
+        preload_script_directories()
+        config = build_alembic_config(
+            alembic_directory_path=temp_dir, alembic_config_file_path="alembic.ini", alembic_section_name="test"
+        )
+        assert script_directory_cache.get_script_heads(config) == {"bbbbbbbbbbbb"}
+
+    from_config.assert_called_once()
@@ -0,0 +1,44 @@
+"""Unit tests for the startup time of the chartreuse-upgrade entry point."""
+
+import os
+import re
+import subprocess
+import sys
+
+# Cumulative import time of chartreuse.chartreuse_upgrade allowed, in microseconds
+IMPORT_TIME_BUDGET_US = int(os.environ.get("CHARTREUSE_IMPORT_TIME_BUDGET_MS", "300")) * 1000
+
+# Only imported once the code path that needs them runs
+DEFERRED_MODULES = ("wiremind_kubernetes", "kubernetes", "sqlalchemy", "pydantic", "yaml", "alembic")
+
+IMPORTTIME_LINE_RE = re.compile(r"import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \| (?P<module>\s*\S+)")
+
+
+def _get_import_times() -> dict[str, int]:
+    # `-m chartreuse.chartreuse_upgrade` would also run main()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import chartreuse.chartreuse_upgrade"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return {
+        match["module"].strip(): int(match["cumulative"])
+        for match in map(IMPORTTIME_LINE_RE.match, result.stderr.splitlines())
+        if match is not None
+    }
+
+
+def test_entry_point_defers_heavy_imports() -> None:
+    """Test that importing the entry point imports none of the heavy dependencies."""
+    import_times = _get_import_times()
+
+    imported = {module.split(".")[0] for module in import_times}
+    assert imported.isdisjoint(DEFERRED_MODULES), sorted(imported.intersection(DEFERRED_MODULES))
+
+
+def test_entry_point_import_time_budget() -> None:
+    """Test that importing the entry point stays within the startup-time budget."""
+    import_times = _get_import_times()
+
+    assert import_times["chartreuse.chartreuse_upgrade"] < IMPORT_TIME_BUDGET_US
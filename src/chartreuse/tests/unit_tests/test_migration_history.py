@@ -0,0 +1,130 @@
+"""Unit tests for the migration history."""
+
+import os
+import tempfile
+
+import pytest
+import sqlalchemy
+from pytest_mock.plugin import MockerFixture
+
+from chartreuse.utils import dispose_engines
+from chartreuse.utils.alembic_output import RevisionProgress
+
+from .conftest import SAMPLE_REVISION, HelperFactory, write_alembic_tree
+
+
+def _get_history(database_url: str) -> list[tuple]:
+    engine = sqlalchemy.create_engine(database_url)
+    with engine.connect() as connection:
+        rows = connection.execute(
+            sqlalchemy.text("SELECT database, revision, duration, success FROM chartreuse_migration_history")
+        ).all()
+    engine.dispose()
+    return [tuple(row) for row in rows]
+
+
+def test_applied_revisions_are_recorded(make_helper: HelperFactory) -> None:
+    """Test that every revision applied by an in-process upgrade is recorded in the database."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+
+        try:
+            make_helper(temp_dir, upgrade_engine="inprocess").upgrade_db()
+        finally:
+            dispose_engines()
+
+        history = _get_history(f"sqlite:///{temp_dir}/test.db")
+
+    assert [(database, revision, success) for database, revision, _, success in history] == [
+        ("test", "aaaaaaaaaaaa", True),
+        ("test", "bbbbbbbbbbbb", True),
+    ]
+    assert all(duration >= 0 for _, _, duration, _ in history)
+
+
+def test_repeated_upgrades_record_their_own_revisions(make_helper: HelperFactory) -> None:
+    """Test that a helper upgrading twice only records the revisions of each upgrade once."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+        helper = make_helper(temp_dir, upgrade_engine="inprocess")
+
+        try:
+            helper.upgrade_db()
+            with open(os.path.join(temp_dir, "migrations", "versions", "cccccccccccc.py"), "w") as f:
+                f.write(SAMPLE_REVISION.format(revision="cccccccccccc", down_revision=repr("bbbbbbbbbbbb")))
+            helper.upgrade_db()
+        finally:
+            dispose_engines()
+
+        history = _get_history(f"sqlite:///{temp_dir}/test.db")
+
+    assert [revision for _, revision, _, _ in history] == ["aaaaaaaaaaaa", "bbbbbbbbbbbb", "cccccccccccc"]
+
+
+def test_failed_revision_is_recorded(make_helper: HelperFactory) -> None:
+    """Test that the revision failing an upgrade is recorded as failed."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+        with open(os.path.join(temp_dir, "migrations", "versions", "bbbbbbbbbbbb.py"), "a") as f:
+            f.write("\n\ndef upgrade() -> None:\n    raise RuntimeError('Boom')\n")
+
+        try:
+            with pytest.raises(RuntimeError, match="Boom"):
+                make_helper(temp_dir, upgrade_engine="inprocess").upgrade_db()
+        finally:
+            dispose_engines()
+
+        history = _get_history(f"sqlite:///{temp_dir}/test.db")
+
+    # The upgrade transaction was rolled back with aaaaaaaaaaaa, not the history
+    assert [(revision, success) for _, revision, _, success in history] == [("bbbbbbbbbbbb", False)]
+
+
+def test_history_can_be_disabled(mocker: MockerFixture, make_helper: HelperFactory) -> None:
+    """Test that nothing is recorded when record_migration_history is false."""
+    mocked_record = mocker.patch("chartreuse.utils.alembic_migration_helper.record_migration_history")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+
+        try:
+            make_helper(temp_dir, upgrade_engine="inprocess", record_migration_history=False).upgrade_db()
+        finally:
+            dispose_engines()
+
+    mocked_record.assert_not_called()
+
+
+def test_history_failure_does_not_fail_upgrade(mocker: MockerFixture, make_helper: HelperFactory) -> None:
+    """Test that an upgrade succeeds even if its history can't be recorded."""
+    mocker.patch(
+        "chartreuse.utils.alembic_migration_helper.record_migration_history", side_effect=Exception("Read-only")
+    )
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+
+        try:
+            helper = make_helper(temp_dir, upgrade_engine="inprocess")
+            helper.upgrade_db()
+        finally:
+            dispose_engines()
+
+    assert len(helper.applied_revisions) == 2
+
+
+def test_in_process_revision_progress(make_helper: HelperFactory) -> None:
+    """Test that in-process upgrades emit a progress event when each revision starts."""
+    events: list[RevisionProgress] = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+
+        try:
+            make_helper(
+                temp_dir, upgrade_engine="inprocess", record_migration_history=False, on_revision_progress=events.append
+            ).upgrade_db()
+        finally:
+            dispose_engines()
+
+    assert [(event.revision, event.position, event.total) for event in events] == [
+        ("aaaaaaaaaaaa", 1, 2),
+        ("bbbbbbbbbbbb", 2, 2),
+    ]
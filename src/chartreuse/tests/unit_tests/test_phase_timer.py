@@ -0,0 +1,86 @@
+"""Unit tests for the phase timings."""
+
+import json
+import os
+import tempfile
+
+import pytest
+
+import chartreuse.utils
+from chartreuse.utils.phase_timer import (
+    JSON_REPORT_FILE_NAME,
+    PROMETHEUS_FILE_NAME,
+    clear_phase_timings,
+    get_phase_timings,
+    time_phase,
+    write_phase_report,
+)
+
+from .conftest import write_alembic_tree
+
+
+@pytest.fixture(autouse=True)
+def _clear_phase_timings() -> None:
+    clear_phase_timings()
+
+
+def test_time_phase() -> None:
+    """Test that phases are recorded with their database and whether they succeeded."""
+    with time_phase("upgrade", "main"):
+        pass
+    with pytest.raises(RuntimeError), time_phase("start_pods"):
+        raise RuntimeError("Boom")
+
+    upgrade, start_pods = get_phase_timings()
+    assert (upgrade.phase, upgrade.database, upgrade.success) == ("upgrade", "main", True)
+    assert upgrade.duration >= 0
+    assert (start_pods.phase, start_pods.database, start_pods.success) == ("start_pods", None, False)
+
+
+def test_write_phase_report() -> None:
+    """Test that the timings are written as JSON and in the Prometheus text format."""
+    for _ in range(2):
+        with time_phase("connect", "main"):
+            pass
+    with time_phase("stop_pods"):
+        pass
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_phase_report(temp_dir)
+
+        with open(os.path.join(temp_dir, JSON_REPORT_FILE_NAME)) as f:
+            report = json.load(f)
+        with open(os.path.join(temp_dir, PROMETHEUS_FILE_NAME)) as f:
+            metrics = f.read()
+
+    assert [(phase["phase"], phase["database"]) for phase in report["phases"]] == [
+        ("connect", "main"),
+        ("connect", "main"),
+        ("stop_pods", None),
+    ]
+    assert "# TYPE chartreuse_phase_duration_seconds gauge" in metrics
+    # Phases run several times are summed up
+    assert metrics.count('chartreuse_phase_duration_seconds{phase="connect",database="main"}') == 1
+    assert 'chartreuse_phase_success{phase="stop_pods",database=""} 1' in metrics
+
+
+def test_database_phases_are_timed() -> None:
+    """Test that the checks of a database are timed per phase."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+
+        alembic_migration_helper = chartreuse.utils.AlembicMigrationHelper(
+            alembic_directory_path=temp_dir,
+            database_url=f"sqlite:///{temp_dir}/test.db",
+            alembic_section_name="test",
+            allow_migration_for_empty_database=True,
+            check_mode="inprocess",
+            configure=False,
+        )
+        assert alembic_migration_helper.is_migration_needed
+
+    assert [(timing.phase, timing.database) for timing in get_phase_timings()] == [
+        ("connect", "test"),
+        ("emptiness_check", "test"),
+        ("current", "test"),
+    ]
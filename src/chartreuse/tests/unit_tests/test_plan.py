@@ -0,0 +1,165 @@
+"""Unit tests for the migration plans."""
+
+import json
+import os
+import tempfile
+from collections.abc import Iterator
+from dataclasses import asdict
+from unittest.mock import MagicMock
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+
+from chartreuse.benchmarks.alembic_tree import write_synthetic_tree
+from chartreuse.chartreuse import plan_migrations
+from chartreuse.cli import main
+from chartreuse.config_loader import DatabaseConfig
+from chartreuse.utils import MigrationPlan
+from chartreuse.utils.revision_manifest import bake_manifest
+
+from .conftest import HelperFactory, stamp, write_alembic_tree
+from .test_chartreuse import _databases_config
+
+
+@pytest.mark.parametrize("bake", [False, True])
+def test_migration_plan(bake: bool, make_helper: HelperFactory) -> None:
+    """Test that the plan lists the revisions from the current revision to the heads, with or without manifest."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+        if bake:
+            bake_manifest(temp_dir)
+
+        empty_plan = make_helper(temp_dir).get_migration_plan()
+        stamp(f"sqlite:///{temp_dir}/test.db", "aaaaaaaaaaaa")
+        plan = make_helper(temp_dir).get_migration_plan()
+
+    assert empty_plan.current_revisions == ()
+    assert empty_plan.pending_revisions == ("aaaaaaaaaaaa", "bbbbbbbbbbbb")
+    assert plan.current_revisions == ("aaaaaaaaaaaa",)
+    assert plan.head_revisions == ("bbbbbbbbbbbb",)
+    assert plan.pending_revisions == ("bbbbbbbbbbbb",)
+
+
+def test_migration_plan_branched(make_helper: HelperFactory) -> None:
+    """Test that pending revisions of a branched history come after the revisions they revise."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        head = write_synthetic_tree(temp_dir, 11, "branched", branch_count=2)
+
+        plan = make_helper(temp_dir, alembic_section_name="bench").get_migration_plan()
+
+    assert len(plan.pending_revisions) == 11
+    assert plan.pending_revisions[0] == f"{0:012x}"
+    assert plan.pending_revisions[-1] == head
+    # Each branch is applied in order
+    first_branch = [revision for revision in plan.pending_revisions if f"{1:012x}" <= revision <= f"{4:012x}"]
+    assert first_branch == sorted(first_branch)
+
+
+def test_migration_plan_empty_database_skipped(make_helper: HelperFactory) -> None:
+    """Test that the plan tells when an empty database would not be upgraded."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+
+        plan = make_helper(temp_dir, allow_migration_for_empty_database=False).get_migration_plan()
+
+    assert plan.skipped_empty_database
+    assert plan.pending_revisions == ()
+
+
+def test_migration_plan_unknown_revision(make_helper: HelperFactory) -> None:
+    """Test that a database at a revision missing from the scripts is reported."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+        stamp(f"sqlite:///{temp_dir}/test.db", "cccccccccccc")
+
+        with pytest.raises(ValueError, match="not found in the migration scripts"):
+            make_helper(temp_dir).get_migration_plan()
+
+
+def test_plan_command(mocker: MockerFixture, capsys: pytest.CaptureFixture[str]) -> None:
+    """Test the `chartreuse plan` command line."""
+    mocked_read_config = mocker.patch("chartreuse.cli.read_multi_database_config")
+    plans = {
+        "main": MigrationPlan(("aaaaaaaaaaaa",), ("bbbbbbbbbbbb",), ("bbbbbbbbbbbb",)),
+        "audit": MigrationPlan(("bbbbbbbbbbbb",), ("bbbbbbbbbbbb",), ()),
+    }
+    mocked_plan_migrations = mocker.patch("chartreuse.cli.plan_migrations", return_value=iter(plans.items()))
+
+    with pytest.raises(SystemExit) as excinfo:
+        main(["plan", "/app/config.yaml", "--json", "--detailed-exitcode", "--max-concurrency", "2"])
+
+    assert excinfo.value.code == 2
+    mocked_read_config.assert_called_once_with("/app/config.yaml")
+    mocked_plan_migrations.assert_called_once_with(
+        mocked_read_config.return_value.iter_databases.return_value, max_concurrency=2
+    )
+    # The plans are streamed, as json.dumps would have printed them at once
+    assert (
+        capsys.readouterr().out
+        == json.dumps({db_name: asdict(plan) for db_name, plan in plans.items()}, indent=2) + "\n"
+    )
+
+
+@pytest.mark.parametrize("args", [["--json"], []])
+def test_plan_command_without_database(
+    mocker: MockerFixture, capsys: pytest.CaptureFixture[str], args: list[str]
+) -> None:
+    """Test that `chartreuse plan` prints an empty plan when the fleet has no tenant."""
+    mocker.patch("chartreuse.cli.read_multi_database_config")
+    mocker.patch("chartreuse.cli.plan_migrations", return_value=iter([]))
+
+    main(["plan", "/app/config.yaml", "--detailed-exitcode", *args])
+
+    assert capsys.readouterr().out == ("{}\n" if args else "")
+
+
+def test_plan_migrations(mocker: MockerFixture) -> None:
+    """Test that every database of the configuration is planned."""
+    helpers = {"main": MagicMock(), "audit": MagicMock()}
+    mocker.patch("chartreuse.chartreuse.create_migration_helpers", return_value=helpers)
+
+    plans = dict(plan_migrations(_databases_config("main", "audit").items(), max_concurrency=2))
+
+    assert plans == {db_name: helper.get_migration_plan.return_value for db_name, helper in helpers.items()}
+
+
+def test_plan_migrations_by_batches(mocker: MockerFixture) -> None:
+    """Test that the databases are planned by batches as they are iterated, their helpers created for each batch."""
+    mocker.patch("chartreuse.chartreuse.FLEET_BATCH_SIZE", 2)
+    create_migration_helpers = mocker.patch(
+        "chartreuse.chartreuse.create_migration_helpers",
+        side_effect=lambda databases, configure: {db_name: MagicMock() for db_name in databases},
+    )
+    dispose_engines = mocker.patch("chartreuse.chartreuse.dispose_engines")
+    databases_config = _databases_config("a", "b", "c")
+    iterated: list[str] = []
+
+    def iter_databases() -> Iterator[tuple[str, DatabaseConfig]]:
+        for db_name, db_config in databases_config.items():
+            iterated.append(db_name)
+            yield db_name, db_config
+
+    plans = plan_migrations(iter_databases())
+
+    assert next(plans)[0] == "a"
+    assert iterated == ["a", "b"]
+    assert [db_name for db_name, _ in plans] == ["b", "c"]
+    assert [list(call.args[0]) for call in create_migration_helpers.call_args_list] == [["a", "b"], ["c"]]
+    assert dispose_engines.call_count == 2
+
+
+def test_plan_migrations_leaves_alembic_ini_unchanged(mocker: MockerFixture) -> None:
+    """Test that planning does not write the database URLs to alembic.ini, unlike an upgrade run."""
+    mocker.patch("chartreuse.utils.AlembicMigrationHelper.get_migration_plan")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+        with open(os.path.join(temp_dir, "alembic.ini"), "rb") as f:
+            alembic_ini = f.read()
+        databases_config = {
+            "test": _databases_config("test")["test"].model_copy(update={"alembic_directory_path": temp_dir})
+        }
+
+        list(plan_migrations(databases_config.items()))
+
+        with open(os.path.join(temp_dir, "alembic.ini"), "rb") as f:
+            assert f.read() == alembic_ini
@@ -0,0 +1,85 @@
+"""Unit tests for the readiness of the databases."""
+
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+import sqlalchemy
+from pytest_mock.plugin import MockerFixture
+
+from chartreuse.chartreuse import Chartreuse
+from chartreuse.tests.unit_tests.test_chartreuse import _databases_config
+from chartreuse.utils.readiness import DatabaseNotReadyError, probe_database, wait_until_ready
+
+NOT_READY_ERROR = sqlalchemy.exc.OperationalError("SELECT 1", {}, Exception("the database system is starting up"))
+
+
+def test_probe_database() -> None:
+    """Test that a database accepting queries is ready, Patroni checks only applying to PostgreSQL."""
+    probe_database(sqlalchemy.create_engine("sqlite://"), patroni_postgresql=True)
+
+
+def test_wait_until_ready_retries(mocker: MockerFixture) -> None:
+    """Test that a database is probed with growing delays until it is ready."""
+    mocked_sleep = mocker.patch("chartreuse.utils.readiness.time.sleep")
+    mocked_probe = mocker.patch(
+        "chartreuse.utils.readiness.probe_database",
+        side_effect=[NOT_READY_ERROR, DatabaseNotReadyError("Role(s) not created yet: wiremind_owner"), None],
+    )
+
+    wait_until_ready(MagicMock(), deadline=float("inf"), patroni_postgresql=True, database="main")
+
+    assert mocked_probe.call_count == 3
+    assert [call.args[0] for call in mocked_sleep.call_args_list] == [0.5, 1.0]
+
+
+def test_wait_until_ready_deadline(mocker: MockerFixture) -> None:
+    """Test that waiting stops at the deadline."""
+    mocker.patch("chartreuse.utils.readiness.time.monotonic", side_effect=[0, 2, 4])
+    mocked_sleep = mocker.patch("chartreuse.utils.readiness.time.sleep")
+    mocker.patch("chartreuse.utils.readiness.probe_database", side_effect=NOT_READY_ERROR)
+
+    with pytest.raises(DatabaseNotReadyError, match="main is still not ready"):
+        wait_until_ready(MagicMock(), deadline=3, database="main")
+
+    # The last delay is shortened to end at the deadline
+    assert [call.args[0] for call in mocked_sleep.call_args_list] == [0.5, 1.0]
+
+
+def test_ready_databases_are_checked_without_waiting_for_others(mocker: MockerFixture) -> None:
+    """Test that a database is checked as soon as it is ready, while another one is still not."""
+    slow_database_ready = threading.Event()
+    slow_helper = MagicMock(is_migration_needed=False)
+    slow_helper.wait_until_ready.side_effect = lambda *args, **kwargs: slow_database_ready.wait(5)
+    ready_helper = MagicMock(is_migration_needed=True)
+    mocker.patch("chartreuse.chartreuse.AlembicMigrationHelper", side_effect=[slow_helper, ready_helper])
+    mocker.patch("chartreuse.chartreuse.configure_logging")
+
+    chartreuse = Chartreuse(
+        databases_config=_databases_config("slow", "ready"),
+        release_name="test-release",
+        kubernetes_helper=MagicMock(),
+        readiness_timeout=60,
+        patroni_postgresql=True,
+    )
+    try:
+        assert chartreuse.is_migration_needed
+        assert not slow_database_ready.is_set()
+        ready_helper.wait_until_ready.assert_called_once_with(mocker.ANY, patroni_postgresql=True)
+    finally:
+        slow_database_ready.set()
+        chartreuse.close()
+
+
+def test_readiness_disabled(mocker: MockerFixture) -> None:
+    """Test that databases are checked without probing them when there is no readiness timeout."""
+    helper = MagicMock(is_migration_needed=False)
+    mocker.patch("chartreuse.chartreuse.AlembicMigrationHelper", return_value=helper)
+    mocker.patch("chartreuse.chartreuse.configure_logging")
+
+    chartreuse = Chartreuse(
+        databases_config=_databases_config("main"), release_name="test-release", kubernetes_helper=MagicMock()
+    )
+
+    assert not chartreuse.is_migration_needed
+    helper.wait_until_ready.assert_not_called()
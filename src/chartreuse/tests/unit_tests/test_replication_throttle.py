@@ -0,0 +1,140 @@
+"""Unit tests for the throttling of upgrades on the replication lag."""
+
+import os
+import tempfile
+from typing import Any
+from unittest.mock import MagicMock
+
+import pytest
+import sqlalchemy
+from pytest_mock.plugin import MockerFixture
+
+from chartreuse.utils import dispose_engines
+from chartreuse.utils.replication_throttle import get_replication_lag, wait_for_replication
+
+from .conftest import HelperFactory, write_alembic_tree
+
+
+def test_wait_for_replication(mocker: MockerFixture) -> None:
+    """Test that the upgrade pauses with exponential backoff until the lag is at most the maximum."""
+    mocker.patch("chartreuse.utils.replication_throttle.get_replication_lag", side_effect=[12.0, 8.0, 3.0, 1.0])
+    sleep = mocker.patch("chartreuse.utils.replication_throttle.time.sleep")
+
+    wait_for_replication(MagicMock(), max_lag=5)
+
+    assert [call.args[0] for call in sleep.call_args_list] == [1.0, 2.0]
+
+
+def test_wait_for_replication_timeout(mocker: MockerFixture) -> None:
+    """Test that the upgrade goes on once the timeout elapsed, even if the replicas did not catch up."""
+    get_lag = mocker.patch("chartreuse.utils.replication_throttle.get_replication_lag", return_value=60.0)
+    mocker.patch("chartreuse.utils.replication_throttle.time.monotonic", side_effect=[0, 1, 3, 10])
+    sleep = mocker.patch("chartreuse.utils.replication_throttle.time.sleep")
+
+    wait_for_replication(MagicMock(), max_lag=5, timeout=10)
+
+    assert [call.args[0] for call in sleep.call_args_list] == [1.0, 2.0]
+    assert get_lag.call_count == 3
+
+
+def test_replication_lag_of_unsupported_dialect(mocker: MockerFixture) -> None:
+    """Test that the upgrade is not throttled when the lag can't be measured on the dialect."""
+    sleep = mocker.patch("chartreuse.utils.replication_throttle.time.sleep")
+    engine = sqlalchemy.create_engine("sqlite://")
+
+    assert get_replication_lag(engine) is None
+    wait_for_replication(engine, max_lag=0)
+
+    sleep.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "row, lag",
+    [
+        # A standby lagging behind, or idle with a NULL replay_lag
+        ((4.5, 0), 4.5),
+        ((None, 0), 0.0),
+        # Standbys hidden from a user who is not a member of pg_monitor
+        ((None, 2), None),
+    ],
+)
+def test_postgresql_replication_lag(row: tuple[float | None, int], lag: float | None) -> None:
+    """Test that the lag of idle standbys is zero, and that it can't be measured when standbys are hidden."""
+    engine = MagicMock()
+    connection = engine.connect.return_value.__enter__.return_value
+    connection.dialect.name = "postgresql"
+    connection.execute.return_value.one.return_value = row
+
+    assert get_replication_lag(engine) == lag
+
+
+# env.py migrating each revision in its own transaction, with its own engine
+TRANSACTION_PER_MIGRATION_ENV_PY = """
+from alembic import context
+from sqlalchemy import engine_from_config, pool
+
+config = context.config
+connectable = engine_from_config(
+    config.get_section(config.config_ini_section), prefix="sqlalchemy.", poolclass=pool.NullPool
+)
+with connectable.connect() as connection:
+    context.configure(connection=connection, transaction_per_migration=True)
+    with context.begin_transaction():
+        context.run_migrations()
+"""
+
+
+def test_inprocess_upgrade_is_throttled_between_revisions(mocker: MockerFixture, make_helper: HelperFactory) -> None:
+    """Test that an upgrade committing each revision on its own waits for the replicas before and between them."""
+    wait = mocker.patch("chartreuse.utils.alembic_migration_helper.wait_for_replication")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+        with open(os.path.join(temp_dir, "migrations", "env.py"), "w") as f:
+            f.write(TRANSACTION_PER_MIGRATION_ENV_PY)
+        helper = make_helper(
+            temp_dir, upgrade_engine="inprocess", max_replication_lag=5, replication_throttle_timeout=30
+        )
+
+        # Revisions committed when the upgrade waits for the replicas
+        committed_revisions: list[list[str]] = []
+
+        def read_committed_revisions(*args: Any, **kwargs: Any) -> None:
+            engine = sqlalchemy.create_engine(f"sqlite:///{temp_dir}/test.db")
+            with engine.connect() as connection:
+                revisions: list[str] = []
+                if sqlalchemy.inspect(connection).has_table("alembic_version"):
+                    query = sqlalchemy.text("SELECT version_num FROM alembic_version")
+                    revisions = list(connection.execute(query).scalars())
+            engine.dispose()
+            committed_revisions.append(revisions)
+
+        wait.side_effect = read_committed_revisions
+        try:
+            helper.upgrade_db()
+        finally:
+            dispose_engines()
+
+    # Once before the upgrade, then between the 2 revisions once the first one is committed
+    assert committed_revisions == [[], ["aaaaaaaaaaaa"]]
+    assert wait.call_args.args[1:] == (5,)
+    assert wait.call_args.kwargs == {"timeout": 30, "database": "test"}
+    assert [applied_revision.revision for applied_revision in helper.applied_revisions] == [
+        "aaaaaaaaaaaa",
+        "bbbbbbbbbbbb",
+    ]
+
+
+def test_inprocess_upgrade_in_one_transaction_is_not_throttled_between_revisions(
+    mocker: MockerFixture, make_helper: HelperFactory
+) -> None:
+    """Test that an upgrade running all its revisions in one transaction only waits for the replicas before it."""
+    wait = mocker.patch("chartreuse.utils.alembic_migration_helper.wait_for_replication")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+
+        try:
+            make_helper(temp_dir, upgrade_engine="inprocess", max_replication_lag=5).upgrade_db()
+        finally:
+            dispose_engines()
+
+    wait.assert_called_once()
@@ -0,0 +1,117 @@
+"""Unit tests for the build-time revision manifest."""
+
+import json
+import os
+import tempfile
+
+from pytest_mock.plugin import MockerFixture
+
+import chartreuse.utils
+from chartreuse.cli import main
+from chartreuse.utils import revision_manifest
+from chartreuse.utils.revision_manifest import MANIFEST_FILE_NAME, bake_manifest
+
+from .conftest import write_alembic_tree
+
+
+def test_bake_manifest() -> None:
+    """Test that bake writes the heads and the revision graph of every alembic section."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+
+        manifest_path = bake_manifest(temp_dir)
+
+        assert manifest_path == os.path.join(temp_dir, MANIFEST_FILE_NAME)
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        section = manifest["sections"]["test"]
+        assert section["heads"] == ["bbbbbbbbbbbb"]
+        assert section["revisions"] == {"aaaaaaaaaaaa": [], "bbbbbbbbbbbb": ["aaaaaaaaaaaa"]}
+        assert section["versions_hash"]
+
+
+def test_bake_command() -> None:
+    """Test the `chartreuse bake` command line."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+
+        main(["bake", temp_dir, "--config", "alembic.ini"])
+
+        assert os.path.isfile(os.path.join(temp_dir, MANIFEST_FILE_NAME))
+
+
+def test_heads_are_read_from_manifest(mocker: MockerFixture) -> None:
+    """Test that the heads come from the manifest, without parsing the migration scripts."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+        bake_manifest(temp_dir)
+        mocked_from_config = mocker.patch("chartreuse.utils.script_directory_cache.ScriptDirectory.from_config")
+
+        alembic_migration_helper = chartreuse.utils.AlembicMigrationHelper(
+            alembic_directory_path=temp_dir,
+            database_url="foo",
+            alembic_section_name="test",
+            configure=False,
+            skip_db_checks=True,
+        )
+
+        assert alembic_migration_helper._get_script_heads() == {"bbbbbbbbbbbb"}
+        mocked_from_config.assert_not_called()
+
+
+def test_manifest_is_validated_once_per_tree(mocker: MockerFixture) -> None:
+    """Test that databases sharing one alembic directory hash its migration scripts once to validate the manifest."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+        bake_manifest(temp_dir)
+        spied_hash = mocker.spy(revision_manifest, "hash_version_locations")
+
+        for database in ("one", "two", "three"):
+            alembic_migration_helper = chartreuse.utils.AlembicMigrationHelper(
+                alembic_directory_path=temp_dir,
+                database_url=f"sqlite:///{database}.db",
+                alembic_section_name="test",
+                configure=False,
+                skip_db_checks=True,
+            )
+            assert alembic_migration_helper._get_script_heads() == {"bbbbbbbbbbbb"}
+
+        assert spied_hash.call_count == 1
+
+
+def test_outdated_manifest_is_ignored() -> None:
+    """Test that the migration scripts are parsed when they changed since the manifest was baked."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+        bake_manifest(temp_dir)
+        with open(os.path.join(temp_dir, "migrations", "versions", "cccccccccccc.py"), "w") as f:
+            f.write('revision = "cccccccccccc"\ndown_revision = "bbbbbbbbbbbb"\n')
+
+        alembic_migration_helper = chartreuse.utils.AlembicMigrationHelper(
+            alembic_directory_path=temp_dir,
+            database_url="foo",
+            alembic_section_name="test",
+            configure=False,
+            skip_db_checks=True,
+        )
+
+        assert alembic_migration_helper._get_script_heads() == {"cccccccccccc"}
+
+
+def test_heads_are_read_from_template_section_manifest(mocker: MockerFixture) -> None:
+    """Test that databases whose section is copied from a template section use the template's manifest entry."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+        bake_manifest(temp_dir)
+        mocked_from_config = mocker.patch("chartreuse.utils.script_directory_cache.ScriptDirectory.from_config")
+
+        alembic_migration_helper = chartreuse.utils.AlembicMigrationHelper(
+            alembic_directory_path=temp_dir,
+            database_url="foo",
+            alembic_section_name="acme",
+            alembic_template_section_name="test",
+            skip_db_checks=True,
+        )
+
+        assert alembic_migration_helper._get_script_heads() == {"bbbbbbbbbbbb"}
+        mocked_from_config.assert_not_called()
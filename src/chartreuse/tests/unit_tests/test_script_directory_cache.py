@@ -0,0 +1,43 @@
+"""Unit tests for the script directory cache."""
+
+import os
+import tempfile
+
+from pytest_mock.plugin import MockerFixture
+
+from chartreuse.utils.script_directory_cache import ScriptDirectory
+
+from .conftest import SAMPLE_REVISION, HelperFactory, write_alembic_tree
+
+
+def test_script_directory_is_parsed_once_per_tree(mocker: MockerFixture, make_helper: HelperFactory) -> None:
+    """Test that helpers sharing one alembic directory share its parsed scripts."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+        spied_from_config = mocker.spy(ScriptDirectory, "from_config")
+
+        for database in ("one", "two"):
+            helper = make_helper(temp_dir, database_url=f"sqlite:///{database}.db", skip_db_checks=True)
+            assert helper._get_script_heads() == {"bbbbbbbbbbbb"}
+
+        assert spied_from_config.call_count == 1
+
+
+def test_script_directory_is_parsed_again_when_scripts_change(
+    mocker: MockerFixture, make_helper: HelperFactory
+) -> None:
+    """Test that adding a migration script invalidates the cached heads."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        write_alembic_tree(temp_dir)
+        spied_from_config = mocker.spy(ScriptDirectory, "from_config")
+        versions_path = os.path.join(temp_dir, "migrations", "versions")
+        assert make_helper(temp_dir, skip_db_checks=True)._get_script_heads() == {"bbbbbbbbbbbb"}
+
+        with open(os.path.join(versions_path, "cccccccccccc_third.py"), "w") as f:
+            f.write(SAMPLE_REVISION.format(revision="cccccccccccc", down_revision="'bbbbbbbbbbbb'"))
+        # Make sure the directory mtime moves even on coarse-grained filesystems
+        stat = os.stat(versions_path)
+        os.utime(versions_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+        assert make_helper(temp_dir, skip_db_checks=True)._get_script_heads() == {"cccccccccccc"}
+        assert spied_from_config.call_count == 2
@@ -0,0 +1,126 @@
+"""Unit tests for the sharding of the databases across the pods of an Indexed Job."""
+
+from unittest.mock import MagicMock
+
+import pytest
+from pytest_mock.plugin import MockerFixture
+
+from chartreuse.config_loader import DatabaseConfig
+from chartreuse.sharding import (
+    Shard,
+    ShardFailedError,
+    get_shard_index,
+    parse_indexes,
+    select_shard_databases,
+    wait_for_shards,
+)
+
+
+def _databases_config(*db_names: str, depends_on: dict[str, list[str]] | None = None) -> dict[str, DatabaseConfig]:
+    depends_on = depends_on or {}
+    return {
+        db_name: DatabaseConfig(
+            dialect="postgresql",
+            user="user",
+            password="pass",
+            host="localhost",
+            port=5432,
+            database=db_name,
+            alembic_directory_path="/app/alembic",
+            depends_on=depends_on.get(db_name, []),
+        )
+        for db_name in db_names
+    }
+
+
+def test_shards_partition_the_databases() -> None:
+    """Test that every database is in exactly one shard, the shards being balanced."""
+    databases = _databases_config(*(f"tenant_{index}" for index in range(400)))
+
+    shards = [set(dict(select_shard_databases(databases.items(), Shard(index=index, count=4)))) for index in range(4)]
+
+    assert sorted(db_name for shard in shards for db_name in shard) == sorted(databases)
+    assert all(60 < len(shard) < 140 for shard in shards)
+
+
+def test_adding_databases_does_not_move_the_others() -> None:
+    """Test that the assignment of a database only depends on its name and the shard count."""
+    db_names = [f"tenant_{index}" for index in range(100)]
+    before = {db_name: get_shard_index(db_name, 8) for db_name in db_names}
+
+    databases = _databases_config(*db_names, "tenant_new")
+    after = {
+        db_name: index
+        for index in range(8)
+        for db_name, _ in select_shard_databases(databases.items(), Shard(index=index, count=8))
+    }
+
+    assert {db_name: after[db_name] for db_name in db_names} == before
+
+
+def test_databases_depending_on_a_shared_database_are_spread() -> None:
+    """Test that tenants depending on one shared database are spread over the shards, not kept with it."""
+    tenants = [f"tenant_{index}" for index in range(400)]
+    databases = _databases_config("main", *tenants, depends_on={tenant: ["main"] for tenant in tenants})
+
+    shards = [dict(select_shard_databases(databases.items(), Shard(index=index, count=4))) for index in range(4)]
+
+    assert all(60 < len(shard) < 140 for shard in shards)
+    assert sum("main" in shard for shard in shards) == 1
+
+
+def test_shard_contains_its_databases() -> None:
+    """Test that a database is in the shard it is assigned to, and in no other."""
+    shards = [Shard(index=index, count=4) for index in range(4)]
+
+    assert [shard.index for shard in shards if "tenant_0" in shard] == [get_shard_index("tenant_0", 4)]
+
+
+@pytest.mark.parametrize("index,count", [(2, 2), (-1, 2), (0, 0)])
+def test_invalid_shard(index: int, count: int) -> None:
+    """Test that shards outside of the shard count are rejected."""
+    with pytest.raises(ValueError):
+        Shard(index=index, count=count)
+
+
+@pytest.mark.parametrize("indexes,expected", [(None, set()), ("", set()), ("1", {1}), ("1,3-5,7", {1, 3, 4, 5, 7})])
+def test_parse_indexes(indexes: str | None, expected: set[int]) -> None:
+    """Test the parsing of the completed and failed indexes of a Job status."""
+    assert parse_indexes(indexes) == expected
+
+
+def _job(completed_indexes: str | None = None, failed_indexes: str | None = None) -> MagicMock:
+    job = MagicMock()
+    job.status.completed_indexes = completed_indexes
+    job.status.failed_indexes = failed_indexes
+    job.status.conditions = None
+    return job
+
+
+def test_wait_for_shards(mocker: MockerFixture) -> None:
+    """Test that the coordinator waits until every other shard completed."""
+    mocker.patch("chartreuse.sharding.SHARD_POLL_INTERVAL", 0)
+    kubernetes_helper = MagicMock()
+    kubernetes_helper.client_batchv1_api.read_namespaced_job.side_effect = [_job("1"), _job("1-2")]
+
+    wait_for_shards(kubernetes_helper, "chartreuse", Shard(index=0, count=3), timeout=5)
+
+    assert kubernetes_helper.client_batchv1_api.read_namespaced_job.call_count == 2
+
+
+def test_wait_for_failed_shard() -> None:
+    """Test that the coordinator stops waiting as soon as another shard failed."""
+    kubernetes_helper = MagicMock()
+    kubernetes_helper.client_batchv1_api.read_namespaced_job.return_value = _job("1", failed_indexes="2")
+
+    with pytest.raises(ShardFailedError, match=r"\[2\]"):
+        wait_for_shards(kubernetes_helper, "chartreuse", Shard(index=0, count=3), timeout=5)
+
+
+def test_wait_for_shards_timeout() -> None:
+    """Test that the coordinator gives up when the other shards are still running at the timeout."""
+    kubernetes_helper = MagicMock()
+    kubernetes_helper.client_batchv1_api.read_namespaced_job.return_value = _job()
+
+    with pytest.raises(ShardFailedError, match="still not done"):
+        wait_for_shards(kubernetes_helper, "chartreuse", Shard(index=0, count=2), timeout=0)
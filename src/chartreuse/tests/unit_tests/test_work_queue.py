@@ -0,0 +1,201 @@
+"""Unit tests for the work queue of the databases, on SQLite (which ignores FOR UPDATE SKIP LOCKED)."""
+
+import datetime
+import os
+import tempfile
+import threading
+from collections.abc import Iterable, Iterator
+from unittest.mock import MagicMock
+
+import pytest
+import sqlalchemy
+from pytest_mock.plugin import MockerFixture
+
+from chartreuse.work_queue import WorkQueue, WorkQueueError, process_work_queue, work_queue_table
+
+
+@pytest.fixture
+def engine() -> Iterator[sqlalchemy.Engine]:
+    with tempfile.TemporaryDirectory() as temp_dir:
+        engine = sqlalchemy.create_engine(f"sqlite:///{os.path.join(temp_dir, 'queue.db')}")
+        yield engine
+        engine.dispose()
+
+
+def _queue(engine: sqlalchemy.Engine, worker: str = "worker-0", **kwargs: object) -> WorkQueue:
+    queue = WorkQueue(engine, run_id="42", worker=worker, **kwargs)  # type: ignore[arg-type]
+    queue.create()
+    return queue
+
+
+def _enqueue(queue: WorkQueue, databases: list[str], dependencies: dict[str, list[str]] | None = None) -> None:
+    queue.enqueue((database, (dependencies or {}).get(database, [])) for database in databases)
+
+
+def _chartreuse(*batches: dict[str, list[str]]) -> MagicMock:
+    """A Chartreuse going over the databases by batches, the first one being its databases_config."""
+    chartreuse = MagicMock()
+    configs = [
+        {database: MagicMock(depends_on=depends_on) for database, depends_on in batch.items()} for batch in batches
+    ]
+    chartreuse.databases_config = configs[0]
+    chartreuse.iter_database_batches.side_effect = lambda: iter(configs)
+    return chartreuse
+
+
+def _expire_leases(engine: sqlalchemy.Engine) -> None:
+    with engine.begin() as connection:
+        connection.execute(
+            work_queue_table.update().values(
+                lease_expires_at=datetime.datetime.now(tz=datetime.UTC) - datetime.timedelta(seconds=1)
+            )
+        )
+
+
+def test_claim_each_database_once(engine: sqlalchemy.Engine) -> None:
+    """Test that workers claim each database once, the queue being drained once every database completed."""
+    queue = _queue(engine)
+    _enqueue(queue, ["b", "a"])
+    # Enqueuing again, e.g. from another worker, is a no-op
+    _enqueue(_queue(engine, worker="worker-1"), ["a", "b"])
+
+    assert queue.claim() == "a"
+    assert _queue(engine, worker="worker-1").claim() == "b"
+    assert queue.claim() is None
+    assert not queue.is_drained()
+
+    queue.complete("a", "upgraded")
+    _queue(engine, worker="worker-1").complete("b", "up_to_date")
+
+    assert queue.get_statuses() == {"a": "upgraded", "b": "up_to_date"}
+    assert queue.is_drained()
+
+
+def test_expired_lease_is_claimed_again(engine: sqlalchemy.Engine) -> None:
+    """Test that the database of a crashed worker is claimed again once its lease expired."""
+    crashed = _queue(engine, worker="crashed")
+    _enqueue(crashed, ["a"])
+    assert crashed.claim() == "a"
+    _expire_leases(engine)
+
+    queue = _queue(engine)
+    assert queue.claim() == "a"
+
+    # The crashed worker lost its lease: its result is ignored
+    assert not crashed.renew_lease("a")
+    crashed.complete("a", "failed", "boom")
+    assert queue.renew_lease("a")
+    assert queue.get_statuses() == {"a": "claimed"}
+
+
+def test_database_failed_after_max_attempts(engine: sqlalchemy.Engine) -> None:
+    """Test that a database whose workers keep crashing is failed after max_attempts claims."""
+    queue = _queue(engine, max_attempts=2)
+    _enqueue(queue, ["a"])
+    for _ in range(2):
+        assert queue.claim() == "a"
+        _expire_leases(engine)
+
+    assert queue.claim() is None
+    assert queue.get_statuses() == {"a": "failed"}
+
+
+def test_dependencies(engine: sqlalchemy.Engine) -> None:
+    """Test that databases are only claimed once their dependencies succeeded, and not upgraded if they failed."""
+    queue = _queue(engine)
+    _enqueue(queue, ["a", "b", "c", "d"], dependencies={"b": ["a"], "c": ["a"], "d": ["b"]})
+
+    assert queue.claim() == "a"
+    assert queue.claim() is None
+    queue.complete("a", "upgraded")
+    assert queue.claim() == "b"
+    queue.complete("b", "failed", "boom")
+    assert queue.claim() == "c"
+    queue.complete("c", "up_to_date")
+
+    assert queue.claim() is None
+    assert queue.get_statuses() == {"a": "upgraded", "b": "failed", "c": "up_to_date", "d": "not_upgraded"}
+
+
+def test_claim_reads_claimable_databases_by_batches(engine: sqlalchemy.Engine, mocker: MockerFixture) -> None:
+    """Test that a database is claimed past a batch of claimable databases all waiting for their dependencies."""
+    mocker.patch("chartreuse.work_queue.CLAIM_BATCH_SIZE", 2)
+    queue = _queue(engine)
+    _enqueue(queue, ["a", "b", "c", "d", "e"], dependencies={"a": ["e"], "b": ["e"]})
+
+    assert [queue.claim() for _ in range(4)] == ["c", "d", "e", None]
+    queue.complete("e", "upgraded")
+    assert [queue.claim() for _ in range(3)] == ["a", "b", None]
+
+
+def test_claim_among_databases(engine: sqlalchemy.Engine) -> None:
+    """Test that a worker only claims the given databases, e.g. the ones of its current batch."""
+    queue = _queue(engine)
+    _enqueue(queue, ["a", "b", "c"])
+
+    assert queue.claim({"b", "c"}) == "b"
+    assert queue.claim({"b"}) is None
+    assert not queue.has_claimable({"b"})
+    assert queue.has_claimable({"a", "b"})
+
+
+def test_process_work_queue(engine: sqlalchemy.Engine, mocker: MockerFixture) -> None:
+    """Test that workers check and upgrade the databases they claim until the queue is drained."""
+    mocker.patch("chartreuse.work_queue.WORK_QUEUE_POLL_INTERVAL", 0)
+    queue = _queue(engine)
+    chartreuse = _chartreuse({"a": []}, {"b": ["a"]}, {"c": []})
+    chartreuse.is_database_migration_needed.side_effect = lambda database: database != "c"
+    before_upgrade = MagicMock()
+
+    process_work_queue(queue, chartreuse, concurrency=2, before_upgrade=before_upgrade)
+
+    assert queue.get_statuses() == {"a": "upgraded", "b": "upgraded", "c": "up_to_date"}
+    assert sorted(call.args[0] for call in chartreuse.upgrade_database.call_args_list) == ["a", "b"]
+    assert sorted(call.args[0] for call in before_upgrade.call_args_list) == ["a", "b"]
+
+
+def test_process_work_queue_by_batches(engine: sqlalchemy.Engine, mocker: MockerFixture) -> None:
+    """Test that the databases of a batch are queued and drained before the next batch is queued."""
+    queue = _queue(engine)
+    chartreuse = _chartreuse({"a": []}, {"b": ["a"], "c": []}, {"d": ["a"]})
+    queued: list[list[str]] = []
+    enqueue = queue.enqueue
+
+    def record_enqueue(databases: Iterable[tuple[str, list[str]]]) -> None:
+        databases = list(databases)
+        queued.append([database for database, _ in databases])
+        # The databases of the previous batches were all claimed and completed
+        assert set(queue.get_statuses().values()) <= {"upgraded"}
+        enqueue(databases)
+
+    mocker.patch.object(queue, "enqueue", side_effect=record_enqueue)
+
+    process_work_queue(queue, chartreuse, concurrency=2)
+
+    assert queued == [["a"], ["b", "c"], ["d"]]
+    assert queue.get_statuses() == {"a": "upgraded", "b": "upgraded", "c": "upgraded", "d": "upgraded"}
+
+
+def test_process_work_queue_failure(engine: sqlalchemy.Engine) -> None:
+    """Test that workers raise once the queue is drained when a database failed."""
+    queue = _queue(engine)
+    chartreuse = _chartreuse({"a": [], "b": []})
+    chartreuse.upgrade_database.side_effect = lambda database: database == "a" and 1 / 0
+
+    with pytest.raises(WorkQueueError, match="Failed to upgrade database\\(s\\): a"):
+        process_work_queue(queue, chartreuse, concurrency=1)
+
+    assert queue.get_statuses() == {"a": "failed", "b": "upgraded"}
+
+
+def test_lease_is_renewed_while_working(engine: sqlalchemy.Engine, mocker: MockerFixture) -> None:
+    """Test that the lease of the database being worked on is renewed in the background."""
+    queue = _queue(engine, lease_duration=0.03)
+    _enqueue(queue, ["a"])
+    assert queue.claim() == "a"
+    renewed = threading.Event()
+    renew_lease = queue.renew_lease
+    mocker.patch.object(queue, "renew_lease", side_effect=lambda database: renewed.set() or renew_lease(database))
+
+    with queue.hold_lease("a"):
+        assert renewed.wait(5)
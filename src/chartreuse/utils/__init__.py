@@ -1 +1,36 @@
-from .alembic_migration_helper import AlembicMigrationHelper  # noqa: F401
+"""
+The helpers are imported on first use: they pull SQLAlchemy and alembic, which most runs only need once they
+know there is a database to check.
+"""
+
+import importlib
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from .alembic_migration_helper import AlembicMigrationHelper, MigrationPlan
+    from .engine_registry import dispose_engines, get_engine
+    from .phase_timer import time_phase, write_phase_report
+
+_EXPORTS = {
+    "AlembicMigrationHelper": ".alembic_migration_helper",
+    "MigrationPlan": ".alembic_migration_helper",
+    "dispose_engines": ".engine_registry",
+    "get_engine": ".engine_registry",
+    "time_phase": ".phase_timer",
+    "write_phase_report": ".phase_timer",
+}
+
+__all__ = [
+    "AlembicMigrationHelper",
+    "MigrationPlan",
+    "dispose_engines",
+    "get_engine",
+    "time_phase",
+    "write_phase_report",
+]
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(_EXPORTS[name], __name__), name)
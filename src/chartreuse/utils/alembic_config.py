@@ -0,0 +1,51 @@
+import os
+from argparse import Namespace
+
+from alembic.config import Config
+
+from .alembic_migration_helper import copy_template_section
+
+
+def _absolute_paths(alembic_directory_path: str, paths: list[str]) -> str:
+    return os.pathsep.join(os.path.join(alembic_directory_path, path) for path in paths)
+
+
+def build_alembic_config(
+    *,
+    alembic_directory_path: str,
+    alembic_config_file_path: str,
+    alembic_section_name: str,
+    alembic_template_section_name: str | None = None,
+    database_url: str | None = None,
+    x_arguments: list[str] | None = None,
+) -> Config:
+    """
+    Build an in-memory alembic Config for a section, as `alembic -c ... -n ...` would see it
+    when run from the alembic directory.
+    With a template section, the section is a copy of it made in memory: the file is left untouched.
+    """
+    config = Config(
+        file_=os.path.join(alembic_directory_path, alembic_config_file_path),
+        ini_section=alembic_section_name,
+        cmd_opts=Namespace(x=x_arguments or []),
+    )
+    if alembic_template_section_name:
+        copy_template_section(config.file_config, alembic_template_section_name, alembic_section_name)
+
+    # Relative paths are resolved by alembic against the current working directory,
+    # which is the alembic directory when we spawn the alembic CLI.
+    script_location = config.get_main_option("script_location")
+    if script_location and ":" not in script_location and not os.path.isabs(script_location):
+        config.set_main_option("script_location", os.path.join(alembic_directory_path, script_location))
+    prepend_sys_path = config.get_prepend_sys_paths_list()
+    version_locations = config.get_version_locations_list()
+    config.set_main_option("path_separator", "os")
+    if prepend_sys_path:
+        config.set_main_option("prepend_sys_path", _absolute_paths(alembic_directory_path, prepend_sys_path))
+    if version_locations:
+        config.set_main_option("version_locations", _absolute_paths(alembic_directory_path, version_locations))
+
+    if database_url is not None:
+        # ConfigParser interpolation: a raw "%" (e.g. in a password) must be escaped
+        config.set_main_option("sqlalchemy.url", database_url.replace("%", "%%"))
+    return config
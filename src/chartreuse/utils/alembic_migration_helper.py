@@ -1,14 +1,170 @@
+import asyncio
+import itertools
 import logging
+import os
+import random
 import re
+import shlex
+import tempfile
+import threading
+import time
+from collections.abc import Awaitable, Callable, Iterator, Sequence
 from configparser import ConfigParser
-from subprocess import SubprocessError
+from contextlib import contextmanager
+from dataclasses import dataclass
+from graphlib import TopologicalSorter
+from subprocess import CalledProcessError, SubprocessError
+from typing import TYPE_CHECKING, Any, Literal
 
 import sqlalchemy
 from sqlalchemy import inspect
-from wiremind_kubernetes.utils import run_command
+
+from .alembic_output import LOCK_TIMEOUT_RE, AlembicOutputWatcher, RevisionProgress, log_revision_progress
+from .command_runner import run_command, run_command_async
+from .engine_registry import get_engine
+from .migration_history import MIGRATION_HISTORY_TABLE, AppliedRevision, record_migration_history
+from .phase_timer import time_phase
+from .readiness import wait_until_ready
+from .replication_throttle import DEFAULT_THROTTLE_TIMEOUT, wait_for_replication
+
+if TYPE_CHECKING:
+    from alembic.config import Config
+    from alembic.runtime.migration import MigrationContext, MigrationInfo
+
+    from .forkserver_pool import WorkerOperation
 
 logger = logging.getLogger(__name__)
 
+# "subprocess" spawns `alembic current`, "inprocess" reads alembic_version and the script heads directly,
+# "forkserver" does it in a worker forked from the forkserver
+CheckMode = Literal["subprocess", "inprocess", "forkserver"]
+# "subprocess" spawns `alembic upgrade head`, "inprocess" runs the upgrade (and env.py) in the Chartreuse process,
+# "forkserver" in a worker forked from the forkserver
+UpgradeEngine = Literal["subprocess", "inprocess", "forkserver"]
+
+
+ALEMBIC_VERSION_TABLE = "alembic_version"
+
+# Tables of alembic and Chartreuse, which don't make a database populated
+BOOKKEEPING_TABLES = (ALEMBIC_VERSION_TABLE, MIGRATION_HISTORY_TABLE)
+_BOOKKEEPING_TABLES_SQL = ", ".join(f"'{table}'" for table in BOOKKEEPING_TABLES)
+
+# Per dialect, a query returning a row as soon as a table other than the bookkeeping tables exists in the current
+# schema, so that the cost of the emptiness check does not depend on the number of tables.
+USER_TABLE_QUERIES: dict[str, str] = {
+    "postgresql": f"""
+        SELECT 1 FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = current_schema() AND c.relkind IN ('r', 'p')
+        AND c.relname NOT IN ({_BOOKKEEPING_TABLES_SQL})
+        LIMIT 1
+    """,
+    "clickhouse": f"""
+        SELECT 1 FROM system.tables
+        WHERE database = currentDatabase() AND name NOT IN ({_BOOKKEEPING_TABLES_SQL})
+        LIMIT 1
+    """,
+    "mysql": f"""
+        SELECT 1 FROM information_schema.tables
+        WHERE table_schema = DATABASE() AND table_type = 'BASE TABLE'
+        AND table_name NOT IN ({_BOOKKEEPING_TABLES_SQL})
+        LIMIT 1
+    """,
+    "sqlite": f"""
+        SELECT 1 FROM sqlite_master
+        WHERE type = 'table' AND name NOT IN ({_BOOKKEEPING_TABLES_SQL}) AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\'
+        LIMIT 1
+    """,
+}
+
+
+# Backoff between the attempts of an upgrade failing on a lock timeout, in seconds
+LOCK_RETRY_BASE_DELAY = 1.0
+LOCK_RETRY_MAX_DELAY = 30.0
+
+
+def _is_lock_timeout(error: BaseException) -> bool:
+    """Whether the error, or one of the errors it was raised from, is a lock timeout."""
+    current: BaseException | None = error
+    while current is not None:
+        if LOCK_TIMEOUT_RE.search(str(current)):
+            return True
+        current = current.__cause__ or current.__context__
+    return False
+
+
+# PostgreSQL drivers based on libpq, which take the `options` of the session at connection time like PGOPTIONS
+LIBPQ_DRIVERS = ("psycopg2", "psycopg")
+
+
+@contextmanager
+def _apply_session_settings_to_new_connections(
+    settings: dict[str, str], shared_engine: sqlalchemy.Engine
+) -> Iterator[None]:
+    """
+    Apply the PostgreSQL session settings to the connections the current thread opens meanwhile with another engine
+    than the shared one, e.g. the ones of an env.py creating its own engine instead of using the shared connection.
+    """
+    if not settings:
+        yield
+        return
+    thread_id = threading.get_ident()
+    options = " ".join(f"-c {name}={value}" for name, value in settings.items())
+
+    def add_options(dialect: Any, connection_record: Any, cargs: Any, cparams: dict[str, Any]) -> None:
+        # Every engine has its own dialect. The pooled connections of the shared engine outlive the upgrade.
+        if threading.get_ident() != thread_id or dialect is shared_engine.dialect or dialect.name != "postgresql":
+            return
+        if dialect.driver not in LIBPQ_DRIVERS:
+            logger.warning(
+                "Can't set %s on connections of the %s driver, env.py runs without them.", options, dialect.driver
+            )
+            return
+        cparams["options"] = f"{cparams.get('options', '')} {options}".strip()
+
+    sqlalchemy.event.listen(sqlalchemy.engine.Engine, "do_connect", add_options)
+    try:
+        yield
+    finally:
+        sqlalchemy.event.remove(sqlalchemy.engine.Engine, "do_connect", add_options)
+
+
+# alembic.context and alembic.op are module-level proxies to the running migration:
+# in-process upgrades must not run concurrently, even on different databases.
+_in_process_upgrade_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class MigrationPlan:
+    """What an upgrade would do to a database: the revisions it would apply, oldest first."""
+
+    current_revisions: tuple[str, ...]
+    head_revisions: tuple[str, ...]
+    pending_revisions: tuple[str, ...]
+    # The database is empty and allow_migration_for_empty_database is false: it would not be upgraded
+    skipped_empty_database: bool = False
+
+
+def copy_template_section(config: ConfigParser, template_section_name: str, section_name: str) -> None:
+    """(Re)create a section of a parsed alembic.ini from its template section."""
+    if not config.has_section(template_section_name):
+        raise ValueError(f"Section '{template_section_name}' not found in alembic.ini")
+    config.remove_section(section_name)
+    config.add_section(section_name)
+    for key, value in config.items(template_section_name, raw=True):
+        config.set(section_name, key, value)
+
+
+def _get_ancestors(revision_graph: dict[str, list[str]], revisions: set[str]) -> set[str]:
+    """The given revisions and all the revisions they (indirectly) revise."""
+    ancestors: set[str] = set()
+    to_visit = list(revisions)
+    while to_visit:
+        revision = to_visit.pop()
+        if revision not in ancestors:
+            ancestors.add(revision)
+            to_visit.extend(revision_graph[revision])
+    return ancestors
+
 
 class AlembicMigrationHelper:
     def __init__(
@@ -18,8 +174,19 @@ class AlembicMigrationHelper:
         alembic_config_file_path: str = "alembic.ini",
         database_url: str,
         alembic_section_name: str,
+        alembic_template_section_name: str | None = None,
         additional_parameters: str = "",
         allow_migration_for_empty_database: bool = False,
+        check_mode: CheckMode = "subprocess",
+        upgrade_engine: UpgradeEngine = "subprocess",
+        record_migration_history: bool = True,
+        lock_timeout: float | None = None,
+        statement_timeout: float | None = None,
+        lock_retry_deadline: float = 0,
+        max_replication_lag: float | None = None,
+        replication_throttle_timeout: float = DEFAULT_THROTTLE_TIMEOUT,
+        on_revision_progress: Callable[[RevisionProgress], None] | None = log_revision_progress,
+        preload_modules: Sequence[str] = (),
         configure: bool = True,
         # skip_db_checks is used for testing purposes only
         skip_db_checks: bool = False,
@@ -33,22 +200,88 @@ class AlembicMigrationHelper:
         self.alembic_directory_path = alembic_directory_path
         self.alembic_config_file_path = alembic_config_file_path
         self.alembic_section_name = alembic_section_name
+        # Section alembic_section_name is (re)created from, for databases sharing one migration tree
+        self.alembic_template_section_name = alembic_template_section_name
+        self.check_mode = check_mode
+        self.upgrade_engine = upgrade_engine
+        self.record_migration_history = record_migration_history
+        # Timeouts of the statements of the upgrade in seconds (PostgreSQL only), and for how long an upgrade failing
+        # on a lock timeout is retried
+        self.lock_timeout = lock_timeout
+        self.statement_timeout = statement_timeout
+        self.lock_retry_deadline = lock_retry_deadline
+        # Maximum replication lag before and between the revisions of the upgrade, and for how long to wait for it
+        self.max_replication_lag = max_replication_lag
+        self.replication_throttle_timeout = replication_throttle_timeout
+        # Called when each revision of an upgrade starts
+        self.on_revision_progress = on_revision_progress
+        # Modules imported once by the forkserver, before it forks the workers of the forkserver engine
+        self.preload_modules = tuple(preload_modules)
+        self.applied_revisions: list[AppliedRevision] = []
         self.skip_db_checks = skip_db_checks
 
+        # The check is run lazily, possibly from a worker thread, and only once
+        self._is_migration_needed: bool | None = None
+        self._check_lock = threading.Lock()
+        self._is_ready = False
+        self._readiness_lock = threading.Lock()
+
         if configure:
             self._configure()
-        # skip_db_checks is used for testing purposes only
-        if not skip_db_checks:
-            self.is_migration_needed = self._check_migration_needed()
-        else:
-            self.is_migration_needed = False
+        if "forkserver" in (check_mode, upgrade_engine):
+            from .forkserver_pool import register_preload_modules, register_preload_script_directory
 
-    def _configure(self) -> None:
-        config_path = f"{self.alembic_directory_path}/{self.alembic_config_file_path}"
+            register_preload_modules(self.preload_modules)
+            register_preload_script_directory(
+                self.alembic_directory_path,
+                self.alembic_config_file_path,
+                self.alembic_template_section_name or self.alembic_section_name,
+            )
+
+    @property
+    def is_migration_needed(self) -> bool:
+        with self._check_lock:
+            if self._is_migration_needed is None:
+                # skip_db_checks is used for testing purposes only
+                self._is_migration_needed = False if self.skip_db_checks else self._check_migration_needed()
+            return self._is_migration_needed
+
+    def recheck_migration_needed(self) -> bool:
+        """Check again whether the database needs migration, e.g. while another shard upgrades it."""
+        with self._check_lock:
+            self._is_migration_needed = False if self.skip_db_checks else self._check_migration_needed()
+            return self._is_migration_needed
 
-        # Read the configuration file
+    def wait_until_ready(self, deadline: float, patroni_postgresql: bool = False) -> None:
+        """Wait until the database is ready to be checked, up to the deadline (a time.monotonic() timestamp)."""
+        with self._readiness_lock:
+            if self._is_ready or self.skip_db_checks:
+                return
+            with time_phase("readiness", self.alembic_section_name):
+                wait_until_ready(
+                    get_engine(self.database_url),
+                    deadline,
+                    patroni_postgresql=patroni_postgresql,
+                    database=self.alembic_section_name,
+                )
+            self._is_ready = True
+
+    def _read_config_file(self) -> ConfigParser:
         config = ConfigParser()
-        config.read(config_path)
+        config.read(os.path.join(self.alembic_directory_path, self.alembic_config_file_path))
+        return config
+
+    def _configure(self) -> None:
+        config = self._read_config_file()
+
+        if self.alembic_template_section_name:
+            # The section is copied from the template in memory when the database is checked or upgraded: rewriting
+            # the shared alembic.ini for each of them would be slow on large fleets, and leave their credentials on disk
+            if not config.has_section(self.alembic_template_section_name):
+                raise ValueError(
+                    f"Section '{self.alembic_template_section_name}' not found in {self.alembic_config_file_path}"
+                )
+            return
 
         # Multi-database configuration: update specific section
         if not config.has_section(self.alembic_section_name):
@@ -58,49 +291,512 @@ class AlembicMigrationHelper:
         config.set(self.alembic_section_name, "sqlalchemy.url", self.database_url)
 
         # Write the updated configuration back to the file
-        with open(config_path, "w") as f:
+        with open(os.path.join(self.alembic_directory_path, self.alembic_config_file_path), "w") as f:
             config.write(f)
 
         logger.info("alembic.ini was configured for section %s.", self.alembic_section_name)
 
-    def _get_table_list(self) -> list[str]:
-        return inspect(sqlalchemy.create_engine(self.database_url)).get_table_names()
+    @contextmanager
+    def _subprocess_config_file(self) -> Iterator[str]:
+        """
+        The configuration file of the `alembic` subprocesses, relative to the alembic directory. A database whose
+        section is copied from a template gets its own temporary copy of alembic.ini, readable by the owner only and
+        removed once the subprocess is done.
+        """
+        if not self.alembic_template_section_name:
+            yield self.alembic_config_file_path
+            return
+
+        config = self._read_config_file()
+        copy_template_section(config, self.alembic_template_section_name, self.alembic_section_name)
+        # ConfigParser interpolation: a raw "%" (e.g. in a password) must be escaped
+        config.set(self.alembic_section_name, "sqlalchemy.url", self.database_url.replace("%", "%%"))
+        # Next to alembic.ini, so that %(here)s and relative paths are unchanged
+        fd, path = tempfile.mkstemp(prefix=".chartreuse-", suffix=".ini", dir=self.alembic_directory_path)
+        try:
+            with os.fdopen(fd, "w") as f:
+                config.write(f)
+            yield os.path.basename(path)
+        finally:
+            os.remove(path)
+
+    def _has_user_table(self) -> bool:
+        """Whether the database has a table other than alembic_version, without listing all of its tables."""
+        with time_phase("connect", self.alembic_section_name):
+            connection = get_engine(self.database_url).connect()
+        with connection, time_phase("emptiness_check", self.alembic_section_name):
+            query = USER_TABLE_QUERIES.get(connection.dialect.name)
+            if query is None:
+                # No catalog query for this dialect, fall back to reflection
+                return any(name not in BOOKKEEPING_TABLES for name in inspect(connection).get_table_names())
+            return connection.execute(sqlalchemy.text(query)).first() is not None
 
     def is_postgres_empty(self) -> bool:
-        table_list = self._get_table_list()
-        logger.info("Tables in the database: %s", table_list)
         # Don't count "alembic" table
-        table_name = "alembic_version"
-        if table_name in table_list:
-            table_list.remove(table_name)
-        if table_list:
-            return False
-        return True
+        is_empty = not self._has_user_table()
+        if is_empty:
+            logger.info("The database has no table besides %s.", ", ".join(BOOKKEEPING_TABLES))
+        return is_empty
 
     def _get_alembic_current(self) -> str:
-        command: str = f"alembic -c {self.alembic_config_file_path} {self.additional_parameters} current"
-        alembic_current, stderr, returncode = run_command(command, return_result=True, cwd=self.alembic_directory_path)
-        if returncode != 0:
-            raise SubprocessError(f"{command} has failed: {alembic_current}, {stderr}")
-        return alembic_current
+        """The last lines of the output of `alembic current`, where the current revisions are."""
+        watcher = AlembicOutputWatcher(self.alembic_section_name, on_revision_progress=None, log_level=logging.DEBUG)
+        with self._subprocess_config_file() as config_file_path:
+            command: str = f"alembic -c {config_file_path} {self.additional_parameters} current"
+            try:
+                run_command(command, line_callback=watcher, cwd=self.alembic_directory_path)
+            except CalledProcessError as e:
+                raise SubprocessError(f"{command} has failed: {watcher.output_tail}") from e
+        return watcher.output_tail
+
+    def _get_alembic_config(self) -> "Config":
+        # alembic is only imported by the in-process checks and upgrades, `alembic` subprocesses don't need it here
+        from .alembic_config import build_alembic_config
+
+        return build_alembic_config(
+            alembic_directory_path=self.alembic_directory_path,
+            alembic_config_file_path=self.alembic_config_file_path,
+            alembic_section_name=self.alembic_section_name,
+            alembic_template_section_name=self.alembic_template_section_name,
+            database_url=self.database_url,
+            x_arguments=self._get_x_arguments(),
+        )
+
+    def _get_x_arguments(self) -> list[str]:
+        """Extract the `-x key=value` arguments from additional_parameters, for context.get_x_argument()."""
+        x_arguments: list[str] = []
+        arguments = shlex.split(self.additional_parameters)
+        for index, argument in enumerate(arguments):
+            if argument == "-x" and index + 1 < len(arguments):
+                x_arguments.append(arguments[index + 1])
+            elif argument.startswith("-x") and len(argument) > 2:
+                x_arguments.append(argument[2:])
+        return x_arguments
+
+    def _get_manifest_section(self, config: "Config") -> dict[str, Any] | None:
+        from .script_directory_cache import get_manifest_section
+
+        return get_manifest_section(
+            self.alembic_directory_path, config, section_name=self.alembic_template_section_name
+        )
+
+    def _get_script_heads(self) -> set[str]:
+        from .script_directory_cache import get_script_heads
+
+        config = self._get_alembic_config()
+        manifest_section = self._get_manifest_section(config)
+        if manifest_section is not None:
+            return set(manifest_section["heads"])
+        return set(get_script_heads(config))
+
+    def _get_revision_graph(self) -> tuple[set[str], dict[str, list[str]]]:
+        """The script heads, and the down revisions of every revision."""
+        from alembic import util
+
+        from .script_directory_cache import get_script_directory, get_script_heads
+
+        config = self._get_alembic_config()
+        manifest_section = self._get_manifest_section(config)
+        if manifest_section is not None:
+            return set(manifest_section["heads"]), manifest_section["revisions"]
+        revision_graph = {
+            revision.revision: list(util.to_tuple(revision.down_revision, default=()))
+            for revision in get_script_directory(config).walk_revisions()
+        }
+        return set(get_script_heads(config)), revision_graph
+
+    def _get_current_heads(self) -> set[str]:
+        from alembic.runtime.migration import MigrationContext
+
+        with get_engine(self.database_url).connect() as connection:
+            return set(MigrationContext.configure(connection).get_current_heads())
+
+    def _is_at_head(self) -> bool:
+        with time_phase("current", self.alembic_section_name):
+            return self._compare_current_to_head()
+
+    def _compare_current_to_head(self) -> bool:
+        if self.check_mode == "inprocess":
+            current_heads = self._get_current_heads()
+            script_heads = self._get_script_heads()
+            logger.info("Current revision(s): %s, head revision(s): %s", current_heads, script_heads)
+            return current_heads == script_heads
+
+        head_re = re.compile(r"^\w+ \(head\)$", re.MULTILINE)
+        alembic_current = self._get_alembic_current()
+        return bool(head_re.search(alembic_current))
 
     def _check_migration_needed(self) -> bool:
+        if self.check_mode == "forkserver":
+            is_migration_needed, _ = self._run_in_worker("check")
+            return is_migration_needed
+
         if self.is_postgres_empty() and not self.allow_migration_for_empty_database:
             logger.info("Database is not populated yet but migration for empty database is forbidden, not upgrading.")
             return False
 
-        head_re = re.compile(r"^\w+ \(head\)$", re.MULTILINE)
-        alembic_current = self._get_alembic_current()
-        if head_re.search(alembic_current):
+        if self._is_at_head():
             logger.info("SQL database schema does not need upgrade.")
             return False
         logger.info("SQL database schema can be upgraded.")
         return True
 
+    def prepare_upgrade(self) -> None:
+        """
+        Load ahead of the upgrade what an in-process upgrade needs: the revisions of the script directory and a
+        pooled connection to the database. Subprocess upgrades load them in the alembic process.
+        """
+        if self.upgrade_engine != "inprocess":
+            return
+        from .script_directory_cache import get_script_directory
+
+        with time_phase("prepare", self.alembic_section_name):
+            get_script_directory(self._get_alembic_config())
+            with get_engine(self.database_url).connect():
+                pass
+
+    def get_migration_plan(self) -> MigrationPlan:
+        """
+        Compute the revisions an upgrade would apply, without applying them, whatever the check mode.
+        """
+        with time_phase("plan", self.alembic_section_name):
+            if self.is_postgres_empty() and not self.allow_migration_for_empty_database:
+                return MigrationPlan(
+                    current_revisions=(), head_revisions=(), pending_revisions=(), skipped_empty_database=True
+                )
+
+            current_revisions = self._get_current_heads()
+            head_revisions, revision_graph = self._get_revision_graph()
+            unknown_revisions = current_revisions - revision_graph.keys()
+            if unknown_revisions:
+                raise ValueError(f"Current revision(s) not found in the migration scripts: {unknown_revisions}")
+
+            pending = _get_ancestors(revision_graph, head_revisions) - _get_ancestors(revision_graph, current_revisions)
+            sorter = TopologicalSorter({revision: revision_graph[revision] for revision in pending})
+            return MigrationPlan(
+                current_revisions=tuple(sorted(current_revisions)),
+                head_revisions=tuple(sorted(head_revisions)),
+                pending_revisions=tuple(revision for revision in sorter.static_order() if revision in pending),
+            )
+
+    def _upgrade_db_in_process(self) -> None:
+        """
+        Equivalent of alembic.command.upgrade(config, "head"), recording each applied revision and its duration.
+        """
+        from alembic import util
+        from alembic.runtime.environment import EnvironmentContext
+
+        from .script_directory_cache import get_script_directory
+
+        config = self._get_alembic_config()
+        script = get_script_directory(config)
+        # (revision, down revisions) of each step of the upgrade, the first one not applied yet being the running one
+        steps: list[tuple[str, tuple[str, ...]]] = []
+        step_started_at = time.monotonic()
+        step_started_at_timestamp = time.time()
+        started_steps = 0
+
+        def start_step() -> None:
+            nonlocal step_started_at, step_started_at_timestamp, started_steps
+            step_started_at = time.monotonic()
+            step_started_at_timestamp = time.time()
+            if started_steps < len(steps) and self.on_revision_progress is not None:
+                revision, down_revisions = steps[started_steps]
+                self.on_revision_progress(
+                    RevisionProgress(
+                        database=self.alembic_section_name,
+                        revision=revision,
+                        down_revisions=down_revisions,
+                        position=started_steps + 1,
+                        total=len(steps),
+                    )
+                )
+            started_steps += 1
+
+        def upgrade(revision: Any, context: "MigrationContext") -> Iterator[Any]:
+            revision_steps = script._upgrade_revs("head", revision)
+            steps.extend((step.revision.revision, tuple(step.from_revisions_no_deps)) for step in revision_steps)
+            # Alembic asks for the next step once the previous one is done, out of the transaction of the step when
+            # each revision is committed on its own (transaction_per_migration)
+            for position, revision_step in enumerate(revision_steps):
+                if position and not context.connection.in_transaction():  # type: ignore[union-attr]
+                    # Pausing within a transaction would hold its locks, without the replicas receiving anything
+                    self._throttle_replication()
+                start_step()
+                yield revision_step
+
+        def report_version_apply(*, step: "MigrationInfo", **kwargs: Any) -> None:
+            applied_revision = AppliedRevision(
+                revision=step.up_revision_id or "",
+                down_revisions=step.down_revision_ids,
+                started_at=step_started_at_timestamp,
+                duration=time.monotonic() - step_started_at,
+            )
+            self.applied_revisions.append(applied_revision)
+            logger.info("Applied revision %s in %.2fs.", applied_revision.revision, applied_revision.duration)
+
+        environment_context = EnvironmentContext(config, script, fn=upgrade, destination_rev="head")
+        configure = environment_context.configure
+
+        # configure() replaces the on_version_apply callbacks with the ones env.py passes: add ours to them.
+        # The instance attribute is what the alembic.context proxy exposes to env.py.
+        def configure_with_reporting(*args: Any, on_version_apply: Any = None, **kwargs: Any) -> None:
+            callbacks = (*util.to_tuple(on_version_apply, default=()), report_version_apply)
+            configure(*args, on_version_apply=callbacks, **kwargs)
+
+        environment_context.configure = configure_with_reporting  # type: ignore[method-assign]
+        applied_before = len(self.applied_revisions)
+        session_settings = self._get_session_settings()
+        engine = get_engine(self.database_url)
+        try:
+            # Share our connection with env.py, which may use it instead of creating its own engine:
+            # https://alembic.sqlalchemy.org/en/latest/cookbook.html#connection-sharing
+            with (
+                _in_process_upgrade_lock,
+                _apply_session_settings_to_new_connections(session_settings, engine),
+                engine.begin() as connection,
+                environment_context,
+            ):
+                # Scoped to the transaction of the upgrade, the connection goes back to the pool afterwards
+                for name, value in session_settings.items():
+                    connection.execute(sqlalchemy.text(f"SET LOCAL {name} = {value}"))
+                config.attributes["connection"] = connection
+                script.run_env()
+        except Exception:
+            applied_count = len(self.applied_revisions) - applied_before
+            if applied_count < len(steps):
+                failed_revision, down_revisions = steps[applied_count]
+                self.applied_revisions.append(
+                    AppliedRevision(
+                        revision=failed_revision,
+                        down_revisions=down_revisions,
+                        started_at=step_started_at_timestamp,
+                        duration=time.monotonic() - step_started_at,
+                        success=False,
+                    )
+                )
+            self._discard_rolled_back_revisions(applied_before)
+            raise
+
+    def _discard_rolled_back_revisions(self, applied_before: int) -> None:
+        """
+        After a failed upgrade, forget the revisions it applied then rolled back, i.e. the ones the database is not
+        at or past anymore, so that they are not recorded as applied. Whether they were rolled back depends on env.py
+        running all the revisions in one transaction, or each of them in its own.
+        """
+        try:
+            current_heads = self._get_current_heads()
+            _, revision_graph = self._get_revision_graph()
+        except Exception as e:
+            logger.warning("Could not check which revisions of %s were rolled back: %s", self.alembic_section_name, e)
+            return
+        committed_revisions = _get_ancestors(revision_graph, current_heads & revision_graph.keys())
+        self.applied_revisions[applied_before:] = [
+            applied_revision
+            for applied_revision in self.applied_revisions[applied_before:]
+            if not applied_revision.success or applied_revision.revision in committed_revisions
+        ]
+
+    def _run_in_worker(self, operation: "WorkerOperation") -> tuple[bool, list[AppliedRevision]]:
+        from .forkserver_pool import run_in_worker
+
+        return run_in_worker(
+            operation,
+            {
+                "alembic_directory_path": self.alembic_directory_path,
+                "alembic_config_file_path": self.alembic_config_file_path,
+                "database_url": self.database_url,
+                "alembic_section_name": self.alembic_section_name,
+                "alembic_template_section_name": self.alembic_template_section_name,
+                "additional_parameters": self.additional_parameters,
+                "allow_migration_for_empty_database": self.allow_migration_for_empty_database,
+                "lock_timeout": self.lock_timeout,
+                "statement_timeout": self.statement_timeout,
+                "max_replication_lag": self.max_replication_lag,
+                "replication_throttle_timeout": self.replication_throttle_timeout,
+            },
+            on_revision_progress=self.on_revision_progress,
+        )
+
+    def _upgrade_db_in_worker(self) -> None:
+        from .forkserver_pool import WorkerUpgradeError
+
+        try:
+            _, applied_revisions = self._run_in_worker("upgrade")
+        except WorkerUpgradeError as e:
+            self.applied_revisions.extend(e.applied_revisions)
+            raise
+        self.applied_revisions.extend(applied_revisions)
+
+    def _get_session_settings(self) -> dict[str, str]:
+        """PostgreSQL settings of the upgrade session, in milliseconds."""
+        settings = {}
+        if self.lock_timeout is not None:
+            settings["lock_timeout"] = str(int(self.lock_timeout * 1000))
+        if self.statement_timeout is not None:
+            settings["statement_timeout"] = str(int(self.statement_timeout * 1000))
+        if settings and sqlalchemy.engine.make_url(self.database_url).get_backend_name() != "postgresql":
+            logger.warning("lock_timeout and statement_timeout are only supported by PostgreSQL, ignoring them.")
+            return {}
+        return settings
+
+    def _get_upgrade_command(self, config_file_path: str) -> tuple[str, dict[str, Any]]:
+        """The `alembic upgrade head` command with the configuration file, and the keyword arguments of its process."""
+        popen_kwargs: dict[str, Any] = {"cwd": self.alembic_directory_path}
+        session_settings = self._get_session_settings()
+        if session_settings:
+            # Applied by libpq to every connection of alembic
+            options = " ".join(f"-c {name}={value}" for name, value in session_settings.items())
+            popen_kwargs["env"] = {**os.environ, "PGOPTIONS": f"{os.environ.get('PGOPTIONS', '')} {options}".strip()}
+        return f"alembic -c {config_file_path} {self.additional_parameters} upgrade head", popen_kwargs
+
+    @contextmanager
+    def _watch_upgrade_output(self, command: str) -> Iterator[AlembicOutputWatcher]:
+        """Watch the output of the `alembic upgrade head` command, recording the revisions it applies."""
+        watcher = AlembicOutputWatcher(self.alembic_section_name, on_revision_progress=self.on_revision_progress)
+        applied_before = len(self.applied_revisions)
+        try:
+            yield watcher
+        except CalledProcessError as e:
+            self._finish_failed_upgrade_output(watcher, applied_before)
+            if watcher.lock_timed_out:
+                raise SubprocessError(f"{command} has failed on a lock timeout") from e
+            raise SubprocessError(f"{command} has failed: {watcher.output_tail}") from e
+        except BaseException:
+            self._finish_failed_upgrade_output(watcher, applied_before)
+            raise
+        else:
+            watcher.finish(success=True)
+            self.applied_revisions.extend(watcher.applied_revisions)
+
+    def _finish_failed_upgrade_output(self, watcher: AlembicOutputWatcher, applied_before: int) -> None:
+        watcher.finish(success=False)
+        self.applied_revisions.extend(watcher.applied_revisions)
+        self._discard_rolled_back_revisions(applied_before)
+
+    def _upgrade_db_in_subprocess(self) -> None:
+        with self._subprocess_config_file() as config_file_path:
+            command, popen_kwargs = self._get_upgrade_command(config_file_path)
+            with self._watch_upgrade_output(command) as watcher:
+                run_command(command, line_callback=watcher, **popen_kwargs)
+
+    async def _async_upgrade_db_in_subprocess(self) -> None:
+        with self._subprocess_config_file() as config_file_path:
+            command, kwargs = self._get_upgrade_command(config_file_path)
+            with self._watch_upgrade_output(command) as watcher:
+                await run_command_async(command, line_callback=watcher, **kwargs)
+
+    def _get_lock_retry_delay(self, error: Exception, attempt: int, deadline: float) -> float | None:
+        """Seconds to wait before retrying an upgrade that failed with the error, None to not retry it."""
+        if not self.lock_retry_deadline or not _is_lock_timeout(error):
+            return None
+        # "Full jitter": concurrent retries don't wait on the same lock at the same time
+        delay = random.uniform(0, min(LOCK_RETRY_MAX_DELAY, LOCK_RETRY_BASE_DELAY * 2**attempt))
+        if time.monotonic() + delay > deadline:
+            logger.error("Upgrade still failing on a lock timeout after %ss, giving up.", self.lock_retry_deadline)
+            return None
+        logger.warning("Upgrade failed on a lock timeout, retrying in %.1fs (attempt %d).", delay, attempt + 2)
+        return delay
+
+    def _start_lock_retries(self) -> Callable[[Exception], float]:
+        """
+        Start retrying an upgrade with jittered exponential backoff while it fails on lock timeouts, until
+        lock_retry_deadline seconds have passed. Return the function giving the seconds to wait before the next attempt
+        once an attempt failed with an error, which raises the error again if the upgrade must not be retried.
+
+        Each retry runs the whole upgrade again, skipping the revisions already committed: once an attempt fails on
+        another revision than the previous one, the deadline and the backoff start over for that revision.
+        """
+        deadline = time.monotonic() + self.lock_retry_deadline
+        attempts = itertools.count()
+        failed_revision: str | None = None
+
+        def get_retry_delay(error: Exception) -> float:
+            nonlocal deadline, attempts, failed_revision
+            last_applied_revision = self.applied_revisions[-1] if self.applied_revisions else None
+            if last_applied_revision is not None and not last_applied_revision.success:
+                if last_applied_revision.revision != failed_revision:
+                    failed_revision = last_applied_revision.revision
+                    deadline = time.monotonic() + self.lock_retry_deadline
+                    attempts = itertools.count()
+            delay = self._get_lock_retry_delay(error, next(attempts), deadline)
+            if delay is None:
+                raise error
+            return delay
+
+        return get_retry_delay
+
+    def _upgrade_db_with_retry(self, upgrade: Callable[[], None]) -> None:
+        get_retry_delay = self._start_lock_retries()
+        while True:
+            try:
+                upgrade()
+                return
+            except Exception as e:
+                time.sleep(get_retry_delay(e))
+
+    async def _async_upgrade_db_with_retry(self, upgrade: Callable[[], Awaitable[None]]) -> None:
+        get_retry_delay = self._start_lock_retries()
+        while True:
+            try:
+                await upgrade()
+                return
+            except Exception as e:
+                await asyncio.sleep(get_retry_delay(e))
+
+    def _throttle_replication(self) -> None:
+        """Wait for the replicas to catch up, with a max_replication_lag."""
+        if self.max_replication_lag is None:
+            return
+        with time_phase("throttle", self.alembic_section_name):
+            wait_for_replication(
+                get_engine(self.database_url),
+                self.max_replication_lag,
+                timeout=self.replication_throttle_timeout,
+                database=self.alembic_section_name,
+            )
+
+    def _record_migration_history(self, applied_revisions: list[AppliedRevision]) -> None:
+        """Record the applied revisions in the database, without failing the upgrade if it can't."""
+        try:
+            record_migration_history(get_engine(self.database_url), self.alembic_section_name, applied_revisions)
+        except Exception as e:
+            logger.warning("Could not record the migration history of %s: %s", self.alembic_section_name, e)
+
+    @contextmanager
+    def _recording_upgrade(self) -> Iterator[None]:
+        """Time the upgrade, then record the revisions it applied, whether it succeeded or not."""
+        # Revisions applied by previous upgrades of this helper are already recorded
+        applied_before = len(self.applied_revisions)
+        try:
+            with time_phase("upgrade", self.alembic_section_name):
+                yield
+        finally:
+            applied_revisions = self.applied_revisions[applied_before:]
+            if self.record_migration_history and applied_revisions:
+                self._record_migration_history(applied_revisions)
+
     def upgrade_db(self) -> None:
         logger.info("Database needs to be upgraded. Proceeding.")
-        run_command(
-            f"alembic -c {self.alembic_config_file_path} {self.additional_parameters} upgrade head",
-            cwd=self.alembic_directory_path,
-        )
+        self._throttle_replication()
+        with self._recording_upgrade():
+            if self.upgrade_engine == "inprocess":
+                self._upgrade_db_with_retry(self._upgrade_db_in_process)
+            elif self.upgrade_engine == "forkserver":
+                self._upgrade_db_with_retry(self._upgrade_db_in_worker)
+            else:
+                self._upgrade_db_with_retry(self._upgrade_db_in_subprocess)
+        logger.info("Done upgrading database.")
+
+    async def async_upgrade_db(self) -> None:
+        """
+        Like upgrade_db() with the subprocess upgrade engine, running `alembic upgrade head` as an asyncio subprocess
+        so that the event loop keeps running other upgrades and Kubernetes operations meanwhile.
+        """
+        if self.upgrade_engine != "subprocess":
+            raise ValueError(f"The {self.upgrade_engine} upgrade engine can't run asynchronously, use upgrade_db()")
+        logger.info("Database needs to be upgraded. Proceeding.")
+        await asyncio.to_thread(self._throttle_replication)
+        with self._recording_upgrade():
+            await self._async_upgrade_db_with_retry(self._async_upgrade_db_in_subprocess)
         logger.info("Done upgrading database.")
@@ -0,0 +1,116 @@
+"""
+Streaming of the output of alembic subprocesses.
+
+The output of `alembic upgrade` is consumed line by line as it is printed: each "Running upgrade X -> Y" line
+starts a revision, which gives the progress of long upgrades while they run and the duration of each revision.
+Only the last lines are kept, for error messages, so that memory stays bounded whatever the size of the output.
+"""
+
+import logging
+import re
+import time
+from collections import deque
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from .migration_history import AppliedRevision
+
+logger = logging.getLogger(__name__)
+
+# Logged by alembic before each revision, e.g. "Running upgrade 1a2b, 3c4d -> 5e6f, Merge heads"
+UPGRADE_STEP_RE = re.compile(r"Running upgrade (?P<down_revisions>[\w, ]*?) ?-> (?P<revision>\w+)")
+# Errors of statements cancelled because they waited too long on a lock:
+# PostgreSQL (SQLSTATE 55P03, LockNotAvailable) and MySQL (1205, "Lock wait timeout exceeded")
+LOCK_TIMEOUT_RE = re.compile(r"lock timeout|lock wait timeout|LockNotAvailable|55P03", re.IGNORECASE)
+
+# Lines of output kept for error messages
+OUTPUT_TAIL_LINES = 50
+
+
+@dataclass(frozen=True)
+class RevisionProgress:
+    """A revision starting to be applied: the position-th of the upgrade, out of total revisions when known."""
+
+    database: str
+    revision: str
+    down_revisions: tuple[str, ...]
+    position: int
+    total: int | None = None
+
+
+def log_revision_progress(progress: RevisionProgress) -> None:
+    total = f"/{progress.total}" if progress.total is not None else ""
+    logger.info("%s: applying revision %s (%d%s).", progress.database, progress.revision, progress.position, total)
+
+
+class AlembicOutputWatcher:
+    """
+    Line callback of an alembic subprocess: logs each line, emits a RevisionProgress when a revision starts,
+    records the applied revisions and notes whether it failed on a lock timeout.
+    """
+
+    def __init__(
+        self,
+        database: str,
+        on_revision_progress: Callable[[RevisionProgress], None] | None = log_revision_progress,
+        log_level: int = logging.INFO,
+    ) -> None:
+        self.database = database
+        self.on_revision_progress = on_revision_progress
+        self.log_level = log_level
+        self.tail: deque[str] = deque(maxlen=OUTPUT_TAIL_LINES)
+        # CalledProcessError doesn't hold the output of the command
+        self.lock_timed_out = False
+        self.applied_revisions: list[AppliedRevision] = []
+        # The revision being applied: (revision, down revisions), with when it started
+        self._running: tuple[str, tuple[str, ...]] | None = None
+        self._running_started_at = 0.0
+        self._running_started_at_timestamp = 0.0
+        self._position = 0
+
+    def __call__(self, line: str) -> None:
+        logger.log(self.log_level, line)
+        self.tail.append(line)
+        self.lock_timed_out = self.lock_timed_out or bool(LOCK_TIMEOUT_RE.search(line))
+
+        match = UPGRADE_STEP_RE.search(line)
+        if match is None:
+            return
+        self._end_running_revision(success=True)
+        down_revisions = tuple(filter(None, (r.strip() for r in match["down_revisions"].split(","))))
+        self._running = (match["revision"], down_revisions)
+        self._running_started_at = time.monotonic()
+        self._running_started_at_timestamp = time.time()
+        self._position += 1
+        if self.on_revision_progress is not None:
+            self.on_revision_progress(
+                RevisionProgress(
+                    database=self.database,
+                    revision=match["revision"],
+                    down_revisions=down_revisions,
+                    position=self._position,
+                )
+            )
+
+    def _end_running_revision(self, success: bool) -> None:
+        if self._running is None:
+            return
+        revision, down_revisions = self._running
+        self.applied_revisions.append(
+            AppliedRevision(
+                revision=revision,
+                down_revisions=down_revisions,
+                started_at=self._running_started_at_timestamp,
+                duration=time.monotonic() - self._running_started_at,
+                success=success,
+            )
+        )
+        self._running = None
+
+    def finish(self, success: bool) -> None:
+        """Record the last revision once the command exited, as failed if the command failed."""
+        self._end_running_revision(success=success)
+
+    @property
+    def output_tail(self) -> str:
+        return "\n".join(self.tail)
@@ -0,0 +1,76 @@
+"""
+Commands run with their output streamed line by line, like wiremind_kubernetes' run_command.
+
+Importing wiremind_kubernetes loads the whole Kubernetes client, which checking the databases doesn't need.
+"""
+
+import asyncio
+import codecs
+import logging
+import shlex
+import subprocess
+from collections.abc import Callable
+from subprocess import CalledProcessError
+from typing import Any
+
+logger = logging.getLogger(__name__)
+
+# Bytes of output read at once, lines being of any length: alembic may log long statements
+STREAM_CHUNK_SIZE = 2**16
+
+
+def run_command(command: str, line_callback: Callable[[str], None] | None = None, **kwargs: Any) -> None:
+    """
+    Run the command, passing each line of its output (stdout and stderr) to line_callback, logger.info by default.
+    Raise CalledProcessError if it fails.
+    """
+    logger.debug("Running %s", command)
+    if line_callback is None:
+        line_callback = logger.info
+    with subprocess.Popen(
+        shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors="replace", **kwargs
+    ) as process:
+        assert process.stdout is not None
+        for line in process.stdout:
+            line_callback(line.strip())
+    if process.returncode:
+        raise CalledProcessError(process.returncode, command)
+
+
+async def run_command_async(command: str, line_callback: Callable[[str], None] | None = None, **kwargs: Any) -> None:
+    """
+    Like run_command() without blocking the event loop, the command running as an asyncio subprocess.
+    Kill it if cancelled or if its output can't be handled.
+    """
+    logger.debug("Running %s", command)
+    if line_callback is None:
+        line_callback = logger.info
+    process = await asyncio.create_subprocess_exec(
+        *shlex.split(command), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, **kwargs
+    )
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    # Start of the line being read, over as many chunks as it takes
+    line_parts: list[str] = []
+    try:
+        assert process.stdout is not None
+        while chunk := await process.stdout.read(STREAM_CHUNK_SIZE):
+            *lines, rest = decoder.decode(chunk).split("\n")
+            if lines:
+                lines[0] = "".join((*line_parts, lines[0]))
+                line_parts = []
+                for line in lines:
+                    line_callback(line.strip())
+            line_parts.append(rest)
+        last_line = "".join((*line_parts, decoder.decode(b"", final=True)))
+        if last_line:
+            line_callback(last_line.strip())
+        returncode = await process.wait()
+    except BaseException:
+        # Don't leave the command running, blocked on a full pipe once its output is not read anymore
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+        raise
+
+    if returncode:
+        raise CalledProcessError(returncode, command)
@@ -0,0 +1,42 @@
+"""
+Process-wide registry of SQLAlchemy engines, one per database URL.
+
+The checks and the in-process upgrades of a database share its engine, hence its connection pool, instead of
+opening new connections each time. Engines are disposed of with dispose_engines() once Chartreuse is done.
+"""
+
+import logging
+import threading
+from collections.abc import Iterable
+
+import sqlalchemy
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_engines: dict[str, Engine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(database_url: str) -> Engine:
+    """Return the engine of the given database URL, creating it on first use."""
+    with _engines_lock:
+        engine = _engines.get(database_url)
+        if engine is None:
+            # Connections may sit idle in the pool between the check and the upgrade of a database
+            engine = sqlalchemy.create_engine(database_url, pool_pre_ping=True)
+            _engines[database_url] = engine
+        return engine
+
+
+def dispose_engines(database_urls: Iterable[str] | None = None) -> None:
+    """
+    Close the connections of the engines of the given database URLs, of every registered engine by default, and
+    forget them.
+    """
+    with _engines_lock:
+        urls = list(_engines) if database_urls is None else [url for url in database_urls if url in _engines]
+        for url in urls:
+            _engines.pop(url).dispose()
+        if urls and database_urls is None:
+            logger.info("Closed the connections to %d database(s).", len(urls))
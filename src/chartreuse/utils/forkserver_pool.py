@@ -0,0 +1,169 @@
+"""
+Checks and upgrades of databases in isolated workers forked from a forkserver.
+
+env.py files may import large model packages and patch alembic internals: they can't safely run in the Chartreuse
+process, but importing them again in every `alembic` subprocess is slow. The forkserver imports alembic, SQLAlchemy
+and the configured model modules once, then every check or upgrade runs in a fresh worker forked from it, with the
+isolation of a process but without paying for the interpreter start-up and the imports each time. The forkserver
+also parses the migration trees of the databases once, for its workers to inherit them instead of parsing them again
+for each check and upgrade.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from collections.abc import Callable, Iterable
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.context import BaseContext
+from multiprocessing.queues import SimpleQueue
+from typing import Any, Literal
+
+from .alembic_output import RevisionProgress
+from .migration_history import AppliedRevision
+
+logger = logging.getLogger(__name__)
+
+# Imported by the forkserver before it forks any worker, with the modules registered by register_preload_modules()
+FORKSERVER_PRELOAD = (
+    "alembic.runtime.environment",
+    "alembic.runtime.migration",
+    "alembic.script",
+    "sqlalchemy",
+    "chartreuse.utils.alembic_migration_helper",
+)
+# Imported by the forkserver last, to parse the migration trees registered by register_preload_script_directory()
+FORKSERVER_PRELOAD_SCRIPT_DIRECTORIES = "chartreuse.utils.forkserver_preload"
+# Passes the registered migration trees to the forkserver, which inherits the environment of the Chartreuse process
+PRELOAD_SCRIPT_DIRECTORIES_ENV = "CHARTREUSE_FORKSERVER_SCRIPT_DIRECTORIES"
+
+WorkerOperation = Literal["check", "upgrade"]
+
+_preload_modules: set[str] = set()
+# (alembic directory, alembic config file, section) of the migration trees parsed by the forkserver
+_preload_script_directories: set[tuple[str, str, str]] = set()
+_preload_lock = threading.Lock()
+
+# Progress of the upgrade of the worker, sent to the Chartreuse process
+_progress_queue: "SimpleQueue[RevisionProgress | None] | None" = None
+
+
+class WorkerUpgradeError(Exception):
+    """An upgrade that failed in a worker, with the revisions it applied (the last one failed) before failing."""
+
+    def __init__(self, message: str, applied_revisions: list[AppliedRevision]) -> None:
+        # Both are arguments so that the error is pickled back to the Chartreuse process with them
+        super().__init__(message, applied_revisions)
+        self.message = message
+        self.applied_revisions = applied_revisions
+
+    def __str__(self) -> str:
+        return self.message
+
+
+def register_preload_modules(modules: Iterable[str]) -> None:
+    """
+    Have the forkserver import the modules, e.g. the models imported by env.py.
+    The forkserver is started by the first worker, modules must be registered before.
+    """
+    with _preload_lock:
+        _preload_modules.update(modules)
+
+
+def register_preload_script_directory(
+    alembic_directory_path: str, alembic_config_file_path: str, alembic_section_name: str
+) -> None:
+    """
+    Have the forkserver parse the migration tree of the alembic section, the workers inheriting it.
+    Like modules, the tree must be registered before the forkserver is started.
+    """
+    with _preload_lock:
+        _preload_script_directories.add((alembic_directory_path, alembic_config_file_path, alembic_section_name))
+
+
+def get_forkserver_context() -> BaseContext:
+    context = multiprocessing.get_context("forkserver")
+    with _preload_lock:
+        os.environ[PRELOAD_SCRIPT_DIRECTORIES_ENV] = json.dumps(sorted(_preload_script_directories))
+        context.set_forkserver_preload(
+            [*FORKSERVER_PRELOAD, *sorted(_preload_modules), FORKSERVER_PRELOAD_SCRIPT_DIRECTORIES]
+        )
+    return context
+
+
+def _initialize_worker(log_level: int, progress_queue: "SimpleQueue[RevisionProgress | None]") -> None:
+    global _progress_queue
+    # Workers don't inherit the logging configuration of the Chartreuse process
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", datefmt="%H:%M:%S", level=log_level)
+    _progress_queue = progress_queue
+
+
+def _send_progress(progress: RevisionProgress) -> None:
+    assert _progress_queue is not None
+    _progress_queue.put(progress)
+
+
+def _run_operation(operation: WorkerOperation, helper_kwargs: dict[str, Any]) -> tuple[bool, list[AppliedRevision]]:
+    """
+    Run the operation in the worker, with an in-process helper: whether a migration is needed for a check, and the
+    applied revisions of an upgrade.
+    """
+    from .alembic_migration_helper import AlembicMigrationHelper
+
+    helper = AlembicMigrationHelper(
+        **helper_kwargs,
+        check_mode="inprocess",
+        upgrade_engine="inprocess",
+        record_migration_history=False,
+        on_revision_progress=_send_progress,
+        # alembic.ini was configured by the Chartreuse process
+        configure=False,
+    )
+    if operation == "check":
+        return helper._check_migration_needed(), []
+    try:
+        helper._upgrade_db_in_process()
+    except Exception as e:
+        # The error may not be picklable, and the revisions applied before it would be lost
+        raise WorkerUpgradeError(f"{type(e).__name__}: {e}", helper.applied_revisions) from None
+    return True, helper.applied_revisions
+
+
+def _forward_progress(
+    progress_queue: "SimpleQueue[RevisionProgress | None]",
+    on_revision_progress: Callable[[RevisionProgress], None] | None,
+) -> None:
+    while (progress := progress_queue.get()) is not None:
+        if on_revision_progress is not None:
+            on_revision_progress(progress)
+
+
+def run_in_worker(
+    operation: WorkerOperation,
+    helper_kwargs: dict[str, Any],
+    on_revision_progress: Callable[[RevisionProgress], None] | None = None,
+) -> tuple[bool, list[AppliedRevision]]:
+    """
+    Run the check or the upgrade of a database in a worker forked from the forkserver, and wait for it.
+    helper_kwargs are the keyword arguments of the AlembicMigrationHelper of the database, the revision progress of
+    the upgrade being passed to on_revision_progress in the calling process.
+    """
+    context = get_forkserver_context()
+    progress_queue: SimpleQueue[RevisionProgress | None] = context.SimpleQueue()
+    forwarder = threading.Thread(target=_forward_progress, args=(progress_queue, on_revision_progress), daemon=True)
+    forwarder.start()
+    try:
+        # A worker per operation, never reused: env.py may leave global state behind
+        with ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=context,
+            initializer=_initialize_worker,
+            initargs=(logging.getLogger().getEffectiveLevel(), progress_queue),
+            max_tasks_per_child=1,
+        ) as executor:
+            return executor.submit(_run_operation, operation, helper_kwargs).result()
+    finally:
+        progress_queue.put(None)
+        forwarder.join()
+        progress_queue.close()
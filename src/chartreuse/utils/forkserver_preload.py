@@ -0,0 +1,34 @@
+"""
+Imported by the forkserver once it started: parse the migration trees registered by the Chartreuse process, so that
+the workers forked from it find them in the script directory cache instead of parsing them for each operation.
+"""
+
+import json
+import logging
+import os
+
+from .alembic_config import build_alembic_config
+from .forkserver_pool import PRELOAD_SCRIPT_DIRECTORIES_ENV
+from .script_directory_cache import get_manifest_section, get_script_directory
+
+logger = logging.getLogger(__name__)
+
+
+def preload_script_directories() -> None:
+    """Parse the registered migration trees, and validate their revision manifest sections."""
+    script_directories = json.loads(os.environ.get(PRELOAD_SCRIPT_DIRECTORIES_ENV) or "[]")
+    for alembic_directory_path, alembic_config_file_path, alembic_section_name in script_directories:
+        try:
+            config = build_alembic_config(
+                alembic_directory_path=alembic_directory_path,
+                alembic_config_file_path=alembic_config_file_path,
+                alembic_section_name=alembic_section_name,
+            )
+            get_script_directory(config)
+            get_manifest_section(alembic_directory_path, config)
+        except Exception as e:
+            # The workers parse the tree themselves, and report the error if it persists
+            logger.warning("The forkserver could not parse the migration scripts of %s: %s", alembic_section_name, e)
+
+
+preload_script_directories()
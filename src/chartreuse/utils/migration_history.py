@@ -0,0 +1,75 @@
+"""
+History of the revisions applied by Chartreuse, kept in each migrated database.
+
+Every revision applied (or failed) by an upgrade is recorded in the chartreuse_migration_history table, with when
+it started and how long it took, to estimate the duration of the next upgrades and to spot slowing revisions.
+"""
+
+import datetime
+import logging
+from dataclasses import dataclass
+from importlib.metadata import PackageNotFoundError, version
+
+import sqlalchemy
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_HISTORY_TABLE = "chartreuse_migration_history"
+
+
+@dataclass(frozen=True)
+class AppliedRevision:
+    """
+    A revision applied by an upgrade, with its start as a Unix timestamp and the time it took in seconds.
+    A failed revision has success set to false.
+    """
+
+    revision: str
+    down_revisions: tuple[str, ...]
+    started_at: float
+    duration: float
+    success: bool = True
+
+
+metadata = sqlalchemy.MetaData()
+
+migration_history_table = sqlalchemy.Table(
+    MIGRATION_HISTORY_TABLE,
+    metadata,
+    sqlalchemy.Column("database", sqlalchemy.String(255), nullable=False),
+    sqlalchemy.Column("revision", sqlalchemy.String(255), nullable=False),
+    sqlalchemy.Column("started_at", sqlalchemy.DateTime(timezone=True), nullable=False),
+    sqlalchemy.Column("duration", sqlalchemy.Float, nullable=False),
+    sqlalchemy.Column("success", sqlalchemy.Boolean, nullable=False),
+    sqlalchemy.Column("chartreuse_version", sqlalchemy.String(64), nullable=False),
+)
+
+
+def _get_chartreuse_version() -> str:
+    try:
+        return version("chartreuse")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def record_migration_history(engine: Engine, database: str, applied_revisions: list[AppliedRevision]) -> None:
+    """Append the applied revisions to the history table of the database, creating it if needed."""
+    chartreuse_version = _get_chartreuse_version()
+    with engine.begin() as connection:
+        metadata.create_all(connection, checkfirst=True)
+        connection.execute(
+            migration_history_table.insert(),
+            [
+                {
+                    "database": database,
+                    "revision": applied_revision.revision,
+                    "started_at": datetime.datetime.fromtimestamp(applied_revision.started_at, tz=datetime.UTC),
+                    "duration": applied_revision.duration,
+                    "success": applied_revision.success,
+                    "chartreuse_version": chartreuse_version,
+                }
+                for applied_revision in applied_revisions
+            ],
+        )
+    logger.info("Recorded %d revision(s) in %s.", len(applied_revisions), MIGRATION_HISTORY_TABLE)
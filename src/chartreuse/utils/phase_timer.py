@@ -0,0 +1,122 @@
+"""
+Process-wide timings of the phases of a Chartreuse run.
+
+Phases (configuration loading, checks, upgrades, scaling of the deployments...) are timed with time_phase(),
+per database when they are specific to one. write_phase_report() writes them as a JSON report and as a
+Prometheus text exposition file, e.g. for the node exporter's textfile collector.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+
+logger = logging.getLogger(__name__)
+
+JSON_REPORT_FILE_NAME = "chartreuse-report.json"
+PROMETHEUS_FILE_NAME = "chartreuse.prom"
+
+
+@dataclass(frozen=True)
+class PhaseTiming:
+    """A timed phase: its start as a Unix timestamp and its duration in seconds."""
+
+    phase: str
+    database: str | None
+    started_at: float
+    duration: float
+    success: bool
+
+
+_timings: list[PhaseTiming] = []
+_timings_lock = threading.Lock()
+
+
+@contextmanager
+def time_phase(phase: str, database: str | None = None) -> Iterator[None]:
+    """Time the enclosed block as the given phase, of the given database if any."""
+    started_at = time.time()
+    start = time.monotonic()
+    success = False
+    try:
+        yield
+        success = True
+    finally:
+        timing = PhaseTiming(
+            phase=phase,
+            database=database,
+            started_at=started_at,
+            duration=time.monotonic() - start,
+            success=success,
+        )
+        with _timings_lock:
+            _timings.append(timing)
+
+
+def get_phase_timings() -> list[PhaseTiming]:
+    with _timings_lock:
+        return list(_timings)
+
+
+def clear_phase_timings() -> None:
+    with _timings_lock:
+        _timings.clear()
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_prometheus(timings: list[PhaseTiming]) -> str:
+    """Format the timings in the Prometheus text exposition format, summing the phases run several times."""
+    durations: dict[tuple[str, str], float] = {}
+    successes: dict[tuple[str, str], bool] = {}
+    for timing in timings:
+        key = (timing.phase, timing.database or "")
+        durations[key] = durations.get(key, 0.0) + timing.duration
+        successes[key] = successes.get(key, True) and timing.success
+
+    lines = [
+        "# HELP chartreuse_phase_duration_seconds Time spent in a phase of the last Chartreuse run.",
+        "# TYPE chartreuse_phase_duration_seconds gauge",
+    ]
+    for (phase, database), duration in durations.items():
+        labels = f'phase="{_escape_label_value(phase)}",database="{_escape_label_value(database)}"'
+        lines.append(f"chartreuse_phase_duration_seconds{{{labels}}} {duration:.6f}")
+    lines += [
+        "# HELP chartreuse_phase_success Whether a phase of the last Chartreuse run succeeded.",
+        "# TYPE chartreuse_phase_success gauge",
+    ]
+    for (phase, database), success in successes.items():
+        labels = f'phase="{_escape_label_value(phase)}",database="{_escape_label_value(database)}"'
+        lines.append(f"chartreuse_phase_success{{{labels}}} {int(success)}")
+    lines += [
+        "# HELP chartreuse_last_run_timestamp_seconds When the last Chartreuse run ended.",
+        "# TYPE chartreuse_last_run_timestamp_seconds gauge",
+        f"chartreuse_last_run_timestamp_seconds {time.time():.3f}",
+    ]
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomically(path: str, content: str) -> None:
+    # Readers (e.g. the node exporter) must never see a partially written file
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as f:
+        f.write(content)
+    os.replace(temporary_path, path)
+
+
+def write_phase_report(directory: str) -> None:
+    """Write the phase timings to the JSON report and the Prometheus file of the given directory."""
+    timings = get_phase_timings()
+    os.makedirs(directory, exist_ok=True)
+    _write_atomically(
+        os.path.join(directory, JSON_REPORT_FILE_NAME),
+        json.dumps({"phases": [asdict(timing) for timing in timings]}, indent=2),
+    )
+    _write_atomically(os.path.join(directory, PROMETHEUS_FILE_NAME), format_prometheus(timings))
+    logger.info("Wrote the timings of %d phase(s) to %s", len(timings), directory)
@@ -0,0 +1,84 @@
+"""
+Readiness of the databases before checking them.
+
+A database may not accept connections yet when Chartreuse starts, e.g. while its cluster is being created. On
+PostgreSQL clusters managed by postgres-operator (Patroni), the owner roles and their default privileges are also
+created after the cluster accepts connections, and migrations must not run before.
+"""
+
+import logging
+import time
+
+import sqlalchemy
+from sqlalchemy.engine import Connection, Engine
+
+logger = logging.getLogger(__name__)
+
+# Roles created by postgres-operator, the owner is the role migrations run as
+PATRONI_OWNER_ROLE = "wiremind_owner"
+PATRONI_ROLES = (PATRONI_OWNER_ROLE, f"{PATRONI_OWNER_ROLE}_user")
+
+# Backoff between the probes of a database that is not ready, in seconds
+READINESS_BASE_DELAY = 0.5
+READINESS_MAX_DELAY = 10.0
+
+
+class DatabaseNotReadyError(Exception):
+    pass
+
+
+def _check_patroni_configured(connection: Connection) -> None:
+    existing_roles = set(
+        connection.execute(
+            sqlalchemy.text("SELECT rolname FROM pg_catalog.pg_roles WHERE rolname IN :roles").bindparams(
+                sqlalchemy.bindparam("roles", expanding=True)
+            ),
+            {"roles": list(PATRONI_ROLES)},
+        ).scalars()
+    )
+    missing_roles = [role for role in PATRONI_ROLES if role not in existing_roles]
+    if missing_roles:
+        raise DatabaseNotReadyError(f"Role(s) not created yet: {', '.join(missing_roles)}")
+
+    has_default_privileges = (
+        connection.execute(
+            sqlalchemy.text(
+                "SELECT 1 FROM pg_catalog.pg_default_acl d JOIN pg_catalog.pg_roles r ON r.oid = d.defaclrole"
+                " WHERE r.rolname = :role LIMIT 1"
+            ),
+            {"role": PATRONI_OWNER_ROLE},
+        ).first()
+        is not None
+    )
+    if not has_default_privileges:
+        raise DatabaseNotReadyError(f"Default privileges of {PATRONI_OWNER_ROLE} not set yet")
+
+
+def probe_database(engine: Engine, patroni_postgresql: bool = False) -> None:
+    """Raise if the database does not accept queries yet or, with patroni_postgresql, is not configured yet."""
+    with engine.connect() as connection:
+        connection.execute(sqlalchemy.text("SELECT 1"))
+        if patroni_postgresql and connection.dialect.name == "postgresql":
+            _check_patroni_configured(connection)
+
+
+def wait_until_ready(engine: Engine, deadline: float, patroni_postgresql: bool = False, database: str = "") -> None:
+    """
+    Probe the database with exponential backoff until it is ready.
+    Raise DatabaseNotReadyError if it is still not ready at the deadline, a time.monotonic() timestamp.
+    """
+    attempt = 0
+    while True:
+        try:
+            probe_database(engine, patroni_postgresql=patroni_postgresql)
+            if attempt:
+                logger.info("Database %s is ready.", database)
+            return
+        except (sqlalchemy.exc.SQLAlchemyError, DatabaseNotReadyError) as e:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DatabaseNotReadyError(f"Database {database} is still not ready, giving up: {e}") from e
+            delay = min(READINESS_MAX_DELAY, READINESS_BASE_DELAY * 2**attempt, remaining)
+            logger.info("Database %s is not ready (%s), probing again in %.1fs...", database, e, delay)
+            time.sleep(delay)
+            attempt += 1
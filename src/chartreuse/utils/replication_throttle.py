@@ -0,0 +1,94 @@
+"""
+Throttling of upgrades on the replication lag of the database.
+
+Large DDL and data migrations make the replicas of a primary fall behind, and the reads they serve stale. With a
+max_replication_lag, an upgrade pauses before it starts, and between two revisions once the first one is committed,
+until the replay lag of the slowest PostgreSQL standby (pg_stat_replication), or the number of entries of the
+ClickHouse replication queue of the database (system.replication_queue), is at most max_replication_lag.
+Pausing within the transaction of a revision would keep its locks, while the replicas receive nothing until it commits.
+"""
+
+import logging
+import time
+
+import sqlalchemy
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Per dialect, a query returning the replication lag of the database, and the number of replicas whose lag is hidden
+REPLICATION_LAG_QUERIES: dict[str, str] = {
+    # The state and the lags of the standbys are only visible to superusers and members of pg_monitor, NULL otherwise.
+    # The replay_lag of a visible standby is NULL once it is idle, having replayed everything.
+    "postgresql": """
+        SELECT COALESCE(MAX(EXTRACT(EPOCH FROM replay_lag)), 0), COUNT(*) FILTER (WHERE state IS NULL)
+        FROM pg_catalog.pg_stat_replication
+    """,
+    "clickhouse": "SELECT count(), 0 FROM system.replication_queue WHERE database = currentDatabase()",
+}
+
+# Seconds an upgrade waits at most for the replicas to catch up, before going on anyway
+DEFAULT_THROTTLE_TIMEOUT = 600.0
+# Backoff between the measures of a lag above the maximum, in seconds
+THROTTLE_BASE_DELAY = 1.0
+THROTTLE_MAX_DELAY = 30.0
+
+
+def get_replication_lag(engine: Engine) -> float | None:
+    """
+    The replication lag of the database: the replay lag of its slowest standby in seconds on PostgreSQL, the number
+    of entries of its replication queue on ClickHouse. None if it can't be measured: on other dialects, or when the
+    user can't see the lag of every standby.
+    """
+    with engine.connect() as connection:
+        query = REPLICATION_LAG_QUERIES.get(connection.dialect.name)
+        if query is None:
+            logger.warning("The replication lag can't be measured on %s.", connection.dialect.name)
+            return None
+        lag, hidden_replicas = connection.execute(sqlalchemy.text(query)).one()
+    if hidden_replicas:
+        logger.warning(
+            "The replication lag of %d replica(s) is hidden from the user, who needs to be a member of pg_monitor.",
+            hidden_replicas,
+        )
+        return None
+    return float(lag or 0)
+
+
+def wait_for_replication(
+    engine: Engine, max_lag: float, timeout: float = DEFAULT_THROTTLE_TIMEOUT, database: str = ""
+) -> None:
+    """
+    Wait with exponential backoff until the replication lag of the database is at most max_lag.
+    Give up waiting, without failing, after timeout seconds or if the lag can't be measured.
+    """
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        try:
+            lag = get_replication_lag(engine)
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logger.warning("Could not measure the replication lag of %s, not throttling: %s", database, e)
+            return
+        if lag is None:
+            logger.warning("The replication lag of %s can't be measured, not throttling.", database)
+            return
+        if lag <= max_lag:
+            if attempt:
+                logger.info("The replicas of %s caught up (lag: %.1f).", database, lag)
+            return
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            logger.warning("The replication lag of %s is still %.1f after %ss, going on.", database, lag, timeout)
+            return
+        delay = min(THROTTLE_MAX_DELAY, THROTTLE_BASE_DELAY * 2**attempt, remaining)
+        logger.info(
+            "The replication lag of %s is %.1f (max: %s), pausing the upgrade for %.1fs...",
+            database,
+            lag,
+            max_lag,
+            delay,
+        )
+        time.sleep(delay)
+        attempt += 1
@@ -0,0 +1,114 @@
+"""
+Build-time manifest of the alembic revisions, so that the heads can be known at job start without importing
+every migration script.
+
+`chartreuse bake` writes, next to alembic.ini, the heads and the revision graph of every alembic section, along
+with a content hash of its version locations. At run time the manifest is only trusted if that hash still matches.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from typing import Any
+
+from alembic import util
+from alembic.config import Config
+from alembic.script import ScriptDirectory
+
+from .alembic_config import build_alembic_config
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE_NAME = "chartreuse-manifest.json"
+
+
+def get_version_locations(config: Config) -> list[str]:
+    version_locations = config.get_version_locations_list()
+    if version_locations:
+        return version_locations
+    script_location = util.coerce_resource_to_filename(config.get_main_option("script_location") or "")
+    return [os.path.join(script_location, "versions")]
+
+
+def hash_version_locations(version_locations: list[str]) -> str:
+    """Content hash of the migration scripts, which does not depend on file modification times."""
+    digest = hashlib.sha256()
+    for version_location in version_locations:
+        for root, directories, file_names in os.walk(version_location):
+            directories[:] = sorted(directory for directory in directories if directory != "__pycache__")
+            for file_name in sorted(file_names):
+                if not file_name.endswith(".py"):
+                    continue
+                file_path = os.path.join(root, file_name)
+                digest.update(os.path.relpath(file_path, version_location).encode())
+                with open(file_path, "rb") as f:
+                    digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def _get_manifest_path(alembic_directory_path: str) -> str:
+    return os.path.join(alembic_directory_path, MANIFEST_FILE_NAME)
+
+
+def bake_manifest(alembic_directory_path: str, alembic_config_file_path: str = "alembic.ini") -> str:
+    """
+    Write the revision manifest of every section of alembic.ini having a script_location.
+
+    Returns:
+        str: The path of the written manifest
+    """
+    config = Config(os.path.join(alembic_directory_path, alembic_config_file_path))
+    sections: dict[str, Any] = {}
+    for section_name in config.file_config.sections():
+        if not config.file_config.has_option(section_name, "script_location"):
+            continue
+        section_config = build_alembic_config(
+            alembic_directory_path=alembic_directory_path,
+            alembic_config_file_path=alembic_config_file_path,
+            alembic_section_name=section_name,
+        )
+        script = ScriptDirectory.from_config(section_config)
+        sections[section_name] = {
+            "versions_hash": hash_version_locations(get_version_locations(section_config)),
+            "heads": sorted(script.get_heads()),
+            "revisions": {
+                revision.revision: list(util.to_tuple(revision.down_revision, default=()))
+                for revision in script.walk_revisions()
+            },
+        }
+        logger.info(
+            "Baked %d revision(s) of section %s, head(s): %s",
+            len(sections[section_name]["revisions"]),
+            section_name,
+            ", ".join(sections[section_name]["heads"]),
+        )
+
+    manifest_path = _get_manifest_path(alembic_directory_path)
+    with open(manifest_path, "w") as f:
+        json.dump({"sections": sections}, f, indent=2, sort_keys=True)
+    return manifest_path
+
+
+def load_manifest_section(
+    alembic_directory_path: str, config: Config, section_name: str | None = None
+) -> dict[str, Any] | None:
+    """
+    Return the manifest entry of the section (by default the config's), or None if there is none or if the
+    migration scripts changed since it was baked.
+    """
+    section_name = section_name or config.config_ini_section
+    manifest_path = _get_manifest_path(alembic_directory_path)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        section = json.load(f)["sections"].get(section_name)
+    if section is None:
+        return None
+    if section["versions_hash"] != hash_version_locations(get_version_locations(config)):
+        logger.warning(
+            "The revision manifest of section %s is outdated, parsing the migration scripts instead.",
+            section_name,
+        )
+        return None
+    return section
@@ -0,0 +1,81 @@
+"""
+Process-wide cache of parsed alembic script directories.
+
+Databases sharing one migration tree (e.g. per-region copies of a schema) share its ScriptDirectory and heads,
+so the migration scripts are parsed once per distinct tree instead of once per database. Entries are keyed by
+script location and by the modification times of the version directories, which change whenever a migration
+script is added, removed or renamed. The same goes for the revision manifest sections, whose validation hashes
+every migration script.
+"""
+
+import logging
+import os
+import threading
+from collections.abc import Hashable
+from typing import Any
+
+from alembic.config import Config
+from alembic.script import ScriptDirectory
+
+from .revision_manifest import MANIFEST_FILE_NAME, get_version_locations, load_manifest_section
+
+logger = logging.getLogger(__name__)
+
+CacheKey = tuple[str, tuple[tuple[str, int], ...]]
+
+_script_directories: dict[CacheKey, tuple[ScriptDirectory, frozenset[str]]] = {}
+# (manifest path, manifest modification time, section name, tree) -> validated manifest section
+_manifest_sections: dict[tuple[str, int, str, CacheKey], dict[str, Any] | None] = {}
+_key_locks: dict[Hashable, threading.Lock] = {}
+_key_locks_lock = threading.Lock()
+
+
+def _get_cache_key(config: Config) -> CacheKey:
+    directory_mtimes: list[tuple[str, int]] = []
+    for version_location in get_version_locations(config):
+        for root, directories, _ in os.walk(version_location):
+            directories[:] = [directory for directory in directories if directory != "__pycache__"]
+            directory_mtimes.append((root, os.stat(root).st_mtime_ns))
+    return config.get_main_option("script_location") or "", tuple(sorted(directory_mtimes))
+
+
+def _get_key_lock(key: Hashable) -> threading.Lock:
+    with _key_locks_lock:
+        return _key_locks.setdefault(key, threading.Lock())
+
+
+def _get_parsed_script_directory(config: Config) -> tuple[ScriptDirectory, frozenset[str]]:
+    key = _get_cache_key(config)
+    # Only one thread parses a given tree, the others wait for its result
+    with _get_key_lock(key):
+        if key not in _script_directories:
+            logger.info("Parsing the migration scripts of %s", key[0])
+            script = ScriptDirectory.from_config(config)
+            _script_directories[key] = script, frozenset(script.get_heads())
+        return _script_directories[key]
+
+
+def get_script_directory(config: Config) -> ScriptDirectory:
+    """Return the ScriptDirectory of the config, with its revisions already loaded."""
+    return _get_parsed_script_directory(config)[0]
+
+
+def get_script_heads(config: Config) -> frozenset[str]:
+    """Return the head revisions of the config's script directory."""
+    return _get_parsed_script_directory(config)[1]
+
+
+def get_manifest_section(
+    alembic_directory_path: str, config: Config, section_name: str | None = None
+) -> dict[str, Any] | None:
+    """Return load_manifest_section(), validated once per manifest, section and distinct tree."""
+    manifest_path = os.path.join(alembic_directory_path, MANIFEST_FILE_NAME)
+    try:
+        manifest_mtime = os.stat(manifest_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    key = (manifest_path, manifest_mtime, section_name or config.config_ini_section, _get_cache_key(config))
+    with _get_key_lock(key):
+        if key not in _manifest_sections:
+            _manifest_sections[key] = load_manifest_section(alembic_directory_path, config, section_name=section_name)
+        return _manifest_sections[key]
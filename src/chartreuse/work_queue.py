@@ -0,0 +1,423 @@
+"""
+Work queue of the databases to migrate, shared by several Chartreuse workers.
+
+Statically splitting a fleet across pods leaves pods idle when the databases are of very uneven sizes. Instead,
+every worker claims the next database from a control table with `SELECT ... FOR UPDATE SKIP LOCKED`, checks it,
+upgrades it if needed, records the result and claims the next one until the queue is drained. A claimed database
+is leased to its worker, which renews the lease while it works on it: when a worker crashes, its lease expires and
+the database is claimed again by another worker, up to max_attempts times.
+"""
+
+import datetime
+import logging
+import threading
+import time
+from collections.abc import Callable, Collection, Iterable, Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import TYPE_CHECKING
+
+import sqlalchemy
+from sqlalchemy.engine import Connection, Engine
+
+if TYPE_CHECKING:
+    from .chartreuse import Chartreuse
+
+logger = logging.getLogger(__name__)
+
+WORK_QUEUE_TABLE = "chartreuse_work_queue"
+# Seconds a database stays claimed by a worker that stopped renewing its lease
+DEFAULT_LEASE_DURATION = 300.0
+DEFAULT_MAX_ATTEMPTS = 3
+# Seconds a worker waits before claiming again when every remaining database is claimed or waits for dependencies
+WORK_QUEUE_POLL_INTERVAL = 5.0
+# Claimable databases read at once when looking for one whose dependencies succeeded
+CLAIM_BATCH_SIZE = 100
+
+PENDING = "pending"
+CLAIMED = "claimed"
+SUCCESS_STATUSES = ("upgraded", "up_to_date")
+FAILURE_STATUSES = ("failed", "not_upgraded")
+
+metadata = sqlalchemy.MetaData()
+
+work_queue_table = sqlalchemy.Table(
+    WORK_QUEUE_TABLE,
+    metadata,
+    sqlalchemy.Column("run_id", sqlalchemy.String(255), primary_key=True),
+    sqlalchemy.Column("database", sqlalchemy.String(255), primary_key=True),
+    sqlalchemy.Column("status", sqlalchemy.String(32), nullable=False),
+    sqlalchemy.Column("depends_on", sqlalchemy.JSON, nullable=False),
+    sqlalchemy.Column("worker", sqlalchemy.String(255), nullable=True),
+    sqlalchemy.Column("lease_expires_at", sqlalchemy.DateTime(timezone=True), nullable=True),
+    sqlalchemy.Column("attempts", sqlalchemy.Integer, nullable=False, default=0),
+    sqlalchemy.Column("error", sqlalchemy.Text, nullable=True),
+    sqlalchemy.Column("updated_at", sqlalchemy.DateTime(timezone=True), nullable=False),
+    # Workers only look for the pending and claimed databases of their run
+    sqlalchemy.Index(f"ix_{WORK_QUEUE_TABLE}_status", "run_id", "status", "database"),
+)
+
+
+class WorkQueueError(Exception):
+    pass
+
+
+def _get_now(connection: Connection) -> datetime.datetime:
+    """
+    The time of the database, which leases are compared to: the clocks of the pods of the workers may be skewed.
+    """
+    now = connection.execute(sqlalchemy.select(sqlalchemy.func.current_timestamp())).scalar_one()
+    if now.tzinfo is None:
+        # SQLite's CURRENT_TIMESTAMP is in UTC
+        now = now.replace(tzinfo=datetime.UTC)
+    return now
+
+
+class WorkQueue:
+    """
+    The queue of the databases of a run, identified by run_id (e.g. the Helm revision), as seen by one worker.
+    Databases are only claimed once the databases they depend on, queued with them, were upgraded or up to date.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        run_id: str,
+        worker: str,
+        lease_duration: float = DEFAULT_LEASE_DURATION,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    ):
+        self.engine = engine
+        self.run_id = run_id
+        self.worker = worker
+        self.lease_duration = lease_duration
+        self.max_attempts = max_attempts
+
+    def create(self) -> None:
+        """Create the queue table if needed, the workers of a run possibly creating it at the same time."""
+        try:
+            with self.engine.begin() as connection:
+                metadata.create_all(connection, checkfirst=True)
+        except sqlalchemy.exc.DBAPIError:
+            if not sqlalchemy.inspect(self.engine).has_table(WORK_QUEUE_TABLE):
+                raise
+
+    def enqueue(self, databases: Iterable[tuple[str, Sequence[str]]]) -> None:
+        """
+        Add the databases to the queue with the databases they depend on, skipping the ones other workers of the run
+        already added.
+        """
+        dependencies = dict(databases)
+        if not dependencies:
+            return
+        with self.engine.begin() as connection:
+            queued = set(
+                connection.execute(
+                    sqlalchemy.select(work_queue_table.c.database).where(
+                        work_queue_table.c.run_id == self.run_id, work_queue_table.c.database.in_(list(dependencies))
+                    )
+                ).scalars()
+            )
+            now = _get_now(connection)
+            rows = [
+                {
+                    "run_id": self.run_id,
+                    "database": database,
+                    "status": PENDING,
+                    "depends_on": list(depends_on),
+                    "attempts": 0,
+                    "updated_at": now,
+                }
+                for database, depends_on in dependencies.items()
+                if database not in queued
+            ]
+            if not rows:
+                return
+            try:
+                with connection.begin_nested():
+                    connection.execute(work_queue_table.insert(), rows)
+            except sqlalchemy.exc.IntegrityError:
+                # Another worker enqueued them meanwhile
+                logger.info("The databases of run %s were already queued.", self.run_id)
+                return
+        logger.info("Queued %d database(s) for run %s.", len(rows), self.run_id)
+
+    def _set_status(self, connection: Connection, database: str, status: str, error: str | None = None) -> None:
+        connection.execute(
+            work_queue_table.update()
+            .where(work_queue_table.c.run_id == self.run_id, work_queue_table.c.database == database)
+            .values(status=status, error=error, lease_expires_at=None, updated_at=_get_now(connection))
+        )
+
+    def claim(self, databases: Collection[str] | None = None) -> str | None:
+        """
+        Claim the next database to migrate, among the given databases if any, None if no database can be claimed
+        right now: every remaining one is claimed by a live worker or waits for its dependencies, or the queue is
+        drained.
+        """
+        while True:
+            database, claimed = self._try_claim(databases)
+            if database is None or claimed:
+                return database
+            # Claimed by another worker meanwhile, on backends without SKIP LOCKED: try the next one
+
+    def _is_claimable(
+        self, now: datetime.datetime, databases: Collection[str] | None = None
+    ) -> sqlalchemy.ColumnElement[bool]:
+        """
+        Whether a database of the run, one of the given databases if any, is pending, or claimed by a worker whose
+        lease expired.
+        """
+        is_claimable = sqlalchemy.and_(
+            work_queue_table.c.run_id == self.run_id,
+            sqlalchemy.or_(
+                work_queue_table.c.status == PENDING,
+                sqlalchemy.and_(work_queue_table.c.status == CLAIMED, work_queue_table.c.lease_expires_at < now),
+            ),
+        )
+        if databases is None:
+            return is_claimable
+        return sqlalchemy.and_(is_claimable, work_queue_table.c.database.in_(databases))
+
+    def _get_statuses_of(self, connection: Connection, databases: set[str]) -> dict[str, str]:
+        if not databases:
+            return {}
+        rows = connection.execute(
+            sqlalchemy.select(work_queue_table.c.database, work_queue_table.c.status).where(
+                work_queue_table.c.run_id == self.run_id, work_queue_table.c.database.in_(sorted(databases))
+            )
+        ).all()
+        return {row.database: row.status for row in rows}
+
+    def _get_candidates(self, connection: Connection, rows: list[sqlalchemy.Row]) -> list[str]:
+        """
+        The claimable databases of the rows whose dependencies all succeeded. The ones with a failed dependency are
+        not upgraded, the ones claimed max_attempts times failed.
+        """
+        statuses = self._get_statuses_of(connection, {dependency for row in rows for dependency in row.depends_on})
+        candidates = []
+        for row in rows:
+            failed_dependencies = [d for d in row.depends_on if statuses.get(d) in FAILURE_STATUSES]
+            if failed_dependencies:
+                self._set_status(
+                    connection,
+                    row.database,
+                    "not_upgraded",
+                    error=f"dependencies not upgraded: {', '.join(failed_dependencies)}",
+                )
+            elif row.attempts >= self.max_attempts:
+                logger.error("Database '%s' was claimed %d times without completing.", row.database, row.attempts)
+                self._set_status(connection, row.database, "failed", error=f"lease expired {row.attempts} time(s)")
+            elif all(statuses.get(d) in SUCCESS_STATUSES for d in row.depends_on):
+                candidates.append(row.database)
+        return candidates
+
+    def _try_claim(self, databases: Collection[str] | None) -> tuple[str | None, bool]:
+        """The database to claim, None if there is none, and whether it could be claimed."""
+        with self.engine.begin() as connection:
+            now = _get_now(connection)
+            # Only the claimable databases are read, by batches, until one of them can be claimed
+            last_database = ""
+            while True:
+                rows = connection.execute(
+                    sqlalchemy.select(
+                        work_queue_table.c.database, work_queue_table.c.depends_on, work_queue_table.c.attempts
+                    )
+                    .where(self._is_claimable(now, databases), work_queue_table.c.database > last_database)
+                    .order_by(work_queue_table.c.database)
+                    .limit(CLAIM_BATCH_SIZE)
+                ).all()
+                if not rows:
+                    return None, False
+                last_database = rows[-1].database
+                candidates = self._get_candidates(connection, rows)
+                if not candidates:
+                    continue
+
+                # Rows being claimed by other workers are skipped instead of waited for
+                row = connection.execute(
+                    sqlalchemy.select(
+                        work_queue_table.c.database,
+                        work_queue_table.c.status,
+                        work_queue_table.c.worker,
+                        work_queue_table.c.attempts,
+                    )
+                    .where(self._is_claimable(now), work_queue_table.c.database.in_(candidates))
+                    .order_by(work_queue_table.c.database)
+                    .limit(1)
+                    .with_for_update(skip_locked=True)
+                ).first()
+                if row is None:
+                    continue
+                result = connection.execute(
+                    work_queue_table.update()
+                    .where(
+                        work_queue_table.c.run_id == self.run_id,
+                        work_queue_table.c.database == row.database,
+                        work_queue_table.c.status == row.status,
+                        work_queue_table.c.attempts == row.attempts,
+                    )
+                    .values(
+                        status=CLAIMED,
+                        worker=self.worker,
+                        lease_expires_at=now + datetime.timedelta(seconds=self.lease_duration),
+                        attempts=work_queue_table.c.attempts + 1,
+                        updated_at=now,
+                    )
+                )
+                if result.rowcount == 0:
+                    return row.database, False
+                if row.status == CLAIMED:
+                    logger.warning(
+                        "The lease of worker %s on database '%s' expired, claiming it.", row.worker, row.database
+                    )
+                return row.database, True
+
+    def _update_claimed(self, database: str, lease_duration: float | None = None, **values: object) -> bool:
+        """
+        Update the database if it is still claimed by this worker, return whether it was.
+        With a lease_duration, extend the lease to lease_duration seconds from now.
+        """
+        with self.engine.begin() as connection:
+            now = _get_now(connection)
+            if lease_duration is not None:
+                values["lease_expires_at"] = now + datetime.timedelta(seconds=lease_duration)
+            result = connection.execute(
+                work_queue_table.update()
+                .where(
+                    work_queue_table.c.run_id == self.run_id,
+                    work_queue_table.c.database == database,
+                    work_queue_table.c.status == CLAIMED,
+                    work_queue_table.c.worker == self.worker,
+                )
+                .values(updated_at=now, **values)
+            )
+        return result.rowcount > 0
+
+    def renew_lease(self, database: str) -> bool:
+        """Extend the lease on the database, return False if it was lost to another worker."""
+        return self._update_claimed(database, lease_duration=self.lease_duration)
+
+    def complete(self, database: str, status: str, error: str | None = None) -> None:
+        """Record the result of the database, if the lease on it was not lost meanwhile."""
+        if not self._update_claimed(database, status=status, error=error, lease_expires_at=None):
+            logger.warning("Lost the lease on database '%s', not recording its result (%s).", database, status)
+
+    @contextmanager
+    def hold_lease(self, database: str) -> Iterator[None]:
+        """Renew the lease on the database in the background while working on it."""
+        stopped = threading.Event()
+
+        def renew() -> None:
+            while not stopped.wait(self.lease_duration / 3):
+                try:
+                    if not self.renew_lease(database):
+                        logger.warning("Lost the lease on database '%s' to another worker.", database)
+                        return
+                except Exception as e:
+                    logger.warning("Could not renew the lease on database '%s': %s", database, e)
+
+        renewer = threading.Thread(target=renew, name=f"chartreuse-lease-{database}", daemon=True)
+        renewer.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            renewer.join()
+
+    def get_statuses(self) -> dict[str, str]:
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                sqlalchemy.select(work_queue_table.c.database, work_queue_table.c.status).where(
+                    work_queue_table.c.run_id == self.run_id
+                )
+            ).all()
+        return {row.database: row.status for row in rows}
+
+    def has_claimable(self, databases: Collection[str] | None = None) -> bool:
+        """
+        Whether a database of the run, one of the given databases if any, is pending or claimed by a worker whose
+        lease expired, even if it can't be claimed until its dependencies are upgraded.
+        """
+        with self.engine.connect() as connection:
+            claimable = connection.execute(
+                sqlalchemy.select(work_queue_table.c.database)
+                .where(self._is_claimable(_get_now(connection), databases))
+                .limit(1)
+            ).first()
+        return claimable is not None
+
+    def is_drained(self) -> bool:
+        with self.engine.connect() as connection:
+            remaining = connection.execute(
+                sqlalchemy.select(work_queue_table.c.database)
+                .where(work_queue_table.c.run_id == self.run_id, work_queue_table.c.status.in_((PENDING, CLAIMED)))
+                .limit(1)
+            ).first()
+        return remaining is None
+
+
+def process_work_queue(
+    queue: WorkQueue,
+    chartreuse: "Chartreuse",
+    concurrency: int,
+    before_upgrade: Callable[[str], None] | None = None,
+) -> None:
+    """
+    Claim databases from concurrency threads until the queue is drained, checking each one and upgrading it when
+    needed, after calling before_upgrade with its name. Raise WorkQueueError if a database of the queue failed, be it
+    claimed by this worker or another one.
+
+    The databases are queued and claimed by the batches of the Chartreuse, so that the helpers of only one batch of
+    fleet databases are held at once: the databases of a batch are claimed, with the databases of databases_config
+    they depend on, until none of them is left to claim.
+    """
+
+    def work(databases: Collection[str]) -> None:
+        while True:
+            database = queue.claim(databases)
+            if database is None:
+                if not queue.has_claimable(databases):
+                    return
+                time.sleep(WORK_QUEUE_POLL_INTERVAL)
+                continue
+
+            logger.info("Claimed database '%s'.", database)
+            with queue.hold_lease(database):
+                try:
+                    if chartreuse.is_database_migration_needed(database):
+                        if before_upgrade is not None:
+                            before_upgrade(database)
+                        chartreuse.upgrade_database(database)
+                        status, error = "upgraded", None
+                    else:
+                        status, error = "up_to_date", None
+                except Exception as e:
+                    logger.error("Failed to upgrade database '%s': %s", database, e)
+                    status, error = "failed", str(e)
+            queue.complete(database, status, error)
+
+    def work_on_batches() -> None:
+        for batch in chartreuse.iter_database_batches():
+            queue.enqueue((db_name, db_config.depends_on) for db_name, db_config in batch.items())
+            databases = {*chartreuse.databases_config, *batch}
+            for worker in [executor.submit(work, databases) for _ in range(concurrency)]:
+                worker.result()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="chartreuse-queue") as executor:
+        work_on_batches()
+        # The remaining databases are claimed by other workers: go over the batches again if one of them stopped
+        # renewing its lease
+        while not queue.is_drained():
+            time.sleep(WORK_QUEUE_POLL_INTERVAL)
+            if queue.has_claimable():
+                work_on_batches()
+
+    statuses = queue.get_statuses()
+    failed = [database for database, status in statuses.items() if status == "failed"]
+    not_upgraded = [database for database, status in statuses.items() if status == "not_upgraded"]
+    if failed or not_upgraded:
+        raise WorkQueueError(
+            f"Failed to upgrade database(s): {', '.join(failed)}"
+            + (f", not upgraded: {', '.join(not_upgraded)}" if not_upgraded else "")
+        )